@@ -0,0 +1,61 @@
+"""
+Benchmark the (cold) import time of the subauth package and its adapters.
+
+Each import is timed in a fresh interpreter, and the results (in milliseconds) are printed as JSON.
+Run with: python benchmarks/import_time.py [--runs N]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+SRC_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '../src'))
+
+## The modules that should only be loaded when they are used
+HEAVY_MODULES = [ "azure.cosmos", "azure.identity", "azure.functions", "azurefunctions", "cachetools", "fastapi", "jose", "msal", "requests" ]
+
+IMPORTS = {
+    "subauth": "import subauth",
+    "subauth.rules": "from subauth.rules import create_rule",
+    "subauth.function_utils": "from subauth import function_utils",
+    "subauth.fastapi_utils": "from subauth import fastapi_utils",
+    "subauth.sub_factory": "from subauth import get_subscription",
+}
+
+_SCRIPT = """
+import sys, time, json
+sys.path.insert(0, {src!r})
+start = time.perf_counter()
+{stmt}
+elapsed = time.perf_counter() - start
+print(json.dumps({{ "ms": elapsed * 1000, "loaded": [ m for m in {heavy!r} if m in sys.modules ] }}))
+"""
+
+def measure_import(stmt:str) -> dict:
+    """
+    Time the given import statement in a fresh interpreter, and report which of the heavy modules it loaded.
+    """
+    script = _SCRIPT.format(src=SRC_DIR, stmt=stmt, heavy=HEAVY_MODULES)
+    out = subprocess.run([ sys.executable, "-c", script ], check=True, capture_output=True, text=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+def run(runs:int = 5) -> dict:
+    results = {}
+    for name, stmt in IMPORTS.items():
+        samples = [ measure_import(stmt) for _ in range(runs) ]
+        times = [ sample["ms"] for sample in samples ]
+        results[name] = {
+            "median_ms": statistics.median(times),
+            "min_ms": min(times),
+            "max_ms": max(times),
+            "loaded": samples[-1]["loaded"],
+        }
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+    print(json.dumps(run(args.runs), indent=2))
@@ -0,0 +1,76 @@
+"""
+Benchmark JWT (RS256) verification throughput, per verification backend.
+
+Compares python-jose given the raw JWK (how the adapters used to verify tokens), python-jose given a
+pre-constructed key, and the cryptography backend. Results (tokens verified per second, on one core) are printed as JSON.
+Run with: python benchmarks/jwt_verify.py [--seconds N]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+
+from subauth.verifiers import JoseVerifier, CryptographyVerifier
+
+AUDIENCE = "benchmark-client-id"
+ISSUER = "https://login.microsoftonline.com/benchmark/v2.0"
+
+def make_signing_key(kid:str = "benchmark-kid") -> tuple[str, dict]:
+    """
+    Generate an RSA key pair, returning the private key (PEM) and the public key (JWK).
+    """
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    from jose import jwk
+
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    private_pem = private_key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()).decode()
+    public_pem = private_key.public_key().public_bytes(serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo).decode()
+    public_jwk = jwk.construct(public_pem, "RS256").to_dict()
+    public_jwk["kid"] = kid
+    return private_pem, public_jwk
+
+def make_token(private_pem:str, kid:str = "benchmark-kid", **claims) -> str:
+    from jose import jwt
+    now = int(time.time())
+    payload = { "aud": AUDIENCE, "iss": ISSUER, "iat": now, "nbf": now, "exp": now + 3600, "preferred_username": "user@example.com" }
+    payload.update(claims)
+    return jwt.encode(payload, private_pem, algorithm="RS256", headers={ "kid": kid })
+
+def _tokens_per_second(verify, seconds:float) -> float:
+    count = 0
+    start = time.perf_counter()
+    while True:
+        for _ in range(0, 50):
+            verify()
+        count += 50
+        elapsed = time.perf_counter() - start
+        if elapsed >= seconds:
+            return count / elapsed
+
+def run(seconds:float = 2.0) -> dict:
+    from jose import jwt
+
+    private_pem, public_jwk = make_signing_key()
+    token = make_token(private_pem)
+    results = {}
+
+    def jose_raw_jwk():
+        header = jwt.get_unverified_header(token)
+        jwt.decode(token, { header["kid"]: public_jwk }[header["kid"]], algorithms=["RS256"], audience=AUDIENCE, issuer=ISSUER)
+    results["jose_raw_jwk"] = _tokens_per_second(jose_raw_jwk, seconds)
+
+    for verifier in (JoseVerifier(), CryptographyVerifier()):
+        key = verifier.prepare_key(public_jwk)
+        results[verifier.name] = _tokens_per_second(lambda: verifier.verify(token, lambda kid: key, AUDIENCE, ISSUER), seconds)
+
+    return { name: { "tokens_per_second": round(rate, 1), "speedup": round(rate / results["jose_raw_jwk"], 2) } for name, rate in results.items() }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--seconds", type=float, default=2.0)
+    args = parser.parse_args()
+    print(json.dumps(run(args.seconds), indent=2))
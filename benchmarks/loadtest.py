@@ -0,0 +1,333 @@
+"""
+End-to-end load test of validate_function_request, against a synthetic corpus of subscriptions in the in-process fake CosmosDB container.
+
+A corpus of subscriptions is generated with a configurable mix of rule profiles, and a request stream with a Zipfian skew
+(a few subscriptions get most of the traffic, like real traffic) is replayed through the Azure Functions adapter or a FastAPI app (called directly over ASGI).
+Reports the throughput, the latency percentiles (p50/p95/p99/p99.9), the subscription cache hit ratio and the store calls per request, as JSON.
+Everything runs in one process, so it only needs one (Linux) machine - 1M subscriptions needs a few GB of memory.
+
+Run with: python benchmarks/loadtest.py [--subscriptions 100000] [--requests 200000] [--adapter functions|asgi] [--zipf 1.1] [--store-latency lognormal:4:0.6]
+"""
+import argparse
+import asyncio
+import bisect
+import itertools
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+
+## The rule profiles of the generated subscriptions (and their default share of the corpus)
+DEFAULT_RULE_MIX = { "host": 0.3, "typical": 0.5, "large": 0.1, "ip": 0.1 }
+
+ALLOWED_PATH = "/api/v1/resource0"
+DENIED_PATH = "/internal/0/secrets"
+CLIENT_IP = "10.1.2.3"
+
+## The large profile shares its (long) pattern lists between the subscriptions, to keep the memory of a big corpus down
+_SHARED_PATHS = [ f"/api/v1/resource{i}" if i % 5 < 3 else (f"/app{i}/*" if i % 5 == 3 else f"regex(/api/v2/items{i}/\\d+)") for i in range(50) ]
+_SHARED_DENIED_PATHS = [ f"/internal/{i}/*" for i in range(10) ]
+_SHARED_NETWORKS = [ f"10.{i}.0.0/16" for i in range(10) ]
+_TYPICAL_PATHS = [ "/api/v1/*", "/app/*", "/static/*", "/health", "regex(/api/v2/items/\\d+)" ]
+
+
+def subscription_host(sub_id:str) -> str:
+    return sub_id + ".example.com"
+
+def _subscription_doc(sub_id:str, profile:str) -> dict:
+    host_rule = { "name": "hosts", "type": "host", "hosts": [ subscription_host(sub_id) ] }
+    if profile == "host":
+        rules = [ host_rule ]
+    elif profile == "typical":
+        rules = [ host_rule, { "name": "paths", "type": "path", "paths": _TYPICAL_PATHS }, { "name": "methods", "type": "method", "methods": [ "GET", "POST" ] } ]
+    elif profile == "large":
+        rules = [
+            host_rule,
+            { "name": "paths", "type": "path", "paths": _SHARED_PATHS },
+            { "name": "client", "type": "header", "header": "x-api-client", "values": [ "client-*" ] },
+            { "name": "network", "type": "client-ip", "ips": _SHARED_NETWORKS },
+            { "name": "internal", "type": "path", "allow": False, "paths": _SHARED_DENIED_PATHS },
+        ]
+    elif profile == "ip":
+        rules = [ host_rule, { "name": "network", "type": "client-ip", "ips": [ "10.0.0.0/8" ] } ]
+    else:
+        raise ValueError(f"Unknown rule profile: {profile}")
+    return { "id": sub_id, "name": sub_id, "expiry": -1, "browserstore": False, "rules": rules }
+
+def parse_rule_mix(spec:str) -> dict[str, float]:
+    """
+    Parse a rule mix, eg. "typical=0.6,host=0.3,large=0.1".
+    """
+    mix = {}
+    for part in spec.split(","):
+        name, _, weight = part.partition("=")
+        mix[name.strip()] = float(weight) if weight else 1.0
+    return mix
+
+def generate_corpus(count:int, rule_mix:dict[str, float] = None, seed:int = 1) -> list[dict]:
+    """
+    Generate count subscription documents, with rule profiles drawn from the (weighted) rule mix.
+    """
+    rule_mix = rule_mix if rule_mix else DEFAULT_RULE_MIX
+    rng = random.Random(seed)
+    profiles = list(rule_mix.keys())
+    cumulative = list(itertools.accumulate(rule_mix[profile] for profile in profiles))
+    docs = []
+    for i in range(count):
+        profile = profiles[bisect.bisect_right(cumulative, rng.random() * cumulative[-1])]
+        docs.append(_subscription_doc(f"sub-{i:07d}", profile))
+    return docs
+
+def zipf_sampler(n:int, s:float, rng:random.Random):
+    """
+    Get a function that samples a rank in [0, n) with a Zipfian distribution (the probability of rank k is proportional to 1 / (k + 1)^s).
+    """
+    cumulative = list(itertools.accumulate(1.0 / (k ** s) for k in range(1, n + 1)))
+    total = cumulative[-1]
+    return lambda: min(n - 1, bisect.bisect_left(cumulative, rng.random() * total))
+
+def request_stream(sub_ids:list[str], count:int, zipf_s:float = 1.1, deny_ratio:float = 0.05, unknown_ratio:float = 0.01, seed:int = 1) -> list[tuple[str, str, str]]:
+    """
+    Generate a stream of (subscription id, host, path) requests. The subscriptions are picked with a Zipfian skew (in a random order, so the
+    popular subscriptions are spread over the corpus). deny_ratio of the requests are for a path most subscriptions don't allow,
+    and unknown_ratio are for subscriptions that don't exist.
+    """
+    rng = random.Random(seed)
+    order = list(range(len(sub_ids)))
+    rng.shuffle(order)
+    sample = zipf_sampler(len(sub_ids), zipf_s, rng)
+    stream = []
+    for i in range(count):
+        if rng.random() < unknown_ratio:
+            sub_id = f"unknown-{rng.randrange(1 << 30)}"
+        else:
+            sub_id = sub_ids[order[sample()]]
+        path = DENIED_PATH if rng.random() < deny_ratio else ALLOWED_PATH
+        stream.append((sub_id, subscription_host(sub_id), path))
+    return stream
+
+def percentiles(latencies_ns:list[int]) -> dict[str, float]:
+    """
+    The (nearest rank) latency percentiles, in milliseconds.
+    """
+    ordered = sorted(latencies_ns)
+    if not ordered:
+        return {}
+    def at(p:float) -> float:
+        return round(ordered[min(len(ordered) - 1, max(0, int(p * len(ordered) + 0.5) - 1))] / 1e6, 4)
+    return { "p50_ms": at(0.50), "p95_ms": at(0.95), "p99_ms": at(0.99), "p999_ms": at(0.999), "max_ms": round(ordered[-1] / 1e6, 4), "mean_ms": round(sum(ordered) / len(ordered) / 1e6, 4) }
+
+
+## The adapters
+
+def _headers(sub_id:str, host:str) -> dict[str, str]:
+    return { "Host": host, "subscription": sub_id, "x-forwarded-for": CLIENT_IP, "x-api-client": "client-load", "Accept": "application/json" }
+
+def _run_functions(stream:list[tuple[str, str, str]], concurrency:int) -> tuple[list[int], int]:
+    """
+    Replay the stream through the Azure Functions adapter, on concurrency threads. Returns the latencies and the number of requests allowed.
+    """
+    import azure.functions as func
+    from subauth import function_utils
+
+    latencies = [ 0 ] * len(stream)
+    allowed_counts = [ 0 ] * concurrency
+
+    def worker(index:int):
+        allowed_count = 0
+        for i in range(index, len(stream), concurrency):
+            sub_id, host, path = stream[i]
+            req = func.HttpRequest("GET", "https://" + host + path, headers=_headers(sub_id, host), body=b"", route_params={})
+            start = time.perf_counter_ns()
+            allowed, _, _ = function_utils.validate_function_request(req)
+            latencies[i] = time.perf_counter_ns() - start
+            allowed_count += 1 if allowed else 0
+        allowed_counts[index] = allowed_count
+
+    threads = [ threading.Thread(target=worker, args=(index,)) for index in range(concurrency) ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, sum(allowed_counts)
+
+def create_asgi_app():
+    """
+    A FastAPI app that validates every request with the FastAPI adapter.
+    """
+    from fastapi import FastAPI, Request as FastApiRequest
+    from fastapi.responses import PlainTextResponse
+    from subauth import fastapi_utils
+
+    app = FastAPI()
+
+    @app.api_route("/{path:path}", methods=[ "GET", "POST" ])
+    async def handle(request:FastApiRequest, path:str):
+        allowed, _, response = fastapi_utils.validate_function_request(request)
+        if not allowed:
+            return response
+        return PlainTextResponse("OK")
+
+    return app
+
+async def _call_asgi(app, host:str, path:str, headers:dict[str, str]) -> int:
+    status = 0
+    scope = {
+        "type": "http",
+        "asgi": { "version": "3.0" },
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "https",
+        "path": path,
+        "raw_path": path.encode(),
+        "root_path": "",
+        "query_string": b"",
+        "headers": [ (name.lower().encode(), value.encode()) for name, value in headers.items() ],
+        "client": (CLIENT_IP, 50000),
+        "server": (host, 443),
+    }
+
+    async def receive():
+        return { "type": "http.request", "body": b"", "more_body": False }
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+
+    await app(scope, receive, send)
+    return status
+
+def _run_asgi(stream:list[tuple[str, str, str]], concurrency:int) -> tuple[list[int], int]:
+    """
+    Replay the stream through a FastAPI app (over ASGI, without a server), with concurrency requests in flight. Returns the latencies and the number of requests allowed.
+    """
+    app = create_asgi_app()
+    latencies = [ 0 ] * len(stream)
+
+    async def worker(index:int) -> int:
+        allowed_count = 0
+        for i in range(index, len(stream), concurrency):
+            sub_id, host, path = stream[i]
+            start = time.perf_counter_ns()
+            status = await _call_asgi(app, host, path, _headers(sub_id, host))
+            latencies[i] = time.perf_counter_ns() - start
+            allowed_count += 1 if status == 200 else 0
+        return allowed_count
+
+    async def main() -> int:
+        return sum(await asyncio.gather(*[ worker(index) for index in range(concurrency) ]))
+
+    return latencies, asyncio.run(main())
+
+ADAPTERS = { "functions": _run_functions, "asgi": _run_asgi }
+
+
+def run(subscriptions:int = 10000, requests:int = 100000, adapter:str = "functions", concurrency:int = 1, zipf_s:float = 1.1, rule_mix:dict[str, float] = None,
+        deny_ratio:float = 0.05, unknown_ratio:float = 0.01, cache_size:int = None, store_latency:str = None, warmup:int = 0, corpus:str = None, seed:int = 1) -> dict:
+    """
+    Generate (or load) the corpus, replay a request stream through the adapter, and report the results.
+    """
+    from subauth import metrics, shield, sub_factory
+    from subauth.caching import MeteredTTLCache
+    from subauth.dataaccess import is_alias_doc
+    from subauth.dataaccess.fake_cosmos import FakeContainerProxy, LatencyModel, register_fake_container
+
+    started = time.perf_counter()
+    if corpus:
+        fake = FakeContainerProxy.from_file(corpus, latency=LatencyModel(store_latency), seed=seed)
+    else:
+        fake = FakeContainerProxy(generate_corpus(subscriptions, rule_mix, seed), latency=LatencyModel(store_latency), seed=seed)
+    sub_ids = sorted(doc["id"] for doc in fake.query_items("SELECT c.id FROM c", enable_cross_partition_query=True) if not is_alias_doc(doc))
+    stream = request_stream(sub_ids, warmup + requests, zipf_s, deny_ratio, unknown_ratio, seed)
+    setup_seconds = time.perf_counter() - started
+
+    register_fake_container("subscriptions", fake)
+    sub_factory._COSMOS_DB_CONNECTION = None
+    cache_size = cache_size if cache_size is not None else sub_factory._SUBSCRIPTION_CACHE_SIZE
+    sub_factory._SUBSCRIPTION_CACHE = MeteredTTLCache("subscription", maxsize=cache_size, ttl=3600)
+    ## All the requests come from the same client IP, so it would soon be throttled for the unknown subscriptions
+    shield.set_failure_throttle(shield.FailureThrottle(max_failures=0))
+
+    replay = ADAPTERS[adapter]
+    if warmup:
+        replay(stream[:warmup], concurrency)
+    metrics.REGISTRY.reset()
+    fake.reset_stats()
+
+    started = time.perf_counter()
+    latencies, allowed = replay(stream[warmup:], concurrency)
+    elapsed = time.perf_counter() - started
+
+    hits = metrics.CACHE_HITS.value("subscription")
+    misses = metrics.CACHE_MISSES.value("subscription")
+    store_calls = sum(fake.calls.values())
+    return {
+        "config": {
+            "adapter": adapter,
+            "subscriptions": len(sub_ids),
+            "requests": requests,
+            "warmup": warmup,
+            "concurrency": concurrency,
+            "zipf_s": zipf_s,
+            "rule_mix": rule_mix if rule_mix else DEFAULT_RULE_MIX,
+            "deny_ratio": deny_ratio,
+            "unknown_ratio": unknown_ratio,
+            "cache_size": cache_size,
+            "store_latency": store_latency,
+            "seed": seed,
+        },
+        "setup_seconds": round(setup_seconds, 3),
+        "elapsed_seconds": round(elapsed, 3),
+        "throughput_rps": round(requests / elapsed, 1) if elapsed > 0 else None,
+        "latency": percentiles(latencies),
+        "allowed": allowed,
+        "denied": requests - allowed,
+        "cache_hit_ratio": round(hits / (hits + misses), 4) if hits + misses else None,
+        "store_calls_per_request": round(store_calls / requests, 4) if requests else None,
+        "store_calls": dict(fake.calls),
+        "max_rss_mb": _max_rss_mb(),
+    }
+
+def _max_rss_mb() -> float|None:
+    try:
+        import resource
+        return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)     ## KB on Linux
+    except ImportError:
+        return None
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--subscriptions", type=int, default=10000, help="The number of subscriptions in the corpus (eg. 10000, 100000, 1000000)")
+    parser.add_argument("--requests", type=int, default=100000)
+    parser.add_argument("--adapter", choices=ADAPTERS.keys(), default="functions")
+    parser.add_argument("--concurrency", type=int, default=1, help="The number of threads (functions) or requests in flight (asgi)")
+    parser.add_argument("--zipf", type=float, default=1.1, help="The skew of the traffic (higher is more skewed)")
+    parser.add_argument("--rule-mix", default=None, help="The share of each rule profile (host, typical, large, ip), eg. typical=0.6,host=0.3,large=0.1")
+    parser.add_argument("--deny-ratio", type=float, default=0.05)
+    parser.add_argument("--unknown-ratio", type=float, default=0.01, help="The share of requests for subscriptions that don't exist")
+    parser.add_argument("--cache-size", type=int, default=None, help="The subscription cache size (defaults to SUBSCRIPTION_CACHE_SIZE)")
+    parser.add_argument("--store-latency", default=None, help="The injected store latency, eg. lognormal:4:0.6 (see LatencyModel)")
+    parser.add_argument("--warmup", type=int, default=0, help="The number of requests to replay before measuring")
+    parser.add_argument("--corpus", default=None, help="Load the corpus from a JSON/JSONL file, rather than generating it")
+    parser.add_argument("--save-corpus", default=None, help="Save the generated corpus to a JSONL file (and exit)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default=None, help="Write the results (JSON) to this file")
+    args = parser.parse_args()
+
+    rule_mix = parse_rule_mix(args.rule_mix) if args.rule_mix else None
+    if args.save_corpus:
+        from subauth.dataaccess.fake_cosmos import FakeContainerProxy
+        FakeContainerProxy(generate_corpus(args.subscriptions, rule_mix, args.seed)).save(args.save_corpus)
+        sys.exit(0)
+
+    results = run(args.subscriptions, args.requests, args.adapter, args.concurrency, args.zipf, rule_mix, args.deny_ratio, args.unknown_ratio,
+                  args.cache_size, args.store_latency, args.warmup, args.corpus, args.seed)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
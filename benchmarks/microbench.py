@@ -0,0 +1,439 @@
+"""
+Microbenchmarks for the rule engine, request parsing, the subscription lookup and token verification.
+
+Each benchmark is timed (the median time per call, over several auto-calibrated repeats), and its allocations are
+measured with tracemalloc (the peak memory allocated during a call, and the memory still held after many calls).
+The results are written as JSON (with the Python version, platform and git commit), so runs can be compared between releases.
+
+Run with: python benchmarks/microbench.py [--filter PATTERN] [--quick] [--output results.json] [--compare baseline.json]
+"""
+import argparse
+import datetime
+import fnmatch
+import gc
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from typing import Callable
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+
+from subauth.data import Request, Subscription
+from subauth.rules import HostCheck, PathCheck, HeaderCheck, QueryCheck, CookieCheck, MethodCheck, ClientIPCheck, DateCheck, RateCheck
+from subauth.ratelimit import LocalRateLimiter
+
+RULE_SIZES = ( 1, 10, 100 )
+
+_BENCHMARKS:dict[str, Callable[[], Callable[[], any]]] = {}
+
+
+def benchmark(name:str):
+    """
+    Register a benchmark: the decorated function does the setup, and returns the function to time.
+    """
+    def register(setup:Callable[[], Callable[[], any]]):
+        _BENCHMARKS[name] = setup
+        return setup
+    return register
+
+
+## Measuring
+
+def measure_time(fn:Callable[[], any], min_time:float = 0.05, repeats:int = 5) -> dict:
+    """
+    Time the function: the number of calls per repeat is calibrated so each repeat takes at least min_time seconds.
+    """
+    number = 1
+    while True:
+        start = time.perf_counter_ns()
+        for _ in range(number):
+            fn()
+        elapsed = time.perf_counter_ns() - start
+        if elapsed >= min_time * 1e9 or number >= 1 << 24:
+            break
+        number *= 2 if elapsed <= 0 else max(2, min(10, int(min_time * 1e9 / elapsed) + 1))
+
+    samples = [ elapsed / number ]
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeats - 1):
+            start = time.perf_counter_ns()
+            for _ in range(number):
+                fn()
+            samples.append((time.perf_counter_ns() - start) / number)
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+    return {
+        "median_ns": round(statistics.median(samples), 1),
+        "min_ns": round(min(samples), 1),
+        "stdev_ns": round(statistics.stdev(samples), 1) if len(samples) > 1 else 0.0,
+        "calls_per_repeat": number,
+        "repeats": len(samples),
+    }
+
+def measure_allocations(fn:Callable[[], any], calls:int = 200) -> dict:
+    """
+    Measure the memory allocated by the function with tracemalloc: the peak allocated during a single call,
+    and the memory still held (per call) after many calls (which should be 0, unless the function caches something).
+    """
+    fn()    ## Warm up any lazy initialisation
+    tracemalloc.start()
+    try:
+        peaks = []
+        for _ in range(min(calls, 20)):
+            tracemalloc.reset_peak()
+            before, _ = tracemalloc.get_traced_memory()
+            fn()
+            _, peak = tracemalloc.get_traced_memory()
+            peaks.append(peak - before)
+
+        gc.collect()
+        before, _ = tracemalloc.get_traced_memory()
+        for _ in range(calls):
+            fn()
+        gc.collect()
+        after, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "peak_bytes": int(statistics.median(peaks)),
+        "retained_bytes_per_call": round(max(0, after - before) / calls, 1),
+    }
+
+def run(pattern:str = "*", min_time:float = 0.05, repeats:int = 5, allocations:bool = True) -> dict:
+    """
+    Run the benchmarks whose name matches the (glob) pattern, and return the results (with details of the environment).
+    """
+    results = {}
+    for name, setup in _BENCHMARKS.items():
+        if not fnmatch.fnmatch(name, pattern):
+            continue
+        fn = setup()
+        result = measure_time(fn, min_time, repeats)
+        if allocations:
+            result.update(measure_allocations(fn))
+        results[name] = result
+    return { "meta": _environment(), "results": results }
+
+def _environment() -> dict:
+    try:
+        commit = subprocess.run([ "git", "rev-parse", "--short", "HEAD" ], capture_output=True, text=True, cwd=os.path.dirname(__file__), timeout=5).stdout.strip() or None
+    except Exception:
+        commit = None
+    return {
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "commit": commit,
+    }
+
+def compare(baseline:dict, current:dict, threshold:float = 0.10) -> list[dict]:
+    """
+    Compare two runs, returning the change in the median time (and peak allocation) of each benchmark in both.
+    A benchmark has regressed if its median time grew by more than the threshold (a fraction).
+    """
+    changes = []
+    for name, result in current["results"].items():
+        base = baseline["results"].get(name, None)
+        if base is None:
+            continue
+        ratio = result["median_ns"] / base["median_ns"] if base["median_ns"] else float("inf")
+        changes.append({
+            "name": name,
+            "baseline_ns": base["median_ns"],
+            "current_ns": result["median_ns"],
+            "ratio": round(ratio, 3),
+            "peak_bytes_change": result.get("peak_bytes", 0) - base.get("peak_bytes", 0),
+            "regressed": ratio > 1 + threshold,
+        })
+    return changes
+
+
+## Rules
+
+def _patterns(n:int, exact:Callable[[int], str], wildcard:Callable[[int], str], regex:Callable[[int], str]) -> list[str]:
+    """
+    A realistic mix of n patterns: mostly exact values, with some wildcards and regexes.
+    """
+    patterns = []
+    for i in range(n):
+        if i % 5 == 3:
+            patterns.append(wildcard(i))
+        elif i % 5 == 4:
+            patterns.append("regex(" + regex(i) + ")")
+        else:
+            patterns.append(exact(i))
+    return patterns
+
+def _rule_benchmark(name:str, create:Callable[[int], any], matching:Callable[[int], Request], missing:Request):
+    """
+    Register benchmarks for a rule at each size: a request that matches the last pattern (so every pattern is tried), and one that matches none.
+    """
+    for n in RULE_SIZES:
+        @benchmark(f"rules.{name}.{n}.match_last")
+        def match_last(n=n):
+            rule, req = create(n), matching(n)
+            return lambda: rule.matches(req)
+
+        @benchmark(f"rules.{name}.{n}.miss")
+        def miss(n=n):
+            rule = create(n)
+            return lambda: rule.matches(missing)
+
+_rule_benchmark(
+    "host",
+    lambda n: HostCheck(_patterns(n, lambda i: f"app{i}.example.com", lambda i: f"*.tenant{i}.example.com", lambda i: f"api{i}\\.example[\\d]\\.com")),
+    lambda n: Request("GET", f"app{n - 1}.example.com" if (n - 1) % 5 < 3 else (f"x.tenant{n - 1}.example.com" if (n - 1) % 5 == 3 else f"api{n - 1}.example1.com"), "/", {}),
+    Request("GET", "other.test", "/", {}),
+)
+_rule_benchmark(
+    "path",
+    lambda n: PathCheck(_patterns(n, lambda i: f"/api/v1/resource{i}", lambda i: f"/app{i}/*", lambda i: f"/api/v2/items{i}/\\d+")),
+    lambda n: Request("GET", "app.test", f"/api/v1/resource{n - 1}" if (n - 1) % 5 < 3 else (f"/app{n - 1}/home" if (n - 1) % 5 == 3 else f"/api/v2/items{n - 1}/42"), {}),
+    Request("GET", "app.test", "/not/a/known/path", {}),
+)
+_rule_benchmark(
+    "header",
+    lambda n: HeaderCheck("x-api-client", _patterns(n, lambda i: f"client-{i}", lambda i: f"partner-{i}-*", lambda i: f"svc-{i}-[a-z]+")),
+    lambda n: Request("GET", "app.test", "/", { "x-api-client": f"client-{n - 1}" if (n - 1) % 5 < 3 else (f"partner-{n - 1}-x" if (n - 1) % 5 == 3 else f"svc-{n - 1}-abc") }),
+    Request("GET", "app.test", "/", { "x-api-client": "unknown" }),
+)
+_rule_benchmark(
+    "query",
+    lambda n: QueryCheck("tenant", _patterns(n, lambda i: f"tenant{i}", lambda i: f"group{i}-*", lambda i: f"org{i}-[0-9]+")),
+    lambda n: Request("GET", "app.test", "/", {}, { "tenant": f"tenant{n - 1}" if (n - 1) % 5 < 3 else (f"group{n - 1}-x" if (n - 1) % 5 == 3 else f"org{n - 1}-7") }),
+    Request("GET", "app.test", "/", {}, { "tenant": "unknown" }),
+)
+_rule_benchmark(
+    "cookie",
+    lambda n: CookieCheck("team", _patterns(n, lambda i: f"team{i}", lambda i: f"squad{i}-*", lambda i: f"crew{i}-[a-z]+")),
+    lambda n: Request("GET", "app.test", "/", {}, cookies={ "team": f"team{n - 1}" if (n - 1) % 5 < 3 else (f"squad{n - 1}-x" if (n - 1) % 5 == 3 else f"crew{n - 1}-abc") }),
+    Request("GET", "app.test", "/", {}, cookies={ "team": "unknown" }),
+)
+_rule_benchmark(
+    "client_ip",
+    lambda n: ClientIPCheck([ f"10.{i // 256}.{i % 256}.0/24" for i in range(n) ]),
+    lambda n: Request("GET", "app.test", "/", {}, client_ip=f"10.{(n - 1) // 256}.{(n - 1) % 256}.7"),
+    Request("GET", "app.test", "/", {}, client_ip="192.168.1.1"),
+)
+
+@benchmark("rules.method.1.match_last")
+def _method_match():
+    rule, req = MethodCheck([ "GET", "POST" ]), Request("POST", "app.test", "/", {})
+    return lambda: rule.matches(req)
+
+@benchmark("rules.date.1.match_last")
+def _date_match():
+    rule, req = DateCheck("2020-01-01", ">"), Request("GET", "app.test", "/", {})
+    return lambda: rule.matches(req)
+
+@benchmark("rules.rate.1.match_last")
+def _rate_match():
+    rule, req = RateCheck(1e12), Request("GET", "app.test", "/", {}, client_ip="10.0.0.1")
+    rule.bind_subscription("bench-rate")
+    return lambda: rule.matches(req)
+
+@benchmark("ratelimit.acquire.hit")
+def _rate_acquire():
+    limiter = LocalRateLimiter()
+    return lambda: limiter.try_acquire("bench-rate", 1e12, 1e12)
+
+@benchmark("ratelimit.acquire.new_key")
+def _rate_acquire_new_key():
+    limiter, keys = LocalRateLimiter(max_buckets=10_000), [ f"bench-rate-{i}" for i in range(100_000) ]
+    counter = iter(range(1 << 62))
+    return lambda: limiter.try_acquire(keys[next(counter) % 100_000], 10, 10)
+
+
+## Subscriptions
+
+def typical_subscription_doc(sub_id:str = "bench-typical") -> dict:
+    """
+    A typical subscription: a few hosts, some paths and the methods it may use.
+    """
+    return { "id": sub_id, "name": "Typical", "expiry": -1, "rules": [
+        { "name": "hosts", "type": "host", "hosts": [ "app.example.com", "*.app.example.com", "localhost" ] },
+        { "name": "paths", "type": "path", "paths": [ "/api/v1/*", "/app/*", "/static/*", "/health", "regex(/api/v2/items/\\d+)" ] },
+        { "name": "methods", "type": "method", "methods": [ "GET", "POST" ] },
+    ] }
+
+def large_subscription_doc(sub_id:str = "bench-large") -> dict:
+    """
+    A large subscription: many hosts and paths, a header, client IP ranges and some denied paths.
+    """
+    return { "id": sub_id, "name": "Large", "expiry": -1, "rules": [
+        { "name": "hosts", "type": "host", "hosts": _patterns(20, lambda i: f"app{i}.example.com", lambda i: f"*.tenant{i}.example.com", lambda i: f"api{i}\\.example[\\d]\\.com") },
+        { "name": "paths", "type": "path", "paths": _patterns(50, lambda i: f"/api/v1/resource{i}", lambda i: f"/app{i}/*", lambda i: f"/api/v2/items{i}/\\d+") },
+        { "name": "client", "type": "header", "header": "x-api-client", "values": [ "client-*" ] },
+        { "name": "network", "type": "client-ip", "ips": [ f"10.{i}.0.0/16" for i in range(10) ] },
+        { "name": "internal", "type": "path", "allow": False, "paths": [ f"/internal/{i}/*" for i in range(10) ] },
+    ] }
+
+@benchmark("is_allowed.typical.allowed")
+def _typical_allowed():
+    sub, req = Subscription(typical_subscription_doc()), Request("GET", "app.example.com", "/api/v1/users", {})
+    return lambda: sub.is_allowed(req)
+
+@benchmark("is_allowed.typical.denied")
+def _typical_denied():
+    sub, req = Subscription(typical_subscription_doc()), Request("DELETE", "app.example.com", "/api/v1/users", {})
+    return lambda: sub.is_allowed(req)
+
+@benchmark("is_allowed.large.allowed")
+def _large_allowed():
+    sub = Subscription(large_subscription_doc())
+    req = Request("GET", "app0.example.com", "/api/v1/resource47", { "x-api-client": "client-7" }, client_ip="10.9.1.1")
+    return lambda: sub.is_allowed(req)
+
+@benchmark("is_allowed.large.denied")
+def _large_denied():
+    sub = Subscription(large_subscription_doc())
+    req = Request("GET", "app0.example.com", "/api/v1/resource47", { "x-api-client": "client-7" }, client_ip="172.16.0.1")
+    return lambda: sub.is_allowed(req)
+
+
+## Request parsing
+
+_HEADERS = {
+    "Host": "app.example.com",
+    "Accept": "application/json",
+    "User-Agent": "Mozilla/5.0 (benchmark)",
+    "x-forwarded-for": "203.0.113.7, 10.0.0.1",
+    "subscription": "Bearer bench-typical",
+    "Cookie": "theme=dark; subscription=bench-typical; team=team7; Authorization=abc.def.ghi",
+}
+
+@benchmark("request.header")
+def _request_header():
+    req = Request("GET", "app.example.com", "/api/v1/users", _HEADERS)
+    return lambda: req.header("subscription")
+
+@benchmark("request.query.parse")
+def _request_query():
+    return lambda: Request("GET", "app.example.com", "/api/v1/users?page=2&size=50&subscription=bench-typical&tenant=t1", _HEADERS).query_param("subscription")
+
+@benchmark("request.cookie.parse")
+def _request_cookie():
+    return lambda: Request("GET", "app.example.com", "/api/v1/users", _HEADERS).cookie("subscription")
+
+@benchmark("request.build")
+def _request_build():
+    from subauth import core
+    return lambda: core.build_request("GET", core.resolve_host(_HEADERS), "https://app.example.com/api/v1/users", _HEADERS)
+
+
+## Subscription lookup (against the in-process fake store)
+
+def _use_fake_store(count:int = 1000) -> list[dict]:
+    from subauth import sub_factory
+    from subauth.dataaccess.fake_cosmos import FakeContainerProxy, register_fake_container
+    docs = [ typical_subscription_doc(f"bench-{i}") for i in range(count) ]
+    register_fake_container("subscriptions", FakeContainerProxy(docs, seed=1))
+    sub_factory._COSMOS_DB_CONNECTION = None
+    sub_factory._SUBSCRIPTION_CACHE.clear()
+    return docs
+
+@benchmark("get_subscription.hit")
+def _get_subscription_hit():
+    from subauth import sub_factory
+    _use_fake_store()
+    sub_factory.get_subscription("bench-1", False)
+    return lambda: sub_factory.get_subscription("bench-1", False)
+
+@benchmark("get_subscription.miss")
+def _get_subscription_miss():
+    from subauth import sub_factory
+    _use_fake_store()
+    return lambda: sub_factory.get_subscription("bench-unknown", False)
+
+@benchmark("get_subscription.load")
+def _get_subscription_load():
+    from subauth import sub_factory
+    _use_fake_store()
+    def load():
+        sub_factory._SUBSCRIPTION_CACHE.pop("bench-2", None)
+        return sub_factory.get_subscription("bench-2", False)
+    return load
+
+
+## Token verification
+
+@benchmark("jwt.verify.cryptography")
+def _jwt_cryptography():
+    from jwt_verify import make_signing_key, make_token, AUDIENCE, ISSUER
+    from subauth.verifiers import CryptographyVerifier
+    private_pem, public_jwk = make_signing_key()
+    token, verifier = make_token(private_pem), CryptographyVerifier()
+    key = verifier.prepare_key(public_jwk)
+    return lambda: verifier.verify(token, lambda kid: key, AUDIENCE, ISSUER)
+
+@benchmark("jwt.verify.jose")
+def _jwt_jose():
+    from jwt_verify import make_signing_key, make_token, AUDIENCE, ISSUER
+    from subauth.verifiers import JoseVerifier
+    private_pem, public_jwk = make_signing_key()
+    token, verifier = make_token(private_pem), JoseVerifier()
+    key = verifier.prepare_key(public_jwk)
+    return lambda: verifier.verify(token, lambda kid: key, AUDIENCE, ISSUER)
+
+@benchmark("jwt.cached")
+def _jwt_cached():
+    from jwt_verify import make_signing_key, make_token, AUDIENCE, ISSUER
+    from subauth import tokens
+    from subauth.verifiers import CryptographyVerifier
+    private_pem, public_jwk = make_signing_key()
+    token, verifier = make_token(private_pem), CryptographyVerifier()
+    key = verifier.prepare_key(public_jwk)
+    tokens.clear_token_cache()
+    tokens.verify_and_cache(token, lambda t: verifier.verify(t, lambda kid: key, AUDIENCE, ISSUER))
+    return lambda: tokens.get_cached_claims(token)
+
+
+def _print_results(results:dict):
+    width = max([ len(name) for name in results["results"] ] + [ 10 ])
+    print(f"{'benchmark':<{width}}  {'median':>12}  {'peak bytes':>10}  {'retained/call':>13}")
+    for name, result in results["results"].items():
+        print(f"{name:<{width}}  {result['median_ns']:>10.0f}ns  {result.get('peak_bytes', 0):>10}  {result.get('retained_bytes_per_call', 0):>13}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--filter", default="*", help="Only run the benchmarks matching this glob pattern (eg. 'rules.*')")
+    parser.add_argument("--quick", action="store_true", help="Shorter runs (less accurate)")
+    parser.add_argument("--no-allocations", action="store_true", help="Skip the tracemalloc measurements")
+    parser.add_argument("--output", help="Write the results (JSON) to this file")
+    parser.add_argument("--compare", help="Compare the results with a previous run (JSON)")
+    parser.add_argument("--threshold", type=float, default=0.10, help="The slowdown (fraction) that counts as a regression when comparing")
+    parser.add_argument("--list", action="store_true", help="List the benchmarks")
+    args = parser.parse_args()
+
+    if args.list:
+        print("\n".join(name for name in _BENCHMARKS if fnmatch.fnmatch(name, args.filter)))
+        sys.exit(0)
+
+    results = run(args.filter, min_time=0.01 if args.quick else 0.05, repeats=3 if args.quick else 5, allocations=not args.no_allocations)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    _print_results(results)
+
+    if args.compare:
+        with open(args.compare) as f:
+            changes = compare(json.load(f), results, args.threshold)
+        print()
+        for change in changes:
+            flag = "  REGRESSED" if change["regressed"] else ""
+            print(f"{change['name']}: {change['baseline_ns']:.0f}ns -> {change['current_ns']:.0f}ns (x{change['ratio']}){flag}")
+        sys.exit(1 if any(change["regressed"] for change in changes) else 0)
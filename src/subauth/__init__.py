@@ -1,6 +1,37 @@
-
 from .data import Request, Subscription
 from .rules import *
+from .metrics import get_metrics, generate_openmetrics
+from .settings import Settings, get_settings, reload_settings
+
+## The adapters and the subscription store (and so the azure SDKs, FastAPI etc.) are only loaded when they are first used
+_LAZY_ATTRIBUTES = {
+    "function_utils": (".function_utils", None),
+    "fastapi_utils": (".fastapi_utils", None),
+    "core": (".core", None),
+    "authorize": (".core", "authorize"),
+    "sub_factory": (".sub_factory", None),
+    "get_subscription": (".sub_factory", "get_subscription"),
+    "get_subscriptions": (".sub_factory", "get_subscriptions"),
+    "preload_subscriptions": (".sub_factory", "preload_subscriptions"),
+    "save_subscription": (".sub_factory", "save_subscription"),
+    "delete_subscription": (".sub_factory", "delete_subscription"),
+    "rebuild_subscription_aliases": (".sub_factory", "rebuild_subscription_aliases"),
+    "invalidate_subscription": (".sub_factory", "invalidate_subscription"),
+    "build_access_index": (".sub_factory", "build_access_index"),
+    "find_subscriptions_with_access": (".sub_factory", "find_subscriptions_with_access"),
+}
+
+def __getattr__(name:str):
+    target = _LAZY_ATTRIBUTES.get(name, None)
+    if target is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    import importlib
+    module_name, attribute = target
+    value = importlib.import_module(module_name, __name__)
+    if attribute is not None:
+        value = getattr(value, attribute)
+    globals()[name] = value
+    return value
 
-from .sub_factory import get_subscription
-from . import function_utils, fastapi_utils
\ No newline at end of file
+def __dir__() -> list[str]:
+    return sorted(list(globals().keys()) + list(_LAZY_ATTRIBUTES.keys()))
@@ -0,0 +1,220 @@
+import threading
+from typing import Iterable
+
+from .data import Request, Subscription
+from .rules import Rule, HostCheck, PathCheck, MethodCheck
+
+
+class _PatternIndex:
+    """
+    An index of the subscriptions by the values they accept for one part of the request (eg. the host):
+    exact values, prefixes (eg. /api/*) and suffixes (eg. *.example.com). Subscriptions that accept values that can't be
+    indexed (eg. a regex, or no rule for this part of the request) are kept apart, and are always candidates.
+    """
+    def __init__(self):
+        self.exact:dict[str, set[str]] = {}
+        self.prefixes:dict[str, set[str]] = {}
+        self.suffixes:dict[str, set[str]] = {}
+        self.unconstrained:set[str] = set()
+        self._prefix_lengths:dict[int, int] = {}    ## length -> number of prefixes of that length
+        self._suffix_lengths:dict[int, int] = {}
+
+    def add(self, sub_id:str, entries:list[tuple[str, str]]|None):
+        """
+        Add the subscription under each of its (kind, value) entries, or as unconstrained if entries is None.
+        """
+        if entries is None:
+            self.unconstrained.add(sub_id)
+            return
+        for kind, value in entries:
+            if kind == "exact":
+                self.exact.setdefault(value, set()).add(sub_id)
+            elif kind == "prefix":
+                _add(self.prefixes, self._prefix_lengths, value, sub_id)
+            else:
+                _add(self.suffixes, self._suffix_lengths, value, sub_id)
+
+    def remove(self, sub_id:str, entries:list[tuple[str, str]]|None):
+        if entries is None:
+            self.unconstrained.discard(sub_id)
+            return
+        for kind, value in entries:
+            if kind == "exact":
+                _discard(self.exact, None, value, sub_id)
+            elif kind == "prefix":
+                _discard(self.prefixes, self._prefix_lengths, value, sub_id)
+            else:
+                _discard(self.suffixes, self._suffix_lengths, value, sub_id)
+
+    def matching(self, value:str) -> set[str]:
+        """
+        The subscriptions that are indexed under a pattern that matches the value (not including the unconstrained ones).
+        """
+        res = set()
+        subs = self.exact.get(value)
+        if subs:
+            res |= subs
+        ## Only the lengths that some prefix (or suffix) has are checked, rather than every prefix of the value
+        for length in self._prefix_lengths:
+            if length <= len(value):
+                subs = self.prefixes.get(value[:length])
+                if subs:
+                    res |= subs
+        for length in self._suffix_lengths:
+            if length <= len(value):
+                subs = self.suffixes.get(value[len(value) - length:])
+                if subs:
+                    res |= subs
+        return res
+
+def _add(index:dict[str, set[str]], lengths:dict[int, int], value:str, sub_id:str):
+    subs = index.get(value)
+    if subs is None:
+        subs = index[value] = set()
+        lengths[len(value)] = lengths.get(len(value), 0) + 1
+    subs.add(sub_id)
+
+def _discard(index:dict[str, set[str]], lengths:dict[int, int]|None, value:str, sub_id:str):
+    subs = index.get(value)
+    if subs is None:
+        return
+    subs.discard(sub_id)
+    if not subs:
+        del index[value]
+        if lengths is not None:
+            lengths[len(value)] -= 1
+            if lengths[len(value)] == 0:
+                del lengths[len(value)]
+
+
+def _wildcard_entries(patterns:list[str]) -> list[tuple[str, str]]|None:
+    """
+    The index entries for a list of host or path patterns, or None if any of them can't be indexed (so the subscription is unconstrained).
+    """
+    entries = []
+    for pattern in patterns:
+        pattern = pattern.lower()
+        if '*' not in pattern:
+            entries.append(("exact", pattern))
+        elif pattern.startswith('*') and '*' not in pattern[1:]:
+            entries.append(("suffix", pattern[1:]))
+        elif pattern.endswith('*') and '*' not in pattern[:-1]:
+            entries.append(("prefix", pattern[:-1]))
+        else:
+            return None     ## A wildcard in the middle
+    return entries
+
+def _host_entries(rule:HostCheck) -> list[tuple[str, str]]|None:
+    if rule.host_regexes:
+        return None
+    return _wildcard_entries(rule.hosts)
+
+def _path_entries(rule:PathCheck) -> list[tuple[str, str]]|None:
+    if rule.path_regexes:
+        return None
+    return _wildcard_entries(rule.paths)
+
+def _method_entries(rule:MethodCheck) -> list[tuple[str, str]]|None:
+    return [ ("exact", method) for method in rule.methods ]
+
+## The rules that are indexed, and how to get their entries
+_INDEXED_RULES = (
+    ( "host", HostCheck, _host_entries ),
+    ( "path", PathCheck, _path_entries ),
+    ( "method", MethodCheck, _method_entries ),
+)
+
+
+class AccessIndex:
+    """
+    A reverse index of the subscriptions by the hosts, paths and methods their rules allow, to answer
+    "which subscriptions can access this host/path" without evaluating every subscription.
+
+    Every ALLOW host, path and method rule of a subscription has to match for a request to be allowed, so each subscription
+    is indexed under the values of one of them (per part of the request). The index is conservative: subscriptions whose
+    rules can't be indexed (eg. regexes, wildcards in the middle, or no rule for that part of the request) are always candidates,
+    and DENY rules are ignored. The candidates are then evaluated in full to get the answer.
+    """
+    def __init__(self, subscriptions:Iterable[Subscription] = ()):
+        self._indexes = { part: _PatternIndex() for part, _, _ in _INDEXED_RULES }
+        self._entries:dict[str, dict[str, list[tuple[str, str]]|None]] = {}
+        self._subscriptions:dict[str, Subscription] = {}
+        self._lock = threading.RLock()
+        for sub in subscriptions:
+            self.add(sub)
+
+    def add(self, sub:Subscription):
+        """
+        Add (or replace) a subscription in the index.
+        """
+        sub_id = sub.id.lower()
+        entries = { part: _subscription_entries(sub.rules, rule_type, get_entries) for part, rule_type, get_entries in _INDEXED_RULES }
+        with self._lock:
+            self._remove(sub_id)
+            for part, part_entries in entries.items():
+                self._indexes[part].add(sub_id, part_entries)
+            self._entries[sub_id] = entries
+            self._subscriptions[sub_id] = sub
+
+    def remove(self, sub_id:str):
+        with self._lock:
+            self._remove(sub_id.lower())
+
+    def _remove(self, sub_id:str):
+        entries = self._entries.pop(sub_id, None)
+        if entries is None:
+            return
+        for part, part_entries in entries.items():
+            self._indexes[part].remove(sub_id, part_entries)
+        del self._subscriptions[sub_id]
+
+    def candidates(self, host:str, path:str, method:str = None) -> set[str]:
+        """
+        The ids of the subscriptions that might allow requests to the host and path (and method, if given).
+        """
+        values = { "host": host.lower(), "path": path.split("?")[0].lower() }
+        if method is not None:
+            values["method"] = method.upper()
+        with self._lock:
+            parts = [ (self._indexes[part], self._indexes[part].matching(value)) for part, value in values.items() ]
+            ## Start from the part with the fewest candidates, and filter those by the other parts (rather than building every part's candidates)
+            parts.sort(key=lambda part: len(part[1]) + len(part[0].unconstrained))
+            index, matching = parts[0]
+            res = matching | index.unconstrained
+            for index, matching in parts[1:]:
+                unconstrained = index.unconstrained
+                res = { sub_id for sub_id in res if sub_id in matching or sub_id in unconstrained }
+            return res
+
+    def find(self, host:str, path:str, method:str = "GET", caller:Request = None) -> list[Subscription]:
+        """
+        The subscriptions that allow a request to the host and path, with the method.
+
+        Only the rules about the resource (eg. host, path, method and date rules) are evaluated, the rules about the caller
+        (eg. headers, cookies or client IP) are assumed to match, unless a caller request is given to evaluate them against.
+        Rate rules are never evaluated (so the query does not use up the subscriptions' limits).
+        """
+        if caller is not None:
+            request = Request(method, host, path, caller.headers, caller.query_params, caller.cookies, caller.client_ip, caller.peer_ip)
+        else:
+            request = Request(method, host, path, {})
+        with self._lock:
+            subs = [ self._subscriptions[sub_id] for sub_id in self.candidates(host, path, method) ]
+        return sorted([ sub for sub in subs if sub.grants_access(request, caller is not None) ], key=lambda sub: sub.id)
+
+    def __len__(self) -> int:
+        return len(self._subscriptions)
+
+    def __contains__(self, sub_id:str) -> bool:
+        return sub_id.lower() in self._subscriptions
+
+def _subscription_entries(rules:list[Rule], rule_type:type, get_entries) -> list[tuple[str, str]]|None:
+    """
+    The index entries of the first indexable ALLOW rule of the type (or None if there are none).
+    """
+    for rule in rules:
+        if type(rule) is rule_type and rule.allow:
+            entries = get_entries(rule)
+            if entries is not None:
+                return entries
+    return None
@@ -0,0 +1,51 @@
+from cachetools import TTLCache, TLRUCache
+from . import metrics
+
+_MISSING = object()
+
+class _MeteredCache:
+    """
+    Records the hits, misses and evictions of a cachetools cache in the metrics registry (under the given cache name).
+    Hits and misses are counted by get(), which is what the library uses for its lookups.
+    """
+    cache_name:str
+
+    def get(self, key, default=None):
+        value = super().get(key, _MISSING)
+        if value is _MISSING:
+            if metrics.METRICS_ENABLED:
+                metrics.CACHE_MISSES.inc(self.cache_name)
+            return default
+        if metrics.METRICS_ENABLED:
+            metrics.CACHE_HITS.inc(self.cache_name)
+        return value
+
+    def popitem(self):
+        item = super().popitem()
+        if metrics.METRICS_ENABLED:
+            metrics.CACHE_EVICTIONS.inc(self.cache_name, "capacity")
+        return item
+
+    def expire(self, time=None):
+        expired = super().expire(time)
+        if expired and metrics.METRICS_ENABLED:
+            metrics.CACHE_EVICTIONS.inc(self.cache_name, "expired", amount=len(expired))
+        return expired
+
+
+class MeteredTTLCache(_MeteredCache, TTLCache):
+    """
+    A TTLCache (every entry has the same time to live) that records its hits, misses and evictions.
+    """
+    def __init__(self, cache_name:str, maxsize:int, ttl:float, **kwargs):
+        super().__init__(maxsize=maxsize, ttl=ttl, **kwargs)
+        self.cache_name = cache_name
+
+
+class MeteredTLRUCache(_MeteredCache, TLRUCache):
+    """
+    A TLRUCache (each entry has its own expiry, given by ttu(key, value, now)) that records its hits, misses and evictions.
+    """
+    def __init__(self, cache_name:str, maxsize:int, ttu, **kwargs):
+        super().__init__(maxsize=maxsize, ttu=ttu, **kwargs)
+        self.cache_name = cache_name
@@ -0,0 +1,542 @@
+import base64
+import logging
+import time
+from types import MappingProxyType
+from typing import Callable, Mapping
+from .data import Subscription, Request
+from .dataaccess import StoreUnavailableError
+from .sub_factory import get_subscription, lookup_subscription
+from . import metrics
+from . import decision_log
+from . import entra
+from . import jwks
+from . import session
+from . import shield
+from . import tokens
+from . import verifiers
+from . import timing
+from .settings import get_settings
+
+SUBSCRIPTION_CREDENTIALS = ( ("header", "subscription"), ("query", "subscription"), ("cookie", "subscription"), ("header", "x-subscription"), ("cookie", "x-subscription") )
+TOKEN_CREDENTIALS = ( ("cookie", "authorization"), ("header", "authorization"), ("query", "authorization"), ("header", "token"), ("cookie", "token"), ("query", "token") )
+STORE_UNAVAILABLE_REASON = "The subscription store is unavailable, try again later"
+
+class Decision:
+    """
+    The outcome of authorizing a request: whether it is allowed, the subscription (if one was found), the reason it was not allowed (if known),
+    and any headers to add to the response (eg. to set the session cookie), as a list of (name, value).
+    """
+    allowed:bool
+    subscription:Subscription|None
+    reason:str|None
+    headers:list[tuple[str, str]]|None
+    trace:timing.StageTrace|None = None     ## The stage timings (when the stage timers are enabled)
+
+    def __init__(self, allowed:bool, subscription:Subscription|None = None, reason:str|None = None, headers:list[tuple[str, str]]|None = None):
+        self.allowed = allowed
+        self.subscription = subscription
+        self.reason = reason
+        self.headers = headers
+
+
+EMPTY_HEADERS = MappingProxyType({})
+
+class ResponseTemplates:
+    """
+    Prebuilt, immutable headers and bodies for the common responses: the CORS preflight, the deny (and login redirect) responses, and the cookie set on the allow path.
+
+    The headers for each origin (of a preflight) and each deny reason are only built once (up to max_cached of each), so the common responses allocate almost nothing.
+    Create one to customise the responses for an app, and pass it to validate_function_request (or make it the default with set_response_templates).
+    """
+    allow_methods:str
+    allow_headers:str
+    allow_credentials:bool
+    max_age:int
+    preflight_body:str
+    not_allowed_body:str
+    redirect_body:str
+    subscription_cookie_attributes:str
+    max_cached:int
+    _cors_headers:dict[str, str]
+    _cors_by_origin:dict[str, Mapping[str, str]]
+    _denied_by_reason:dict[str, Mapping[str, str]]
+
+    def __init__(self,
+                 allow_methods:str = "GET, POST, PUT, DELETE, OPTIONS",
+                 allow_headers:str = "Content-Type, Accept, Authorization, Subscription, X-Subscription",
+                 allow_credentials:bool = True,
+                 max_age:int = 3600,
+                 preflight_body:str = "OK",
+                 not_allowed_body:str = "Not Allowed",
+                 redirect_body:str = "Redirecting...",
+                 subscription_cookie_attributes:str = "Path=/; HttpOnly; SameSite=None; Secure",
+                 max_cached:int = 256):
+        self.allow_methods = allow_methods
+        self.allow_headers = allow_headers
+        self.allow_credentials = allow_credentials
+        self.max_age = max_age
+        self.preflight_body = preflight_body
+        self.not_allowed_body = not_allowed_body
+        self.redirect_body = redirect_body
+        self.subscription_cookie_attributes = subscription_cookie_attributes
+        self.max_cached = max_cached
+
+        self._cors_headers = { "Access-Control-Allow-Methods": allow_methods, "Access-Control-Allow-Headers": allow_headers }
+        if allow_credentials:
+            self._cors_headers["Access-Control-Allow-Credentials"] = "true"
+        self._cors_headers["Access-Control-Max-Age"] = str(max_age)
+        self._cors_by_origin = {}
+        self._denied_by_reason = {}
+
+    def cors_preflight_headers(self, origin:str = None) -> Mapping[str, str]:
+        """
+        The (immutable) headers for the response to a CORS preflight (OPTIONS) request from the given origin.
+        """
+        origin = origin if origin else "*"
+        headers = self._cors_by_origin.get(origin, None)
+        if headers is None:
+            headers = { "Access-Control-Allow-Origin": origin }
+            headers.update(self._cors_headers)
+            headers = MappingProxyType(headers)
+            if len(self._cors_by_origin) < self.max_cached:
+                self._cors_by_origin[origin] = headers
+        return headers
+
+    def denied_headers(self, reason:str|None, include_reason:bool = True) -> Mapping[str, str]:
+        """
+        The (immutable) headers for the response to a request that was not allowed (the reason, if known and wanted).
+        """
+        if not include_reason or reason is None:
+            return EMPTY_HEADERS
+        headers = self._denied_by_reason.get(reason, None)
+        if headers is None:
+            headers = MappingProxyType({ "x-reason": reason })
+            if len(self._denied_by_reason) < self.max_cached:
+                self._denied_by_reason[reason] = headers
+        return headers
+
+    def subscription_cookie(self, sub_id:str) -> str:
+        """
+        The Set-Cookie value that stores the subscription id in the browser.
+        """
+        return "subscription=" + sub_id + "; " + self.subscription_cookie_attributes
+
+
+_RESPONSE_TEMPLATES = ResponseTemplates()
+
+def get_response_templates() -> ResponseTemplates:
+    return _RESPONSE_TEMPLATES
+
+def set_response_templates(templates:ResponseTemplates):
+    """
+    Set the default response templates (used when an adapter is not given its own).
+    """
+    global _RESPONSE_TEMPLATES
+    _RESPONSE_TEMPLATES = templates if templates is not None else ResponseTemplates()
+
+
+## Building the Request
+
+def resolve_host(headers:dict[str, str], disguised_hosts:bool = True) -> str|None:
+    """
+    Get the host the client asked for (the x-host or disguised-host header set by the proxy, if allowed, otherwise the Host header).
+    """
+    host = None
+    if disguised_hosts:
+        host = headers.get('x-host', None)
+        if not host:
+            host = headers.get('disguised-host', None)
+    if not host:
+        host = headers.get('Host', None)
+    return host
+
+def resolve_client_ip(headers:dict[str, str], peer_ip:str = None) -> str|None:
+    """
+    Get the client IP from the x-client-ip or (the first entry of the) x-forwarded-for header, falling back to the peer address (if the framework knows it).
+    """
+    client_ip = headers.get('x-client-ip', None)
+    if client_ip == "ignore":
+        client_ip = None
+    if client_ip is None:
+        forwarded_ips = headers.get('x-forwarded-for', None)
+        if forwarded_ips is not None and forwarded_ips != "ignore":
+            client_ip = forwarded_ips.split(",")[0].strip()
+    return client_ip if client_ip is not None else peer_ip
+
+def build_request(method:str, host:str, path:str, headers:dict[str, str], query:dict[str, str] = None, peer_ip:str = None) -> Request:
+    """
+    Build the (framework neutral) Request the pipeline works on, from the parts of a framework request.
+    """
+    if not host:
+        raise ValueError("Host header not found in request")
+    if not path:
+        raise ValueError("Path not found in request")
+    if path.startswith("http://") or path.startswith("https://"):
+        path = path[path.find("/", 8):]
+    headers = headers if headers else {}
+    return Request(method if method else "GET", host, path, headers, query, client_ip=resolve_client_ip(headers, peer_ip), peer_ip=peer_ip)
+
+
+## Identifying the caller
+
+def _credential(request:Request, sources:tuple[tuple[str, str], ...]) -> str|None:
+    for source, name in sources:
+        if source == "header":
+            value = request.header(name)
+        elif source == "query":
+            value = request.query_param(name)
+        else:
+            value = request.cookie(name)
+        if value:
+            if value.startswith("Bearer ") or value.startswith("BEARER "):
+                value = value[7:]
+            return value
+    return None
+
+def get_subscription_id(request:Request) -> str|None:
+    """
+    Get the subscription id from the request (from the subscription header, query parameter or cookie).
+    """
+    return _credential(request, SUBSCRIPTION_CREDENTIALS)
+
+def get_id_token(request:Request) -> str|None:
+    """
+    Get the Entra ID token from the request (from the authorization or token cookie, header or query parameter).
+    """
+    id_token = _credential(request, TOKEN_CREDENTIALS)
+    if id_token is None:
+        return None
+    ## Some clients send the rest of the cookie attributes along with the token
+    return id_token.split(';', 1)[0].strip()
+
+def get_entra_user(request:Request) -> tuple[dict[str, any]|None, str|None]:
+    """
+    Get the (verified) claims of the Entra ID token on the request, or None and the reason the token could not be used.
+    """
+    from jose import jwt
+
+    settings = get_settings()
+    if settings.entra_authority is None:
+        return None, "ENTRA_AUTHORITY is not set in the environment variables"
+    if settings.entra_client_id is None:
+        return None, "ENTRA_CLIENT_ID is not set in the environment variables"
+
+    id_token = get_id_token(request)
+    if not id_token:
+        return None, "No authorization token found in the request"
+
+    start = time.perf_counter()
+    ## The same token is sent with every request, so it is only verified once (until it expires)
+    payload = tokens.get_cached_claims(id_token)
+    if payload is not None:
+        metrics.record_jwt_verification("cached", start)
+        return payload, None
+
+    def verify(token:str) -> dict[str, any]|None:
+        key_manager = jwks.get_key_manager(settings.entra_authority)
+        verifier = verifiers.get_verifier()
+        return verifier.verify(
+            token,
+            lambda kid: key_manager.get_prepared_key(kid, verifier),
+            audience=settings.entra_client_id,
+            issuer=settings.entra_issuer
+        )
+
+    try:
+        payload = tokens.verify_and_cache(id_token, verify)
+    except jwt.ExpiredSignatureError:
+        metrics.record_jwt_verification("expired", start)
+        return None, "The authorization token has expired"
+    except jwt.JWTClaimsError:
+        metrics.record_jwt_verification("invalid_claims", start)
+        return None, "The authorization token has invalid claims"
+    except RuntimeError:
+        metrics.record_jwt_verification("error", start)
+        return None, "Unable to retrieve the Keys to validate the auth token"
+    except Exception as e:
+        metrics.record_jwt_verification("error", start)
+        ## Logged at debug only, as this can be a flood of bad tokens (the reason is in the decision log)
+        logging.debug("Error validating token: %s", str(e), exc_info=True)
+        return None, "Unable to validate the authorization token: " + str(e)
+
+    if payload is None:
+        metrics.record_jwt_verification("unknown_key", start)
+        return None, "Unable to find a matching key to validate the auth token"
+    metrics.record_jwt_verification("ok", start)
+    return payload, None
+
+def resolve_subscription(request:Request) -> tuple[Subscription|None, str|None]:
+    """
+    Get the subscription for the request: from the subscription id on the request, then the session cookie, then the Entra ID token.
+    Returns None and the reason (if known) when there is no subscription, including when the store is unavailable (the circuit breaker is open)
+    and the subscription is not cached.
+    """
+    subscription, reason, _ = resolve_caller(request)
+    return subscription, reason
+
+def resolve_caller(request:Request) -> tuple[Subscription|None, str|None, dict[str, any]|None]:
+    """
+    Get the subscription for the request (see resolve_subscription), the reason if there is none, and the Entra claims of the caller
+    (from their ID token or session cookie) if they are an Entra user. The claims are per request, so they are not read from the (shared) subscription.
+    """
+    try:
+        return _resolve_caller(request)
+    except StoreUnavailableError:
+        return None, STORE_UNAVAILABLE_REASON, None
+
+def _resolve_caller(request:Request) -> tuple[Subscription|None, str|None, dict[str, any]|None]:
+    subscription = None
+    sub_id = get_subscription_id(request)
+    if sub_id:
+        ## Deny clients that keep sending unknown subscription ids, and skip the lookup of ids that cannot be valid
+        client_key = shield.client_key(request)
+        if shield.is_throttled(client_key):
+            return None, shield.THROTTLED_REASON, None
+        if shield.precheck_subscription_id(sub_id, client_key):
+            subscription, found = lookup_subscription(sub_id)
+            if not found:
+                ## Only unknown ids count against the client (not subscriptions that have expired)
+                shield.record_lookup_failure(client_key)
+    if subscription:
+        return subscription, None, None
+
+    ## A valid session cookie goes straight to the (cached) subscription, without verifying the ID token again
+    subscription, user_session = session.get_session_subscription(request)
+    if subscription:
+        return subscription, None, user_session.entra_claims()
+
+    if timing.TIMING_ENABLED:
+        start = time.monotonic_ns()
+    user, reason = get_entra_user(request)
+    if timing.TIMING_ENABLED:
+        timing.record(timing.JWT, start)
+    if user is None:
+        return None, reason, None
+    username = user.get("preferred_username", user.get("upn", None))
+    if username is None:
+        return None, None, None
+    subscription = get_subscription(username.strip(), True)
+    if subscription is not None:
+        subscription.is_entra_user = True
+        subscription.entra_user_claims = user
+    return subscription, None, user
+
+
+## Authorizing the request
+
+def _allowed_headers(request:Request, sub:Subscription, templates:ResponseTemplates, entra_claims:dict[str, any] = None) -> list[tuple[str, str]]|None:
+    if session.sessions_enabled():
+        # Set (or renew) the session cookie
+        set_cookie = session.session_cookie_for(request, sub, entra_claims)
+        return [ ("Set-Cookie", set_cookie) ] if set_cookie is not None else None
+
+    # Set the subscription in the cookie (if it is not there already)
+    if request.cookie("subscription") is None and sub.store_sub_in_browser():
+        return [ ("Set-Cookie", templates.subscription_cookie(sub.id)) ]
+    return None
+
+def authorize(request:Request, rules_request:Request = None, templates:ResponseTemplates = None) -> Decision:
+    """
+    Decide whether the request is allowed: find its subscription and evaluate the subscription's rules.
+    The rules are evaluated against the rules_request if given (eg. a Request with the path overridden), otherwise the request.
+    """
+    if timing.TIMING_ENABLED:
+        start = time.monotonic_ns()
+    sub, reason, entra_claims = resolve_caller(request)
+    if timing.TIMING_ENABLED:
+        timing.record(timing.LOOKUP, start)
+    if sub is None:
+        return Decision(False, None, reason)
+
+    rules_request = rules_request if rules_request is not None else request
+    if timing.TIMING_ENABLED:
+        start = time.monotonic_ns()
+    allowed, reason = sub.is_allowed(rules_request)
+    if timing.TIMING_ENABLED:
+        timing.record(timing.RULES, start)
+    if not allowed:
+        return Decision(False, sub, reason)
+    return Decision(True, sub, None, _allowed_headers(rules_request, sub, templates if templates is not None else _RESPONSE_TEMPLATES, entra_claims))
+
+def finish_timing(trace:timing.StageTrace, decision:Decision) -> Decision:
+    """
+    Finish the stage timings of the auth check, and (when SERVER_TIMING_ENABLED) add them to the decision's headers as a Server-Timing header.
+    """
+    timing.finish_trace(trace)
+    decision.trace = trace
+    if timing.SERVER_TIMING_ENABLED:
+        decision.headers = (decision.headers or []) + [ ("Server-Timing", trace.server_timing()) ]
+    return decision
+
+def validate_request(req:any, to_request:Callable[..., Request], auth_url:Callable[[str|None], str], override_path:str = None, redirect_on_fail:bool = False, default_fail_status:int = 401, redirect_url:str = None, allow_cors:bool = True, include_reason:bool = True, allow_disguised_host:bool = True, return_headers:bool = False, templates:ResponseTemplates = None) -> tuple[bool, Subscription|None, tuple[int, str, Mapping[str, str]]|None, list[tuple[str, str]]|None]:
+    """
+    Validate a framework request (the validate_function_request of the adapters), which only convert the request and the response.
+
+    to_request(override_path, disguised_hosts) converts the framework request to a Request, and auth_url(redirect_url) gives the Entra login URL to redirect to.
+    Returns whether the request is allowed, its subscription, and the (status, body, headers) of the response - or None if the request is allowed,
+    and the headers to add to the response (eg. Set-Cookie) are returned instead (as a list of (name, value), or None).
+    """
+    templates = templates if templates is not None else _RESPONSE_TEMPLATES
+    if req is None:
+        return False, None, (400, "Invalid Request", None), None
+
+    ## Accept CORS preflight requests
+    if allow_cors and req.method == "OPTIONS":
+        return True, None, (200, templates.preflight_body, templates.cors_preflight_headers(req.headers.get("Origin", None))), None
+
+    # Check for the subscription, and if it is allowed to access the resource
+    if timing.TIMING_ENABLED:
+        trace = timing.start_trace()
+    request = to_request()
+    rules_request = request if not override_path and allow_disguised_host else to_request(override_path, allow_disguised_host)
+    if timing.TIMING_ENABLED:
+        timing.record(timing.CONVERT, trace.started_ns)
+    decision = authorize(request, rules_request, templates)
+    if timing.TIMING_ENABLED:
+        finish_timing(trace, decision)
+    if decision_log.DECISION_LOG_ENABLED:
+        decision_log.log_decision(rules_request, decision)
+    if decision.allowed:
+        if return_headers or not decision.headers:
+            return True, decision.subscription, None, decision.headers
+        return True, decision.subscription, (0, "ADD_THESE_HEADERS_TO_RESPONSE", dict(decision.headers)), None
+
+    ## Subscription is not allowed to access the resource
+    headers = templates.denied_headers(decision.reason, include_reason)
+    if decision.headers:
+        headers = { **headers, **dict(decision.headers) }
+    if redirect_on_fail and get_settings().entra_authority is not None:
+        # Redirect to the auth URL
+        headers = dict(headers)
+        headers["Location"] = auth_url(redirect_url)
+        return False, decision.subscription, (302, templates.redirect_body, headers), None
+    return False, decision.subscription, (default_fail_status, templates.not_allowed_body, headers), None
+
+
+## Entra login
+
+def _forwarded_host(headers:dict[str, str]) -> str:
+    return headers.get("x-host", headers.get('disguised-host', headers.get('Host', "not-set")))
+
+def auth_state(url:str, headers:dict[str, str]) -> str:
+    """
+    Encode the URL to send the user back to after they login (the state of the auth request).
+    """
+    settings = get_settings()
+    if '$host' in url:
+        url = url.replace("$host", _forwarded_host(headers))
+
+    # Use the original path if it's set
+    if headers.get("x-original-path", None) is not None:
+        url = headers.get("x-original-path", None)
+    elif settings.entra_state_strip_api_app_path:
+        ## Strip the /api/app/ path from the URL (this is to handle the internal mapping happing on the edge proxy)
+        if url.startswith("/api/app/"): url = url[8:]
+
+    if settings.entra_state_strip_api_serve_path:
+        if url.startswith("/api/serve/"): url = url[10:]
+
+    path_prefix = settings.entra_state_redirect_path_prefix
+    if path_prefix is not None:
+        if not path_prefix.endswith("/"): path_prefix += "/"
+        if url.startswith("/"): url = url[1:]
+        if url.startswith("api/"): url = url[4:] ## Remove the api/ prefix if it's there
+        url = path_prefix + url
+
+    return base64.urlsafe_b64encode(url.encode()).decode()
+
+def auth_callback_url(origin:str, headers:dict[str, str]) -> str:
+    """
+    Get the auth callback (redirect) URL: ENTRA_REDIRECT_URI, or /api/auth-callback on the given origin (scheme://host[:port]).
+    """
+    redirect_url = get_settings().entra_redirect_uri
+    if redirect_url is None:
+        redirect_url = origin + "/api/auth-callback"
+    if '$host' in redirect_url:
+        redirect_url = redirect_url.replace("$host", _forwarded_host(headers))
+    return redirect_url
+
+def entra_auth_url(url:str, headers:dict[str, str], callback_url:str) -> str:
+    """
+    Generate the Entra login URL, which sends the user back to the given URL once they have logged in.
+    """
+    settings = get_settings()
+    settings.require_entra("ENTRA_AUTHORITY", "ENTRA_CLIENT_ID", "ENTRA_CLIENT_SECRET", "ENTRA_APP_NAME")
+    if not settings.entra_scopes_configured:
+        raise RuntimeError("ENTRA_SCOPES is not set in the environment variables")
+
+    app = entra.get_msal_app()
+    return app.get_authorization_request_url(
+        scopes=settings.entra_scopes,
+        redirect_uri=callback_url,
+        state=auth_state(url, headers)
+        )
+
+def check_auth_callback_config():
+    get_settings().require_entra("ENTRA_AUTHORITY", "ENTRA_CLIENT_ID", "ENTRA_CLIENT_SECRET", "ENTRA_APP_NAME")
+
+def get_auth_code(request:Request) -> str|None:
+    code = request.query_param("code")
+    if code is None or len(code) == 0:
+        code  = request.header("code")
+    return code if code else None
+
+def redeem_auth_code(code:str, callback_url:str) -> dict[str, any]:
+    """
+    Redeem the authorization code with Entra (blocking).
+    """
+    return entra.get_msal_app().acquire_token_by_authorization_code(
+        code=code,
+        scopes=get_settings().entra_scopes,
+        redirect_uri=callback_url,
+    )
+
+async def redeem_auth_code_async(code:str, callback_url:str, timeout:float = None) -> tuple[int, str, dict[str, str]|None]|dict[str, any]:
+    """
+    Redeem the authorization code with Entra, without blocking the event loop.
+    Returns the result of the redemption, or the (status, body, headers) to respond with if there are too many logins in progress (503) or it timed out (504).
+    """
+    import asyncio
+    try:
+        return await entra.redeem_auth_code_async(code, get_settings().entra_scopes, callback_url, timeout)
+    except entra.RedemptionOverloadedError:
+        return 503, "Service Unavailable", { "Retry-After": "1" }
+    except asyncio.TimeoutError:
+        return 504, "Gateway Timeout", None
+
+def auth_callback_response(request:Request, result:dict[str, any], is_https:bool, default_redirect_url:str = None) -> tuple[int, str|None, dict[str, str]|None]:
+    """
+    The (status, body, headers) of the response to the auth callback, from the result of redeeming the auth code:
+    a redirect (back to the URL in the state) that sets the ID token cookie, or a 401 if the code could not be redeemed.
+    """
+    settings = get_settings()
+    if "error" in result:
+        logging.warning("Unable to redeem the auth code: %s", result.get("error"))
+        return 401, "Not Allowed", None
+
+    id_token = result.get("id_token", None)
+    if id_token is None:
+        return 401, "Not Allowed", None
+
+    send_to_url = request.query_param("state")
+    if send_to_url is None or len(send_to_url) == 0:
+        send_to_url = request.header("state")
+    if send_to_url is None or len(send_to_url) == 0:
+        send_to_url = request.query_param("session_state")
+    if send_to_url is None or len(send_to_url) == 0:
+        send_to_url = request.header("session_state")
+
+    if send_to_url is not None:
+        send_to_url = base64.urlsafe_b64decode((send_to_url+"==").encode("utf-8")).decode("utf-8")
+
+    if send_to_url is None or send_to_url == '/' or len(send_to_url) == 0:
+        send_to_url = default_redirect_url if default_redirect_url is not None else settings.default_redirect_url
+
+    ## The cookie is only sent without the Secure attribute over http if that is explicitly allowed (eg. for local development)
+    as_secure = is_https or not settings.id_token_allow_insecure
+    is_secure = settings.id_token_cookie_secure_attributes if as_secure else ''
+    headers = {
+        "Set-Cookie": "Authorization=" + id_token + "; " + is_secure + settings.id_token_cookie_suffix, # HttpOnly;
+        "Location": send_to_url
+    }
+    return 302, None, headers
@@ -1,3 +1,3 @@
 
-from .subscription import Subscription
+from .subscription import Subscription, SUBSCRIPTION_FIELDS
 from .request import Request
\ No newline at end of file
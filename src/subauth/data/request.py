@@ -8,8 +8,9 @@ class Request:
     query_params:dict[str,str]
     cookies:dict[str,str]
     client_ip:str
+    peer_ip:str
 
-    def __init__(self, method:str, host:str, path:str, headers:dict[str,str] = {}, query_params:dict[str,str] = None, cookies:dict[str,str] = None, client_ip:str = None):
+    def __init__(self, method:str, host:str, path:str, headers:dict[str,str] = {}, query_params:dict[str,str] = None, cookies:dict[str,str] = None, client_ip:str = None, peer_ip:str = None):
         self.method = method
         self.host = host
         self.urlpath = path
@@ -17,6 +18,7 @@ class Request:
         self.query_params = query_params
         self.cookies = cookies
         self.client_ip = client_ip
+        self.peer_ip = peer_ip          ## The address of the connection (if the framework knows it), which unlike client_ip is not set by the caller
 
     def header(self, key:str) -> str:
         """
@@ -1,7 +1,13 @@
+import time
 from datetime import datetime
 
 from .request import Request
 from ..rules import Rule, create_rule
+from .. import metrics
+from .. import explain
+
+## The document fields that are used to build (and evaluate) a Subscription
+SUBSCRIPTION_FIELDS = ( "id", "name", "description", "expiry", "rules", "browserstore", "is_entra_user", "entra_username" )
 
 
 class Subscription:
@@ -14,6 +20,7 @@ class Subscription:
     entra_username:str = None
     entra_user_claims:dict = None
     browser_store:bool = True
+    properties:dict[str, any]
 
     def __init__(self, data:dict):
         self.id = data.get("id", None)
@@ -38,6 +45,8 @@ class Subscription:
         self.is_entra_user = data.get("is_entra_user", False)
         self.entra_username = data.get("entra_username", None)
         self.browser_store = data.get("browserstore", True)
+        ## Keep any custom fields (eg. the SUBSCRIPTION_EXTRA_FIELDS) so apps can use them
+        self.properties = { key: value for key, value in data.items() if key not in SUBSCRIPTION_FIELDS and not key.startswith("_") }
         self.rules = []
         for rule_def in data.get("rules", []):
             rule_name = rule_def.get("name", None)
@@ -50,6 +59,7 @@ class Subscription:
             rule = create_rule(rule_type, rule_name, rule_allow, rule_def)
             if not rule:
                 raise ValueError(f"Invalid rule definition: {rule_def}")
+            rule.bind_subscription(self.id)
             self.rules.append(rule)
         if not self.rules:
             raise ValueError("At least one rule is required")
@@ -80,6 +90,12 @@ class Subscription:
         if self.rules is None or len(self.rules) == 0:
             return False, "Subscription has no rules"    ## Not allowed to have a sub with no rules defined
         
+        if explain.EXPLAIN_SAMPLE_RATE > 0 and explain.should_sample():
+            return self._is_allowed_sampled(req)
+
+        if metrics.METRICS_ENABLED:
+            return self._is_allowed_metered(req)
+
         for rule in self.rules:
             matches = rule.matches(req)
             if rule.allow and not matches:
@@ -89,7 +105,88 @@ class Subscription:
             
         # If all allowed rules are matched, and no denied rules are matched, return True
         return True, "OK"
+
+    def _is_allowed_metered(self, req:Request) -> tuple[bool, str]:
+        """
+        Same as is_allowed, but records the decision of each rule (and the overall evaluation time) in the metrics.
+        """
+        start = time.perf_counter()
+        try:
+            for rule in self.rules:
+                matches = rule.matches(req)
+                if rule.allow and not matches:
+                    metrics.RULE_DECISIONS.inc(type(rule).__name__, "deny")
+                    return False, f"Request does not match ALLOW rule {rule.name}"
+                elif not rule.allow and matches:
+                    metrics.RULE_DECISIONS.inc(type(rule).__name__, "deny")
+                    return False, f"Request matches DENY rule {rule.name}"
+                metrics.RULE_DECISIONS.inc(type(rule).__name__, "allow")
+            return True, "OK"
+        finally:
+            metrics.SUBSCRIPTION_EVALUATION_DURATION.observe(time.perf_counter() - start)
     
+    def grants_access(self, req:Request, caller_rules:bool = True) -> bool:
+        """
+        Check if the subscription allows the request, without changing any state (eg. stateful rules, like rate limits, are not evaluated).
+        If caller_rules is False, the rules about the caller (eg. its headers or IP address) are not evaluated either, so this
+        answers whether the subscription can access the resource at all.
+        """
+        if self.is_expired() or not self.rules:
+            return False
+        for rule in self.rules:
+            if rule.stateful or (rule.caller_rule and not caller_rules):
+                continue
+            if rule.matches(req) != rule.allow:
+                return False
+        return True
+
+    def explain(self, req:Request, evaluate_all:bool = False) -> explain.Explanation:
+        """
+        Explain the is_allowed decision for the request: for each rule, the pattern that matched (if any), the outcome and how long it took.
+
+        Like is_allowed, the rules after the first one that denies the request are not evaluated, unless evaluate_all is True
+        (eg. to find the slow rules of a subscription, whatever the request). Stateful rules (eg. rate limits) are reported as
+        "skipped" rather than evaluated, so explaining a request does not use up the subscription's limits.
+        """
+        return self._explain(req, evaluate_all, False)
+
+    def _explain(self, req:Request, evaluate_all:bool, evaluate_stateful:bool) -> "explain.Explanation":
+        if self.is_expired():
+            return explain.Explanation(self.id, False, "Subscription has expired", [], 0)
+        if self.rules is None or len(self.rules) == 0:
+            return explain.Explanation(self.id, False, "Subscription has no rules", [], 0)
+
+        traces = []
+        allowed, reason = True, "OK"
+        start = time.perf_counter_ns()
+        for index, rule in enumerate(self.rules):
+            if rule.stateful and not evaluate_stateful:
+                traces.append(explain.RuleTrace(index, rule.name, type(rule).__name__, rule.allow, None, 0, evaluated=False))
+                continue
+            rule_start = time.perf_counter_ns()
+            pattern = rule.matched_pattern(req)
+            trace = explain.RuleTrace(index, rule.name, type(rule).__name__, rule.allow, pattern, time.perf_counter_ns() - rule_start)
+            traces.append(trace)
+            if trace.outcome == "deny" and allowed:
+                allowed = False
+                reason = f"Request does not match ALLOW rule {rule.name}" if rule.allow else f"Request matches DENY rule {rule.name}"
+                if not evaluate_all:
+                    break
+        return explain.Explanation(self.id, allowed, reason, traces, time.perf_counter_ns() - start)
+
+    def _is_allowed_sampled(self, req:Request) -> tuple[bool, str]:
+        """
+        Same as is_allowed, but the decision is explained and added to the subscription's aggregate (see explain.get_explain_stats).
+        This is the real decision, so the stateful rules are evaluated (and take their tokens).
+        """
+        explanation = self._explain(req, False, True)
+        explain.record(explanation)
+        if metrics.METRICS_ENABLED:
+            for trace in explanation.rules:
+                metrics.RULE_DECISIONS.inc(trace.type, trace.outcome)
+            metrics.SUBSCRIPTION_EVALUATION_DURATION.observe(explanation.duration_ns / 1e9)
+        return explanation.allowed, explanation.reason
+
     def store_sub_in_browser(self) -> bool:
         """
         Check if the subscription should be stored in the browser (using a cookie).
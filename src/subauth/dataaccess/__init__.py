@@ -1,2 +1,22 @@
+from .alias_index import AliasIndex, ENTRA_ALIAS, alias_doc_id, is_alias_doc
+from .projection import select_clause
+from .resilience import StoreUnavailableError
 
-from .cosmosdb import CosmosDBConnection
\ No newline at end of file
+## The CosmosDB connection (and so the azure.cosmos SDK) is only loaded when it is first used
+_LAZY_ATTRIBUTES = {
+    "CosmosDBConnection": ".cosmosdb",
+    "FakeContainerProxy": ".fake_cosmos",
+    "register_fake_container": ".fake_cosmos",
+}
+
+def __getattr__(name:str):
+    module_name = _LAZY_ATTRIBUTES.get(name, None)
+    if module_name is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    import importlib
+    value = getattr(importlib.import_module(module_name, __name__), name)
+    globals()[name] = value
+    return value
+
+def __dir__() -> list[str]:
+    return sorted(list(globals().keys()) + list(_LAZY_ATTRIBUTES.keys()))
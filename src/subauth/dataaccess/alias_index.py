@@ -0,0 +1,125 @@
+from typing import TYPE_CHECKING
+from urllib.parse import quote
+
+from .projection import select_clause
+
+if TYPE_CHECKING:
+    from .cosmosdb import CosmosDBConnection
+
+ALIAS_ID_PREFIX = "alias:"
+ENTRA_ALIAS = "entra"
+
+def alias_doc_id(alias_type:str, alias:str) -> str:
+    """
+    Get the id of the document that stores the given alias.
+    The characters that Cosmos does not allow in an id (/ \\ ? #) are percent-encoded.
+    """
+    return ALIAS_ID_PREFIX + alias_type + ":" + quote(alias.strip().lower(), safe="@.-_+:!$&'()*,;=~ ")
+
+def is_alias_doc(data:dict) -> bool:
+    """
+    Check if the given document is an alias document (rather than a subscription).
+    """
+    return data is not None and "alias_for" in data
+
+
+class AliasIndex:
+    """
+    A maintained mapping of alias -> subscription id (eg. Entra username -> subscription id).
+
+    Each alias is stored as a small document in the subscription container, with an id derived from the alias,
+    which turns an alias lookup into a point read rather than a cross-partition query.
+    """
+    _connection: "CosmosDBConnection"
+
+    def __init__(self, connection: "CosmosDBConnection"):
+        self._connection = connection
+
+    def resolve(self, alias_type:str, alias:str) -> str|None:
+        """
+        Get the subscription id for the given alias (or None if the alias is not known).
+        """
+        doc = self._connection.get_item(alias_doc_id(alias_type, alias))
+        if not is_alias_doc(doc):
+            return None
+        return doc["alias_for"]
+
+    def put(self, alias_type:str, alias:str, sub_id:str):
+        """
+        Point the given alias at the given subscription id.
+        """
+        self._connection.upsert_item({
+            "id": alias_doc_id(alias_type, alias),
+            "alias_for": sub_id,
+            "alias_type": alias_type,
+        })
+
+    def remove(self, alias_type:str, alias:str):
+        """
+        Remove the given alias (if it exists).
+        """
+        from azure.cosmos.exceptions import CosmosResourceNotFoundError
+        try:
+            self._connection.delete_item(alias_doc_id(alias_type, alias))
+        except CosmosResourceNotFoundError:
+            pass
+
+    def find_entra_subscription(self, username:str, fields:list[str] = None) -> dict|None:
+        """
+        Find the subscription for an Entra user using a (parameterised) query, reading only the given fields (or all fields if None).
+        This is the slow path, used when an alias document does not exist yet.
+        """
+        res = self._connection.get_items_by_query(
+            select_clause(fields) + " WHERE c.entra_username = @username AND c.is_entra_user = true",
+            parameters=[ { "name":"@username", "value": username.strip().lower() } ]
+        )
+        if not res:
+            return None
+        return res[0]
+
+    def sync_subscription(self, data:dict, previous:dict = None):
+        """
+        Update the aliases for a subscription document that has been created or changed.
+        If the previous version of the document is provided, any aliases it no longer has are removed.
+        """
+        new_username = entra_alias_for(data)
+        old_username = entra_alias_for(previous) if previous else None
+        if old_username and old_username != new_username:
+            self.remove(ENTRA_ALIAS, old_username)
+        if new_username:
+            self.put(ENTRA_ALIAS, new_username, data["id"])
+
+    def remove_subscription(self, data:dict):
+        """
+        Remove all the aliases for a subscription document that is being deleted.
+        """
+        username = entra_alias_for(data)
+        if username:
+            self.remove(ENTRA_ALIAS, username)
+
+    def rebuild(self) -> int:
+        """
+        (Re)create the alias documents for all the Entra user subscriptions in the container.
+        Returns the number of aliases written.
+        """
+        count = 0
+        for data in self._connection.iter_items_by_query(select_clause([ "id", "is_entra_user", "entra_username", "alias_for" ]) + " WHERE c.is_entra_user = true"):
+            if is_alias_doc(data):
+                continue
+            username = entra_alias_for(data)
+            if username:
+                self.put(ENTRA_ALIAS, username, data["id"])
+                count += 1
+        return count
+
+
+def entra_alias_for(data:dict) -> str|None:
+    """
+    Get the (normalised) Entra username alias for a subscription document, or None if it doesn't have one.
+    """
+    if not data or not data.get("is_entra_user", False):
+        return None
+    username = data.get("entra_username", None)
+    if not username:
+        return None
+    return username.strip().lower()
@@ -1,22 +1,134 @@
+import logging
 import os
+import time
+from typing import Callable, Iterator
 from azure.cosmos import CosmosClient, ContainerProxy, CosmosDict
-from azure.cosmos.errors import CosmosResourceNotFoundError
-from azure.identity import DefaultAzureCredential
+from azure.cosmos.errors import CosmosResourceNotFoundError, CosmosHttpResponseError
+from azure.cosmos.exceptions import CosmosClientTimeoutError
 from azure.core.exceptions import ResourceExistsError
 from azure.core.exceptions import ResourceNotFoundError
 from azure.core.exceptions import HttpResponseError
 from azure.core.exceptions import ClientAuthenticationError
 from azure.core.exceptions import ServiceRequestError
+from azure.core.exceptions import ServiceResponseError
+
+from .. import metrics
+from .. import timing
+from .resilience import CircuitBreaker, RetryBudget, StoreUnavailableError
+from .projection import select_clause
+from .fake_cosmos import get_fake_container
 
 CONTAINER_CONNECTIONS = {}
 CACHE_CONTAINER_CONNECTIONS = os.environ.get('CACHE_COSMOS_CONTAINER_CONNECTIONS', "true").lower() == "true"
 
 CHECK_COSMOS_DB_CONNECTION_ON_STARTUP = os.environ.get('CHECK_SUBSCRIPTION_COSMOS_DB_ON_STARTUP', "false").lower() == "true"
 
+QUERY_PAGE_SIZE = int(os.environ.get('COSMOS_QUERY_PAGE_SIZE', "100"))
+BATCH_READ_CHUNK_SIZE = int(os.environ.get('COSMOS_BATCH_READ_CHUNK_SIZE', "1000"))
+BATCH_READ_MAX_PARALLELISM = int(os.environ.get('COSMOS_BATCH_READ_MAX_PARALLELISM', "4"))
+
+## Latency bounds for the (inline) auth check
+REQUEST_TIMEOUT_MS = int(os.environ.get('COSMOS_REQUEST_TIMEOUT_MS', "2000"))                   # Deadline for each read (or query page), including retries, 0 = no deadline
+CONNECTION_TIMEOUT_SECONDS = float(os.environ.get('COSMOS_CONNECTION_TIMEOUT_SECONDS', "2"))
+MAX_RETRIES = int(os.environ.get('COSMOS_MAX_RETRIES', "2"))
+RETRY_BUDGET_RATIO = float(os.environ.get('COSMOS_RETRY_BUDGET_RATIO', "0.2"))
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get('COSMOS_CIRCUIT_FAILURE_THRESHOLD', "5"))
+CIRCUIT_RESET_SECONDS = float(os.environ.get('COSMOS_CIRCUIT_RESET_SECONDS', "30"))
+PREFERRED_REGIONS = [ region.strip() for region in os.environ.get('COSMOS_PREFERRED_REGIONS', "").split(",") if region.strip() ]
+POOL_CONNECTIONS = int(os.environ.get('COSMOS_POOL_CONNECTIONS', "10"))
+POOL_MAXSIZE = int(os.environ.get('COSMOS_POOL_MAXSIZE', "20"))
+
+COSMOS_CLIENTS = {}
+
+def _retry_after_seconds(e:Exception, attempt:int) -> float|None:
+    """
+    Get how long to wait before retrying after the given error, or None if the call should not be retried.
+    """
+    if isinstance(e, CosmosHttpResponseError):
+        if e.status_code == 429:
+            retry_after_ms = e.headers.get("x-ms-retry-after-ms", None) if e.headers else None
+            return float(retry_after_ms) / 1000.0 if retry_after_ms else 0.1
+        if e.status_code in (408, 449, 503):
+            return 0.05 * (attempt + 1)
+        return None
+    if isinstance(e, CosmosClientTimeoutError):
+        return None     ## The deadline has passed
+    if isinstance(e, (ServiceRequestError, ServiceResponseError)):
+        return 0.05 * (attempt + 1)
+    return None
+
+def _is_store_failure(e:Exception) -> bool:
+    """
+    Check if the given error means the store is unhealthy (as opposed to eg. the item not existing).
+    """
+    if isinstance(e, CosmosHttpResponseError):
+        return e.status_code in (408, 429, 449) or (e.status_code is not None and e.status_code >= 500)
+    return isinstance(e, (CosmosClientTimeoutError, ServiceRequestError, ServiceResponseError))
+
+def _client_options() -> dict[str, any]:
+    """
+    Get the options for creating a CosmosClient tuned for an inline auth check:
+    short connection timeouts, SDK level retries disabled (we retry within our own deadline + budget),
+    preferred regions, and a keep-alive connection pool.
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+    from azure.core.pipeline.transport import RequestsTransport
+    from azure.cosmos.documents import ConnectionPolicy
+    from azure.cosmos._retry_options import RetryOptions
+
+    policy = ConnectionPolicy()
+    policy.RequestTimeout = CONNECTION_TIMEOUT_SECONDS
+    policy.RetryOptions = RetryOptions(max_retry_attempt_count=0, max_wait_time_in_seconds=max(1, REQUEST_TIMEOUT_MS // 1000))
+    if PREFERRED_REGIONS:
+        policy.PreferredLocations = PREFERRED_REGIONS
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE, max_retries=0)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    return {
+        "connection_policy": policy,
+        "retry_total": 0,
+        "transport": RequestsTransport(session=session, session_owner=False),
+    }
+
+def _get_cosmos_client(endpoint:str) -> CosmosClient:
+    """
+    Get the (shared) CosmosClient for the given endpoint, so all containers share one connection pool.
+    """
+    global COSMOS_CLIENTS
+    if endpoint in COSMOS_CLIENTS:
+        return COSMOS_CLIENTS[endpoint]
+
+    ## Determine if we are using a connection string, key or Managed Identity
+    connection_string = os.environ.get('COSMOS_CONNECTION_STRING', None)
+    key = os.environ.get('COSMOS_KEY', None)
+
+    ## Load the Client
+    client = None
+    if connection_string is not None:
+        client = CosmosClient.from_connection_string(connection_string, **_client_options())
+    elif key is not None:
+        client = CosmosClient(endpoint, {'masterKey': key}, **_client_options())
+    else:
+        from azure.identity import DefaultAzureCredential
+        client = CosmosClient(endpoint, DefaultAzureCredential(), **_client_options())
+
+    if CACHE_CONTAINER_CONNECTIONS:
+        COSMOS_CLIENTS[endpoint] = client
+    return client
+
 def _connect_to_cosmos_container(container:str, db:str = None, endpoint:str = None, create_if_not_exists:bool = True, partition_key:str = "/id") -> ContainerProxy:
     global CONTAINER_CONNECTIONS
     global CACHE_CONTAINER_CONNECTIONS
-    
+
+    ## Serve the container from an in-process fake when one is configured (eg. for load testing)
+    fake = get_fake_container(container, db or os.environ.get('COSMOS_DB', None))
+    if fake is not None:
+        return fake
+
     if not endpoint:
         endpoint = os.environ.get('COSMOS_ENDPOINT', os.environ.get('COSMOS_ACCOUNT_HOST', os.environ.get('SUBSCRIPTIONS_COSMOS_ENDPOINT', None)))
     if not endpoint:
@@ -34,18 +146,7 @@ def _connect_to_cosmos_container(container:str, db:str = None, endpoint:str = No
     if CACHE_CONTAINER_CONNECTIONS and cache_key in CONTAINER_CONNECTIONS:
         return CONTAINER_CONNECTIONS[cache_key]
     
-    ## Determine if we are using a connection string, key or Managed Identity
-    connection_string = os.environ.get('COSMOS_CONNECTION_STRING', None)
-    key = os.environ.get('COSMOS_KEY', None)
-    
-    ## Load the Client
-    client = None
-    if connection_string is not None:
-        client = CosmosClient.from_connection_string(connection_string)
-    elif key is not None:
-        client = CosmosClient(endpoint, {'masterKey': key})
-    else:
-        client = CosmosClient(endpoint, DefaultAzureCredential())
+    client = _get_cosmos_client(endpoint)
 
     ## Connect to the DB + Container
     ## Check if the database exists
@@ -106,6 +207,8 @@ class CosmosDBConnection:
     _database: str
     _container: str
     _container_client: ContainerProxy
+    _breaker: CircuitBreaker
+    _retry_budget: RetryBudget
 
     def __init__(self, container_name: str, database_name: str = None, endpoint: str = None):
         """
@@ -115,6 +218,8 @@ class CosmosDBConnection:
         self._database = database_name
         self._container = container_name
         self._container_client = None
+        self._breaker = CircuitBreaker(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_SECONDS)
+        self._retry_budget = RetryBudget(RETRY_BUDGET_RATIO)
         self.connect()
 
     def connect(self):
@@ -135,53 +240,247 @@ class CosmosDBConnection:
             self._container_client = None
         return self
     
-    def get_item(self, id:str, partitionKey:str = None) -> CosmosDict|None:
+    def _execute(self, operation:str, call:Callable[..., any]) -> any:
+        """
+        Execute a call against the container, within the per-call deadline (COSMOS_REQUEST_TIMEOUT_MS).
+        Queries are executed a page at a time (see iter_item_pages), so the deadline and retries apply to each page rather than to a whole scan.
+
+        Throttled (429) and transient failures are retried after the x-ms-retry-after-ms delay, as long as the retry
+        fits within the deadline and the retry budget. If the circuit breaker is open, the call fails fast with a StoreUnavailableError.
+        The call is given the keyword args to pass to the container method (the timeout and a response hook for the metrics).
+        """
+        if not self._breaker.allow_request():
+            if metrics.METRICS_ENABLED:
+                metrics.COSMOS_REQUESTS.inc(operation, "circuit_open")
+            raise StoreUnavailableError(f"CosmosDB container {self._container} is unavailable (circuit breaker is open)")
+
+        self._retry_budget.record_call()
+        if timing.TIMING_ENABLED:
+            start = time.monotonic_ns()
+            try:
+                return self._execute_with_retries(operation, call)
+            finally:
+                timing.record(timing.COSMOS, start)
+        return self._execute_with_retries(operation, call)
+
+    def _execute_with_retries(self, operation:str, call:Callable[..., any]) -> any:
+        deadline = time.monotonic() + REQUEST_TIMEOUT_MS / 1000.0 if REQUEST_TIMEOUT_MS > 0 else None
+        attempt = 0
+        while True:
+            try:
+                res = self._execute_once(operation, call, deadline)
+                self._breaker.record_success()
+                return res
+            except Exception as e:
+                if not _is_store_failure(e):
+                    self._breaker.record_success()  ## The store answered (eg. a 404), so it's healthy
+                    raise e
+
+                retry_after = _retry_after_seconds(e, attempt)
+                attempt += 1
+                remaining = deadline - time.monotonic() if deadline is not None else float("inf")
+                if retry_after is None or attempt > MAX_RETRIES or retry_after >= remaining or not self._retry_budget.try_spend():
+                    self._breaker.record_failure()
+                    raise e
+                time.sleep(retry_after)
+
+    def _execute_once(self, operation:str, call:Callable[..., any], deadline:float|None) -> any:
+        kwargs = {}
+        if deadline is not None:
+            kwargs["timeout"] = max(deadline - time.monotonic(), 0.001)
+        if not metrics.METRICS_ENABLED:
+            return call(**kwargs)
+
+        charge = [ 0.0 ]
+        def response_hook(headers, *args):
+            charge[0] += float(headers.get("x-ms-request-charge", 0) or 0)
+        kwargs["response_hook"] = response_hook
+
+        status = "200"
+        start = time.perf_counter()
+        try:
+            return call(**kwargs)
+        except CosmosHttpResponseError as e:
+            status = str(e.status_code)
+            if e.headers:
+                charge[0] += float(e.headers.get("x-ms-request-charge", 0) or 0)
+            raise e
+        except Exception as e:
+            status = "error"
+            raise e
+        finally:
+            metrics.COSMOS_REQUEST_DURATION.observe(time.perf_counter() - start, operation)
+            metrics.COSMOS_REQUESTS.inc(operation, status)
+            metrics.COSMOS_REQUEST_CHARGE.observe(charge[0], operation)
+            metrics.COSMOS_REQUEST_UNITS.inc(operation, amount=charge[0])
+
+    def get_item(self, id:str, partitionKey:str = None, fields:list[str] = None) -> CosmosDict|None:
+        """
+        Read an item by id.
+        If fields is provided, only those fields are read (using a single partition query rather than a point read).
+        """
         try:
             self.connect()  # Ensure the connection is established
             pk = partitionKey if partitionKey is not None else id
-            return self._container_client.read_item(item=id, partition_key=pk)
+            if fields:
+                items = self._execute("query_items", lambda **kw: list(self._container_client.query_items(
+                    query=select_clause(fields) + " WHERE c.id = @id",
+                    parameters=[ { "name":"@id", "value": id } ],
+                    partition_key=pk,
+                    **kw
+                )))
+                return items[0] if items else None
+            return self._execute("read_item", lambda **kw: self._container_client.read_item(item=id, partition_key=pk, **kw))
         except CosmosResourceNotFoundError: 
             return None
 
     def get_item_list(self, id_list:list[str], partitionKey:str = None) -> list[CosmosDict]:
         try:
-            self.connect() # Ensure the connection is established
             if partitionKey is None: 
-                return list(self._container_client.query_items(
-                    query="SELECT * FROM c WHERE ARRAY_CONTAINS(@items, c.id)",
-                    enable_cross_partition_query=True, 
-                    parameters=[ { "name":"@items", "value": id_list }, ]
-                ))
+                return self._query_all(
+                    "SELECT * FROM c WHERE ARRAY_CONTAINS(@items, c.id)",
+                    [ { "name":"@items", "value": id_list }, ]
+                )
             else: 
-                return list(self._container_client.query_items(
-                    query=f"SELECT * FROM c WHERE c.partitionKey=@partition_key AND ARRAY_CONTAINS(@items, c.id)",
-                    parameters=[ { "name":"@partition_key", "value": partitionKey }, { "name":"@items", "value": id_list }, ],
-                    enable_cross_partition_query=False
-                ))
+                return self._query_all(
+                    "SELECT * FROM c WHERE c.partitionKey=@partition_key AND ARRAY_CONTAINS(@items, c.id)",
+                    [ { "name":"@partition_key", "value": partitionKey }, { "name":"@items", "value": id_list }, ]
+                )
         except CosmosResourceNotFoundError: 
             return None
 
 
-    def get_partition_items(self, partitionKey:str) -> list[CosmosDict]:
+    def get_items_by_ids(self, ids:list[str], partitionKeys:list[str] = None, chunk_size:int = None, max_parallelism:int = None, fields:list[str] = None) -> list[CosmosDict]:
+        """
+        Read many items (by id) in a few batched round trips, rather than one point read per item.
+
+        The ids are read in chunks of chunk_size (id, partition key) pairs, with at most max_parallelism chunks in flight at once.
+        If partitionKeys is not provided, each item's id is used as its partition key.
+        Items that do not exist are omitted from the result, which has no guaranteed ordering.
+        If fields is provided, only those fields are read (using a query per chunk rather than the batched point read).
+        """
+        if not ids:
+            return []
         self.connect()  # Ensure the connection is established
-        return list(self._container_client.query_items(
-            query="SELECT * FROM c WHERE c.partitionKey=@partition_key ORDER BY c._ts DESC",
-            parameters=[
-                { "name":"@partition_key", "value": partitionKey }
-            ]
-        ))
+        chunk_size = chunk_size or BATCH_READ_CHUNK_SIZE
+        max_parallelism = max_parallelism or BATCH_READ_MAX_PARALLELISM
+        pks = partitionKeys if partitionKeys is not None else ids
+        items = list(zip(ids, pks))
+        chunks = [ items[i:i + chunk_size] for i in range(0, len(items), chunk_size) ]
+        read_chunk = lambda chunk: self._read_chunk(chunk, fields)
+        if len(chunks) == 1 or max_parallelism <= 1:
+            return [ item for chunk in chunks for item in read_chunk(chunk) ]
+
+        from concurrent.futures import ThreadPoolExecutor
+        res = []
+        with ThreadPoolExecutor(max_workers=min(max_parallelism, len(chunks))) as executor:
+            for chunk_items in executor.map(read_chunk, chunks):
+                res.extend(chunk_items)
+        return res
+
+    def _read_chunk(self, items:list[tuple[str, str]], fields:list[str] = None) -> list[CosmosDict]:
+        ## Newer SDKs call the batched point read read_items (it was previously read_many_items)
+        read_items = getattr(self._container_client, "read_items", None) or getattr(self._container_client, "read_many_items", None)
+        if read_items is not None and not fields:
+            return self._execute("read_items", lambda **kw: list(read_items(items=items, max_concurrency=1, **kw)))
+
+        ## Otherwise, fall back to a single query for the chunk
+        id_list = [ item_id for item_id, _ in items ]
+        return self._execute("query_items", lambda **kw: list(self._container_client.query_items(
+            query=select_clause(fields) + " WHERE ARRAY_CONTAINS(@items, c.id)",
+            enable_cross_partition_query=True,
+            parameters=[ { "name":"@items", "value": id_list }, ],
+            **kw
+        )))
+
+    def get_partition_items(self, partitionKey:str) -> list[CosmosDict]:
+        return self._query_all(
+            "SELECT * FROM c WHERE c.partitionKey=@partition_key ORDER BY c._ts DESC",
+            [ { "name":"@partition_key", "value": partitionKey } ]
+        )
 
     def get_all_items(self, source:str = None) -> list[CosmosDict]:
+        return self._query_all("SELECT * FROM c ORDER BY c._ts DESC")
+
+    def get_items_by_query(self, query:str, source:str = None, parameters:list[dict[str, any]] = None) -> list[CosmosDict]:
+        """
+        Run a (cross partition) query - use parameters rather than formatting values into the query.
+        """
+        return self._query_all(query, parameters)
+
+    def _query_all(self, query:str, parameters:list[dict[str, any]] = None) -> list[CosmosDict]:
+        """
+        Run a query and collect all of its results, fetching (and retrying) a page at a time, so a large scan is not bound by a single deadline
+        and a failed page is retried from where it left off rather than from the first page.
+        """
+        return [ item for items, _ in self.iter_item_pages(query, parameters) for item in items ]
+
+
+    def iter_item_pages(self, query:str, parameters:list[dict[str, any]] = None, partitionKey:str = None, max_item_count:int = None, continuation_token:str = None) -> Iterator[tuple[list[CosmosDict], str|None]]:
+        """
+        Run a query, yielding one page of (at most max_item_count) results at a time, so the full result set is never held in memory.
+
+        Each page is yielded with the continuation token for the rest of the results (None after the last page),
+        which can be passed back in as continuation_token to resume the query after an interruption.
+        """
         self.connect()  # Ensure the connection is established
-        return list(self._container_client.query_items(
-            query="SELECT * FROM c ORDER BY c._ts DESC",
-            enable_cross_partition_query=True
-        ))
+        token = continuation_token
 
-    def get_items_by_query(self, query:str, source:str = None) -> list[CosmosDict]:
-        self.connect() # Ensure the connection is established
-        return list(self._container_client.query_items(query=query, enable_cross_partition_query=True))
+        def fetch_page(**kwargs):
+            ## The query is (re)started from the last continuation token for each page (which is also how a failed page is retried),
+            ## as the SDK applies the timeout from the start of the query, so each page gets its own deadline
+            options = { "query": query, "parameters": parameters, "max_item_count": max_item_count or QUERY_PAGE_SIZE, **kwargs }
+            if partitionKey is not None:
+                options["partition_key"] = partitionKey
+            else:
+                options["enable_cross_partition_query"] = True
+            pages = self._container_client.query_items(**options).by_page(token)
+            try:
+                return list(next(pages)), pages.continuation_token
+            except StopIteration:
+                return None, None
+
+        while True:
+            items, token = self._execute("query_page", fetch_page)
+            if items is None:
+                return
+            yield items, token
+            if token is None:
+                return
 
+    def iter_items_by_query(self, query:str, parameters:list[dict[str, any]] = None, max_item_count:int = None, continuation_token:str = None) -> Iterator[CosmosDict]:
+        """
+        Run a query, yielding the results one at a time (fetched a page at a time).
+        """
+        for items, _ in self.iter_item_pages(query, parameters, max_item_count=max_item_count, continuation_token=continuation_token):
+            yield from items
+
+    def iter_all_items(self, max_item_count:int = None, continuation_token:str = None, fields:list[str] = None) -> Iterator[CosmosDict]:
+        """
+        Yield all the items in the container (in no particular order), fetched a page at a time.
+        If fields is provided, only those fields are read.
+        """
+        return self.iter_items_by_query(select_clause(fields), max_item_count=max_item_count, continuation_token=continuation_token)
+
+    def iter_partition_items(self, partitionKey:str, max_item_count:int = None, continuation_token:str = None) -> Iterator[CosmosDict]:
+        """
+        Yield all the items with the given partitionKey (in no particular order), fetched a page at a time.
+        """
+        return self.iter_items_by_query(
+            "SELECT * FROM c WHERE c.partitionKey=@partition_key",
+            [ { "name":"@partition_key", "value": partitionKey } ],
+            max_item_count=max_item_count, continuation_token=continuation_token
+        )
+
+    def iter_item_list(self, id_list:list[str], max_item_count:int = None, continuation_token:str = None) -> Iterator[CosmosDict]:
+        """
+        Yield the items with the given ids (in no particular order), fetched a page at a time.
+        """
+        return self.iter_items_by_query(
+            "SELECT * FROM c WHERE ARRAY_CONTAINS(@items, c.id)",
+            [ { "name":"@items", "value": id_list } ],
+            max_item_count=max_item_count, continuation_token=continuation_token
+        )
 
     def upsert_item(self, item:dict, ttl:int = None, source:str = None):
         try:
@@ -197,12 +496,13 @@ class CosmosDBConnection:
                 if ttl is not None: 
                     item = { "ttl":ttl, **item }
 
-            self._container_client.upsert_item(body=item)
+            self._execute("upsert_item", lambda **kw: self._container_client.upsert_item(body=item, **kw))
         except Exception as e: 
-            print("failed to upsert this item:", item)
+            logging.warning("Failed to upsert the item with id %s", item.get("id", None))
             raise e
         
     def delete_item(self, id:str, partitionKey:str = None):
         self.connect() # Ensure the connection is established
-        self._container_client.delete_item(item=id, partition_key=partitionKey)
+        pk = partitionKey if partitionKey is not None else id
+        self._execute("delete_item", lambda **kw: self._container_client.delete_item(item=id, partition_key=pk, **kw))
 
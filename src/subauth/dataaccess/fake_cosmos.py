@@ -0,0 +1,358 @@
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+from typing import Callable, Iterator
+
+from azure.cosmos.exceptions import CosmosHttpResponseError, CosmosResourceNotFoundError, CosmosClientTimeoutError
+
+
+class LatencyModel:
+    """
+    A distribution of (injected) latencies, specified as "<kind>:<params in ms>":
+
+    - fixed:5           - always 5ms
+    - uniform:2:10      - uniformly between 2ms and 10ms
+    - normal:5:1        - normally distributed with a mean of 5ms and a standard deviation of 1ms
+    - lognormal:4:0.6   - log-normally distributed with a median of 4ms and a sigma of 0.6 (a realistic long tail)
+    - exponential:5     - exponentially distributed with a mean of 5ms
+    """
+    kind:str
+    params:list[float]
+
+    def __init__(self, spec:str = None):
+        self.kind = "none"
+        self.params = []
+        if spec:
+            parts = spec.split(":")
+            self.kind = parts[0].strip().lower()
+            self.params = [ float(part) for part in parts[1:] ]
+            if self.kind not in ("none", "fixed", "uniform", "normal", "lognormal", "exponential"):
+                raise ValueError(f"Invalid latency distribution: {spec}")
+
+    def sample_ms(self, rng:random.Random) -> float:
+        if self.kind == "fixed":
+            return self.params[0]
+        if self.kind == "uniform":
+            return rng.uniform(self.params[0], self.params[1])
+        if self.kind == "normal":
+            return max(0.0, rng.gauss(self.params[0], self.params[1]))
+        if self.kind == "lognormal":
+            return rng.lognormvariate(math.log(self.params[0]), self.params[1])
+        if self.kind == "exponential":
+            return rng.expovariate(1.0 / self.params[0])
+        return 0.0
+
+
+class _Condition:
+    """
+    A single condition in the WHERE clause of a (supported) query.
+    """
+    def __init__(self, kind:str, field:str, value:any):
+        self.kind = kind
+        self.field = field
+        self.value = value
+
+    def matches(self, doc:dict) -> bool:
+        if self.kind == "equals":
+            return self.field in doc and doc[self.field] == self.value
+        if self.kind == "array_contains":
+            return self.field in doc and doc[self.field] in (self.value or [])
+        return False
+
+
+_SELECT_PATTERN = re.compile(r"^\s*SELECT\s+(?P<fields>.+?)\s+FROM\s+c(?:\s+WHERE\s+(?P<where>.+?))?(?:\s+ORDER\s+BY\s+c\.(?P<order>\w+)(?:\s+(?P<dir>ASC|DESC))?)?\s*$", re.IGNORECASE)
+_EQUALS_PATTERN = re.compile(r"^c\.(?P<field>\w+)\s*=\s*(?P<value>.+)$", re.IGNORECASE)
+_ARRAY_CONTAINS_PATTERN = re.compile(r"^ARRAY_CONTAINS\(\s*(?P<value>@\w+)\s*,\s*c\.(?P<field>\w+)\s*\)$", re.IGNORECASE)
+
+def _parse_value(raw:str, parameters:dict[str, any]) -> any:
+    raw = raw.strip()
+    if raw.startswith("@"):
+        if raw not in parameters:
+            raise ValueError(f"Query parameter {raw} was not provided")
+        return parameters[raw]
+    if raw.startswith("'") and raw.endswith("'"):
+        return raw[1:-1]
+    return json.loads(raw)
+
+def _parse_query(query:str, parameters:list[dict[str, any]] = None) -> tuple[list[str]|None, list[_Condition], str|None, bool]:
+    """
+    Parse the subset of the Cosmos SQL syntax that the library uses:
+    SELECT * | c.a, c.b FROM c [WHERE <cond> [AND <cond>]...] [ORDER BY c.field [ASC|DESC]],
+    where a condition is c.field = <@param|literal> or ARRAY_CONTAINS(@param, c.field)
+    """
+    match = _SELECT_PATTERN.match(query)
+    if not match:
+        raise ValueError(f"Unsupported query: {query}")
+    params = { param["name"]: param["value"] for param in (parameters or []) }
+
+    fields = None
+    if match.group("fields").strip() != "*":
+        fields = []
+        for field in match.group("fields").split(","):
+            field = field.strip()
+            if not field.startswith("c."):
+                raise ValueError(f"Unsupported projection: {field}")
+            fields.append(field[2:])
+
+    conditions = []
+    if match.group("where"):
+        for clause in re.split(r"\s+AND\s+", match.group("where"), flags=re.IGNORECASE):
+            clause = clause.strip()
+            equals = _EQUALS_PATTERN.match(clause)
+            contains = _ARRAY_CONTAINS_PATTERN.match(clause)
+            if equals:
+                conditions.append(_Condition("equals", equals.group("field"), _parse_value(equals.group("value"), params)))
+            elif contains:
+                conditions.append(_Condition("array_contains", contains.group("field"), _parse_value(contains.group("value"), params)))
+            else:
+                raise ValueError(f"Unsupported query condition: {clause}")
+
+    descending = (match.group("dir") or "ASC").upper() == "DESC"
+    return fields, conditions, match.group("order"), descending
+
+
+class FakePageIterator:
+    """
+    Iterates over the pages of a query result, exposing the continuation_token for the rest of the results.
+    The continuation token is simply the offset of the next result.
+    """
+    def __init__(self, container:"FakeContainerProxy", results:list[dict], page_size:int, continuation_token:str, kwargs:dict):
+        self._container = container
+        self._results = results
+        self._page_size = page_size
+        self._offset = int(continuation_token) if continuation_token else 0
+        self._kwargs = kwargs
+        self._fetched = False
+        self.continuation_token = continuation_token
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> Iterator[dict]:
+        ## Like CosmosDB, an empty result is still one (empty) page, ie. one round trip
+        if self._fetched and self._offset >= len(self._results):
+            raise StopIteration
+        self._fetched = True
+        page = self._results[self._offset:self._offset + self._page_size]
+        self._container._simulate("query_items", self._kwargs)
+        self._offset += len(page)
+        self.continuation_token = str(self._offset) if self._offset < len(self._results) else None
+        self._container._respond(self._kwargs, 2.5 + 0.1 * len(page), page)
+        return iter(page)
+
+
+class FakeItemPaged:
+    """
+    The (lazy) result of a query, which can be iterated over item by item, or page by page (by_page).
+    """
+    def __init__(self, container:"FakeContainerProxy", results:Callable[[], list[dict]], page_size:int, kwargs:dict):
+        self._container = container
+        self._results = results
+        self._page_size = page_size
+        self._kwargs = kwargs
+
+    def by_page(self, continuation_token:str = None) -> FakePageIterator:
+        return FakePageIterator(self._container, self._results(), self._page_size, continuation_token, self._kwargs)
+
+    def __iter__(self) -> Iterator[dict]:
+        for page in self.by_page():
+            yield from page
+
+
+class FakeContainerProxy:
+    """
+    An in-memory stand-in for a CosmosDB ContainerProxy (the methods the library uses), for offline load testing and benchmarks.
+
+    Every call can have latency injected (from a LatencyModel), be throttled (a 429 with a x-ms-retry-after-ms header)
+    or fail (a 503), at the configured rates. A call given a timeout that is shorter than its injected latency raises a CosmosClientTimeoutError.
+    The number of calls per operation is tracked in calls.
+    """
+    latency:LatencyModel
+    throttle_rate:float
+    retry_after_ms:int
+    failure_rate:float
+    calls:dict[str, int]
+
+    def __init__(self, docs:list[dict] = None, latency:str|LatencyModel = None, throttle_rate:float = 0.0, retry_after_ms:int = 100, failure_rate:float = 0.0, seed:int = None, sleep:Callable[[float], None] = time.sleep):
+        self._docs = { doc["id"]: dict(doc) for doc in (docs or []) }
+        self.latency = latency if isinstance(latency, LatencyModel) else LatencyModel(latency)
+        self.throttle_rate = throttle_rate
+        self.retry_after_ms = retry_after_ms
+        self.failure_rate = failure_rate
+        self.calls = {}
+        self._rng = random.Random(seed)
+        self._sleep = sleep
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_file(cls, path:str, **options) -> "FakeContainerProxy":
+        """
+        Load the documents from a JSON file (a list of documents) or a JSON Lines file (one document per line).
+        """
+        with open(path, "r", encoding="utf-8") as f:
+            content = f.read()
+        if content.lstrip().startswith("["):
+            docs = json.loads(content)
+        else:
+            docs = [ json.loads(line) for line in content.splitlines() if line.strip() ]
+        return cls(docs, **options)
+
+    def save(self, path:str):
+        """
+        Save the documents to a JSON Lines file (which can be loaded with from_file).
+        """
+        with self._lock:
+            docs = list(self._docs.values())
+        with open(path, "w", encoding="utf-8") as f:
+            for doc in docs:
+                f.write(json.dumps(doc) + "\n")
+
+    def reset_stats(self):
+        with self._lock:
+            self.calls = {}
+
+    def _simulate(self, operation:str, kwargs:dict):
+        """
+        Record the call, and inject the latency, throttling and failures.
+        """
+        with self._lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+            latency_ms = self.latency.sample_ms(self._rng)
+            throttled = self.throttle_rate > 0 and self._rng.random() < self.throttle_rate
+            failed = not throttled and self.failure_rate > 0 and self._rng.random() < self.failure_rate
+
+        timeout = kwargs.get("timeout", None)
+        if timeout is not None and latency_ms / 1000.0 > timeout:
+            self._sleep(timeout)
+            raise CosmosClientTimeoutError()
+        if latency_ms > 0:
+            self._sleep(latency_ms / 1000.0)
+
+        if throttled:
+            e = CosmosHttpResponseError(status_code=429, message="Request rate is large (injected)")
+            e.headers = { "x-ms-retry-after-ms": str(self.retry_after_ms), "x-ms-request-charge": "0" }
+            raise e
+        if failed:
+            e = CosmosHttpResponseError(status_code=503, message="Service unavailable (injected)")
+            e.headers = { "x-ms-request-charge": "0" }
+            raise e
+
+    def _respond(self, kwargs:dict, charge:float, result:any):
+        hook = kwargs.get("response_hook", None)
+        if hook is not None:
+            hook({ "x-ms-request-charge": str(round(charge, 2)) }, result)
+        return result
+
+    @staticmethod
+    def _read_charge(doc:dict) -> float:
+        return max(1.0, len(json.dumps(doc)) / 1024.0)
+
+    def read(self, **kwargs) -> dict:
+        self._simulate("read", kwargs)
+        return self._respond(kwargs, 1.0, { "id": "fake" })
+
+    def read_item(self, item:str, partition_key:any, **kwargs) -> dict:
+        self._simulate("read_item", kwargs)
+        with self._lock:
+            doc = self._docs.get(item, None)
+        if doc is None:
+            raise CosmosResourceNotFoundError(status_code=404, message=f"Item {item} not found")
+        return self._respond(kwargs, self._read_charge(doc), dict(doc))
+
+    def read_items(self, items:list[tuple[str, any]], **kwargs) -> list[dict]:
+        self._simulate("read_items", kwargs)
+        with self._lock:
+            docs = [ dict(self._docs[item_id]) for item_id, _ in items if item_id in self._docs ]
+        return self._respond(kwargs, sum(self._read_charge(doc) for doc in docs), docs)
+
+    def query_items(self, query:str, parameters:list[dict[str, any]] = None, partition_key:any = None, enable_cross_partition_query:bool = None, max_item_count:int = None, **kwargs) -> FakeItemPaged:
+        fields, conditions, order, descending = _parse_query(query, parameters)
+        ## A point lookup (on the id, which is the partition key) doesn't need to scan every document
+        doc_id = partition_key if partition_key is not None else next((condition.value for condition in conditions if condition.kind == "equals" and condition.field == "id"), None)
+
+        def results() -> list[dict]:
+            with self._lock:
+                if isinstance(doc_id, str):
+                    docs = [ self._docs[doc_id] ] if doc_id in self._docs else []
+                else:
+                    docs = list(self._docs.values())
+            res = [ doc for doc in docs if all(condition.matches(doc) for condition in conditions) ]
+            if partition_key is not None:
+                res = [ doc for doc in res if doc.get("id") == partition_key ]
+            if order:
+                res.sort(key=lambda doc: doc.get(order, 0), reverse=descending)
+            if fields is not None:
+                res = [ { field: doc[field] for field in fields if field in doc } for doc in res ]
+            return res
+
+        return FakeItemPaged(self, results, max_item_count or 100, kwargs)
+
+    def upsert_item(self, body:dict, **kwargs) -> dict:
+        self._simulate("upsert_item", kwargs)
+        doc = { **body, "_ts": int(time.time()) }
+        with self._lock:
+            self._docs[body["id"]] = doc
+        return self._respond(kwargs, 10.0, dict(doc))
+
+    def create_item(self, body:dict, **kwargs) -> dict:
+        with self._lock:
+            exists = body["id"] in self._docs
+        if exists:
+            raise CosmosHttpResponseError(status_code=409, message=f"Item {body['id']} already exists")
+        return self.upsert_item(body, **kwargs)
+
+    def delete_item(self, item:str, partition_key:any, **kwargs):
+        self._simulate("delete_item", kwargs)
+        with self._lock:
+            if item not in self._docs:
+                raise CosmosResourceNotFoundError(status_code=404, message=f"Item {item} not found")
+            del self._docs[item]
+        self._respond(kwargs, 10.0, None)
+
+
+def fake_container_from_env() -> FakeContainerProxy|None:
+    """
+    Create a fake container from the COSMOS_FAKE_* environment variables, if COSMOS_FAKE_STORE is set
+    (to 'memory' for an empty store, or the path of a JSON/JSON Lines file of documents).
+    """
+    store = os.environ.get('COSMOS_FAKE_STORE', None)
+    if not store:
+        return None
+    seed = os.environ.get('COSMOS_FAKE_SEED', None)
+    options = {
+        "latency": os.environ.get('COSMOS_FAKE_LATENCY', None),
+        "throttle_rate": float(os.environ.get('COSMOS_FAKE_THROTTLE_RATE', "0")),
+        "retry_after_ms": int(os.environ.get('COSMOS_FAKE_RETRY_AFTER_MS', "100")),
+        "failure_rate": float(os.environ.get('COSMOS_FAKE_FAILURE_RATE', "0")),
+        "seed": int(seed) if seed is not None else None,
+    }
+    if store.lower() == "memory":
+        return FakeContainerProxy(**options)
+    return FakeContainerProxy.from_file(store, **options)
+
+
+FAKE_CONTAINERS = {}
+
+def register_fake_container(container:str, fake:FakeContainerProxy, db:str = None):
+    """
+    Serve the given container (in the given database, or any database) from a fake container, instead of CosmosDB.
+    """
+    FAKE_CONTAINERS[f"{db or '*'}/{container}"] = fake
+
+def clear_fake_containers():
+    FAKE_CONTAINERS.clear()
+
+def get_fake_container(container:str, db:str = None) -> FakeContainerProxy|None:
+    """
+    Get the fake container for the given container (if one has been registered, or COSMOS_FAKE_STORE is set).
+    """
+    fake = FAKE_CONTAINERS.get(f"{db or '*'}/{container}", None) or FAKE_CONTAINERS.get(f"*/{container}", None)
+    if fake is None:
+        fake = fake_container_from_env()
+        if fake is not None:
+            FAKE_CONTAINERS[f"{db or '*'}/{container}"] = fake
+    return fake
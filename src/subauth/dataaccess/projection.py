@@ -0,0 +1,14 @@
+import re
+
+_FIELD_NAME_PATTERN = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+def select_clause(fields:list[str] = None) -> str:
+    """
+    Get the SELECT clause for a query that projects only the given fields (or all fields if None).
+    """
+    if not fields:
+        return "SELECT * FROM c"
+    for field in fields:
+        if not _FIELD_NAME_PATTERN.match(field):
+            raise ValueError(f"Invalid field name for projection: {field}")
+    return "SELECT " + ", ".join(f"c.{field}" for field in fields) + " FROM c"
@@ -0,0 +1,100 @@
+import threading
+import time
+
+
+class StoreUnavailableError(RuntimeError):
+    """
+    Raised (without calling the store) when the circuit breaker for the store is open.
+    """
+    pass
+
+
+class CircuitBreaker:
+    """
+    A simple circuit breaker, used to fail fast when the store is unhealthy.
+
+    After failure_threshold consecutive failures the circuit opens, and all calls are rejected until reset_timeout seconds have passed.
+    Then a single trial call is let through (half-open): if it succeeds the circuit closes again, otherwise it re-opens.
+    """
+    failure_threshold:int
+    reset_timeout:float
+    _failures:int
+    _opened_at:float|None
+    _trial_in_flight:bool
+
+    def __init__(self, failure_threshold:int = 5, reset_timeout:float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        if time.monotonic() - self._opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def allow_request(self) -> bool:
+        """
+        Check if a call to the store should be attempted.
+        """
+        if self._opened_at is None:
+            return True
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.reset_timeout or self._trial_in_flight:
+                return False
+            self._trial_in_flight = True
+            return True
+
+    def record_success(self):
+        if self._failures == 0 and self._opened_at is None:
+            return
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial_in_flight or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+            self._trial_in_flight = False
+
+
+class RetryBudget:
+    """
+    Limits the number of retries to a fraction of the number of calls, so retries can't multiply the load on a struggling store.
+
+    Each call deposits ratio tokens (up to max_tokens), and each retry spends one token.
+    The budget starts with min_tokens, so that a quiet process can still retry.
+    """
+    ratio:float
+    max_tokens:float
+    _tokens:float
+
+    def __init__(self, ratio:float = 0.2, min_tokens:float = 10.0, max_tokens:float = 100.0):
+        self.ratio = ratio
+        self.max_tokens = max(max_tokens, min_tokens)
+        self._tokens = min_tokens
+        self._lock = threading.Lock()
+
+    def record_call(self):
+        with self._lock:
+            self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    def try_spend(self) -> bool:
+        """
+        Take a token for a retry, returns False if the budget is exhausted.
+        """
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
@@ -0,0 +1,159 @@
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from typing import Callable
+
+from . import metrics
+
+DECISION_LOG_ENABLED = os.environ.get('SUBAUTH_DECISION_LOG', "false").lower() == "true"                         # Emit a structured event for the auth decisions
+DECISION_LOG_ALLOW_SAMPLE_RATE = float(os.environ.get('SUBAUTH_DECISION_LOG_ALLOW_SAMPLE_RATE', "0.01"))        # The fraction of the allowed requests to log
+DECISION_LOG_DENY_SAMPLE_RATE = float(os.environ.get('SUBAUTH_DECISION_LOG_DENY_SAMPLE_RATE', "1.0"))           # The fraction of the denied requests to log
+DECISION_LOG_QUEUE_SIZE = int(os.environ.get('SUBAUTH_DECISION_LOG_QUEUE_SIZE', "10000"))                       # The maximum number of events waiting to be written (the rest are dropped)
+
+DECISION_LOGGER_NAME = "subauth.decisions"
+
+## The (fixed) formats of the Subscription.is_allowed reasons that name the rule that denied the request
+_DENY_RULE_PREFIXES = ( "Request does not match ALLOW rule ", "Request matches DENY rule " )
+
+
+def _log_event(event:dict[str, any]):
+    logging.getLogger(DECISION_LOGGER_NAME).info(json.dumps(event, separators=(",", ":")))
+
+
+class DecisionLogger:
+    """
+    Writes the decision events on a background thread, so that logging never adds latency to a request.
+
+    The events are put on a bounded queue, and when the queue is full (eg. under a flood of bad requests) they are dropped and counted, rather than waiting.
+    The sink is called (on the writer thread) with each event, and defaults to logging it as a line of JSON on the "subauth.decisions" logger.
+    """
+    sink:Callable[[dict[str, any]], None]
+    dropped:int
+    written:int
+
+    def __init__(self, sink:Callable[[dict[str, any]], None] = None, queue_size:int = None):
+        self.sink = sink if sink is not None else _log_event
+        self.dropped = 0
+        self.written = 0
+        self._queue = queue.Queue(maxsize=queue_size if queue_size is not None else DECISION_LOG_QUEUE_SIZE)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def emit(self, event:dict[str, any]) -> bool:
+        """
+        Queue the event to be written, returns False if it was dropped (because the queue is full).
+        """
+        if self._thread is None:
+            self._start()
+        try:
+            self._queue.put_nowait(event)
+            return True
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            if metrics.METRICS_ENABLED:
+                metrics.DECISION_LOG_DROPPED.inc()
+            return False
+
+    def flush(self, timeout:float = None) -> bool:
+        """
+        Wait (up to timeout seconds) for the queued events to be written, returns False if they were not all written in time.
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while self._queue.unfinished_tasks:
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(0.001)
+        return True
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._write, name="subauth-decision-log", daemon=True)
+                self._thread.start()
+
+    def _write(self):
+        while True:
+            event = self._queue.get()
+            try:
+                self.sink(event)
+                self.written += 1
+            except Exception:
+                pass    ## A failing sink must not stop the writer
+            finally:
+                self._queue.task_done()
+
+
+_DECISION_LOGGER:DecisionLogger = None
+_DECISION_LOGGER_LOCK = threading.Lock()
+
+
+def get_decision_logger() -> DecisionLogger:
+    global _DECISION_LOGGER
+    if _DECISION_LOGGER is None:
+        with _DECISION_LOGGER_LOCK:
+            if _DECISION_LOGGER is None:
+                _DECISION_LOGGER = DecisionLogger()
+    return _DECISION_LOGGER
+
+def set_decision_logger(logger:DecisionLogger|None):
+    """
+    Replace the decision logger (eg. with one that has a custom sink), or None to go back to the default.
+    """
+    global _DECISION_LOGGER
+    _DECISION_LOGGER = logger
+
+def set_decision_log_enabled(enabled:bool, allow_sample_rate:float = None, deny_sample_rate:float = None):
+    """
+    Enable or disable the decision log (and, optionally, set the fraction of the allowed and denied requests that are logged).
+    """
+    global DECISION_LOG_ENABLED, DECISION_LOG_ALLOW_SAMPLE_RATE, DECISION_LOG_DENY_SAMPLE_RATE
+    DECISION_LOG_ENABLED = enabled
+    if allow_sample_rate is not None:
+        DECISION_LOG_ALLOW_SAMPLE_RATE = allow_sample_rate
+    if deny_sample_rate is not None:
+        DECISION_LOG_DENY_SAMPLE_RATE = deny_sample_rate
+
+def deny_rule(reason:str|None) -> str|None:
+    """
+    The name of the rule that denied the request, from the reason given by Subscription.is_allowed (or None).
+    """
+    if reason is None:
+        return None
+    for prefix in _DENY_RULE_PREFIXES:
+        if reason.startswith(prefix):
+            return reason[len(prefix):]
+    return None
+
+def log_decision(request, decision) -> bool:
+    """
+    Log a (sampled) event for the decision on the request (a core.Decision), returns True if the event was queued.
+    Only call this when DECISION_LOG_ENABLED.
+
+    The event has the subscription id, the outcome, the reason, the rule that denied the request and the stage timings (in ms, when the stage timers are enabled).
+    It never includes the credentials on the request.
+    """
+    rate = DECISION_LOG_ALLOW_SAMPLE_RATE if decision.allowed else DECISION_LOG_DENY_SAMPLE_RATE
+    if rate < 1.0 and (rate <= 0.0 or random.random() >= rate):
+        return False
+
+    sub = decision.subscription
+    event = {
+        "time": time.time(),
+        "subscription_id": sub.id if sub is not None else None,
+        "outcome": "allow" if decision.allowed else "deny",
+        "reason": decision.reason,
+        "deny_rule": deny_rule(decision.reason) if not decision.allowed else None,
+        "method": request.method,
+        "host": request.host,
+        "path": request.path(),
+        "client_ip": request.client_ip,
+        "sample_rate": rate,
+    }
+    if decision.trace is not None:
+        event["stages"] = { stage: round(duration / 1e6, 3) for stage, duration in decision.trace.durations().items() }
+    return get_decision_logger().emit(event)
@@ -0,0 +1,142 @@
+import asyncio
+import hashlib
+import os
+import threading
+
+HTTP_TIMEOUT_SECONDS = float(os.environ.get('ENTRA_HTTP_TIMEOUT_SECONDS', "10"))                 # The timeout for the MSAL calls to Entra
+REDEMPTION_MAX_CONCURRENCY = int(os.environ.get('ENTRA_REDEMPTION_MAX_CONCURRENCY', "8"))        # The maximum number of auth code redemptions in flight (per process)
+REDEMPTION_MAX_PENDING = int(os.environ.get('ENTRA_REDEMPTION_MAX_PENDING', "64"))               # The maximum number of redemptions waiting (or in flight), before new ones are rejected
+REDEMPTION_TIMEOUT_SECONDS = float(os.environ.get('ENTRA_REDEMPTION_TIMEOUT_SECONDS', "10"))     # The deadline for the async redemption
+
+_MSAL_APPS = {}
+_MSAL_APPS_LOCK = threading.Lock()
+_REDEMPTION_EXECUTOR = None
+_REDEMPTION_PENDING = 0
+_REDEMPTION_LOCK = threading.Lock()
+
+
+class RedemptionOverloadedError(RuntimeError):
+    """
+    Raised when there are too many auth code redemptions waiting to be processed.
+    """
+    pass
+
+
+def _no_token_cache():
+    """
+    A token cache that does not keep any tokens.
+    The library only uses the ID token returned by the auth callback, so a shared app must not accumulate every user's tokens.
+    """
+    import msal
+
+    class _NoTokenCache(msal.TokenCache):
+        def add(self, *args, **kwargs):
+            pass
+
+    return _NoTokenCache()
+
+def get_msal_app(authority:str = None, client_id:str = None, client_secret:str = None, app_name:str = None):
+    """
+    Get the (process wide) MSAL ConfidentialClientApplication for the given app registration (defaults to the ENTRA_* environment variables).
+
+    Creating an app performs the authority (OpenID metadata) discovery over the network, so each app is only created once,
+    keyed on the authority, client id and (a digest of the) client secret.
+    """
+    from .settings import get_settings
+    settings = get_settings()
+    authority = authority or settings.entra_authority
+    client_id = client_id or settings.entra_client_id
+    client_secret = client_secret or settings.entra_client_secret
+    app_name = app_name or settings.entra_app_name
+
+    key = (authority, client_id, hashlib.sha256((client_secret or "").encode("utf-8")).hexdigest(), app_name)
+    app = _MSAL_APPS.get(key, None)
+    if app is not None:
+        return app
+
+    with _MSAL_APPS_LOCK:
+        app = _MSAL_APPS.get(key, None)
+        if app is None:
+            import msal
+            app = msal.ConfidentialClientApplication(
+                app_name=app_name,
+                client_id=client_id,
+                client_credential=client_secret,
+                authority=authority,
+                token_cache=_no_token_cache(),
+                timeout=HTTP_TIMEOUT_SECONDS,
+            )
+            _MSAL_APPS[key] = app
+    return app
+
+def _get_redemption_executor():
+    global _REDEMPTION_EXECUTOR
+    if _REDEMPTION_EXECUTOR is None:
+        with _REDEMPTION_LOCK:
+            if _REDEMPTION_EXECUTOR is None:
+                from concurrent.futures import ThreadPoolExecutor
+                _REDEMPTION_EXECUTOR = ThreadPoolExecutor(max_workers=REDEMPTION_MAX_CONCURRENCY, thread_name_prefix="subauth-redeem")
+    return _REDEMPTION_EXECUTOR
+
+async def redeem_auth_code_async(code:str, scopes:list[str], redirect_uri:str, timeout:float = None, app = None) -> dict[str, any]:
+    """
+    Redeem an authorization code (acquire_token_by_authorization_code) without blocking the event loop.
+
+    The (blocking) MSAL call runs on a bounded executor, so at most ENTRA_REDEMPTION_MAX_CONCURRENCY redemptions are in flight.
+    If more than ENTRA_REDEMPTION_MAX_PENDING are waiting, a RedemptionOverloadedError is raised rather than queueing more,
+    and if the redemption does not complete within the timeout (defaults to ENTRA_REDEMPTION_TIMEOUT_SECONDS) an asyncio.TimeoutError is raised.
+    """
+    global _REDEMPTION_PENDING
+    app = app if app is not None else get_msal_app()
+    with _REDEMPTION_LOCK:
+        if _REDEMPTION_PENDING >= REDEMPTION_MAX_PENDING:
+            raise RedemptionOverloadedError("Too many logins are being processed, try again shortly")
+        _REDEMPTION_PENDING += 1
+
+    def release(_):
+        global _REDEMPTION_PENDING
+        ## Only released when the call is done, or cancelled before it started (even if the caller has given up waiting for it)
+        with _REDEMPTION_LOCK:
+            _REDEMPTION_PENDING -= 1
+
+    try:
+        redemption = _get_redemption_executor().submit(app.acquire_token_by_authorization_code, code=code, scopes=scopes, redirect_uri=redirect_uri)
+    except BaseException as e:
+        release(None)
+        raise e
+    redemption.add_done_callback(release)
+    return await asyncio.wait_for(asyncio.wrap_future(redemption), timeout if timeout is not None else REDEMPTION_TIMEOUT_SECONDS)
+
+def clear_msal_apps():
+    with _MSAL_APPS_LOCK:
+        _MSAL_APPS.clear()
+
+def prewarm(background:bool = False):
+    """
+    Create the MSAL app and load the token signing keys ahead of the first request (eg. at startup), so the first
+    login redirect and the first token verification don't pay for the discovery round trips.
+    Does nothing if Entra is not configured.
+    """
+    from .settings import get_settings
+    settings = get_settings()
+    if not settings.entra_enabled:
+        return
+
+    def warm():
+        from . import jwks
+        try:
+            if settings.entra_client_secret is not None:
+                get_msal_app()
+            jwks.get_key_manager(settings.entra_authority).refresh()
+        except Exception:
+            if not background:
+                raise
+
+    if background:
+        threading.Thread(target=warm, name="subauth-entra-prewarm", daemon=True).start()
+    else:
+        warm()
+
+## Prewarm (in the background) when the adapters are loaded, if ENTRA_PREWARM=true
+if os.environ.get('ENTRA_PREWARM', "false").lower() == "true":
+    prewarm(background=True)
@@ -0,0 +1,214 @@
+import os
+import random
+import threading
+
+EXPLAIN_SAMPLE_RATE = float(os.environ.get('SUBAUTH_EXPLAIN_SAMPLE_RATE', "0"))                 # The fraction of is_allowed calls to explain, and aggregate per subscription (0 = disabled)
+EXPLAIN_MAX_SUBSCRIPTIONS = int(os.environ.get('SUBAUTH_EXPLAIN_MAX_SUBSCRIPTIONS', "1000"))    # The maximum number of subscriptions to keep the sampled aggregates for
+EXPLAIN_MAX_PATTERNS = int(os.environ.get('SUBAUTH_EXPLAIN_MAX_PATTERNS', "50"))                # The maximum number of matched patterns to count per rule
+
+
+class RuleTrace:
+    """
+    The evaluation of one rule of a subscription: what matched, the outcome and how long it took.
+    """
+    index:int
+    name:str
+    type:str
+    allow:bool
+    matched:bool
+    pattern:str|None        ## The pattern (exact value, wildcard or regex) that matched
+    outcome:str             ## "allow", "deny" or "skipped" (for a stateful rule that was not evaluated)
+    duration_ns:int
+
+    def __init__(self, index:int, name:str, type:str, allow:bool, pattern:str|None, duration_ns:int, evaluated:bool = True):
+        self.index = index
+        self.name = name
+        self.type = type
+        self.allow = allow
+        self.matched = pattern is not None
+        self.pattern = pattern
+        if not evaluated:
+            self.outcome = "skipped"
+        else:
+            self.outcome = "allow" if self.matched == allow else "deny"
+        self.duration_ns = duration_ns
+
+    def to_dict(self) -> dict[str, any]:
+        return {
+            "index": self.index,
+            "name": self.name,
+            "type": self.type,
+            "allow": self.allow,
+            "matched": self.matched,
+            "pattern": self.pattern,
+            "outcome": self.outcome,
+            "duration_ns": self.duration_ns,
+        }
+
+    def __repr__(self):
+        return f"RuleTrace(type={self.type}, name={self.name}, pattern={self.pattern}, outcome={self.outcome}, duration_ns={self.duration_ns})"
+
+
+class Explanation:
+    """
+    The explanation of a Subscription.is_allowed decision, with a trace of each rule that was evaluated.
+    """
+    subscription_id:str
+    allowed:bool
+    reason:str
+    rules:list[RuleTrace]
+    duration_ns:int
+
+    def __init__(self, subscription_id:str, allowed:bool, reason:str, rules:list[RuleTrace], duration_ns:int):
+        self.subscription_id = subscription_id
+        self.allowed = allowed
+        self.reason = reason
+        self.rules = rules
+        self.duration_ns = duration_ns
+
+    def slowest(self) -> RuleTrace|None:
+        return max(self.rules, key=lambda rule: rule.duration_ns) if self.rules else None
+
+    def to_dict(self) -> dict[str, any]:
+        return {
+            "subscription_id": self.subscription_id,
+            "allowed": self.allowed,
+            "reason": self.reason,
+            "duration_ns": self.duration_ns,
+            "rules": [ rule.to_dict() for rule in self.rules ],
+        }
+
+    def __repr__(self):
+        return f"Explanation(subscription_id={self.subscription_id}, allowed={self.allowed}, reason={self.reason}, duration_ns={self.duration_ns}, rules={self.rules})"
+
+
+class RuleStats:
+    """
+    The aggregated (sampled) evaluations of one rule of a subscription.
+    """
+    name:str
+    type:str
+    evaluations:int
+    matches:int
+    denies:int
+    total_ns:int
+    max_ns:int
+    patterns:dict[str, int]     ## The number of times each pattern matched
+
+    def __init__(self, name:str, type:str):
+        self.name = name
+        self.type = type
+        self.evaluations = 0
+        self.matches = 0
+        self.denies = 0
+        self.total_ns = 0
+        self.max_ns = 0
+        self.patterns = {}
+
+    def add(self, trace:RuleTrace):
+        if trace.outcome == "skipped":
+            return
+        self.evaluations += 1
+        self.total_ns += trace.duration_ns
+        if trace.duration_ns > self.max_ns:
+            self.max_ns = trace.duration_ns
+        if trace.outcome == "deny":
+            self.denies += 1
+        if trace.matched:
+            self.matches += 1
+            if trace.pattern in self.patterns or len(self.patterns) < EXPLAIN_MAX_PATTERNS:
+                self.patterns[trace.pattern] = self.patterns.get(trace.pattern, 0) + 1
+
+    def to_dict(self) -> dict[str, any]:
+        return {
+            "name": self.name,
+            "type": self.type,
+            "evaluations": self.evaluations,
+            "matches": self.matches,
+            "denies": self.denies,
+            "total_ns": self.total_ns,
+            "mean_ns": self.total_ns // self.evaluations if self.evaluations else 0,
+            "max_ns": self.max_ns,
+            "patterns": dict(self.patterns),
+        }
+
+
+class SubscriptionStats:
+    """
+    The aggregated (sampled) explanations of a subscription's decisions.
+    """
+    subscription_id:str
+    samples:int
+    allowed:int
+    total_ns:int
+    rules:dict[int, RuleStats]  ## Keyed on the index of the rule
+
+    def __init__(self, subscription_id:str):
+        self.subscription_id = subscription_id
+        self.samples = 0
+        self.allowed = 0
+        self.total_ns = 0
+        self.rules = {}
+
+    def add(self, explanation:Explanation):
+        self.samples += 1
+        self.total_ns += explanation.duration_ns
+        if explanation.allowed:
+            self.allowed += 1
+        for trace in explanation.rules:
+            stats = self.rules.get(trace.index)
+            if stats is None:
+                stats = self.rules[trace.index] = RuleStats(trace.name, trace.type)
+            stats.add(trace)
+
+    def to_dict(self) -> dict[str, any]:
+        return {
+            "subscription_id": self.subscription_id,
+            "samples": self.samples,
+            "allowed": self.allowed,
+            "total_ns": self.total_ns,
+            "mean_ns": self.total_ns // self.samples if self.samples else 0,
+            "rules": [ self.rules[index].to_dict() for index in sorted(self.rules) ],
+        }
+
+
+_STATS:dict[str, SubscriptionStats] = {}
+_STATS_LOCK = threading.Lock()
+
+
+def set_explain_sample_rate(rate:float):
+    """
+    Set the fraction (0 to 1) of is_allowed calls that are explained and aggregated per subscription (0 disables the sampling).
+    """
+    global EXPLAIN_SAMPLE_RATE
+    EXPLAIN_SAMPLE_RATE = rate
+
+def should_sample() -> bool:
+    return EXPLAIN_SAMPLE_RATE >= 1.0 or random.random() < EXPLAIN_SAMPLE_RATE
+
+def record(explanation:Explanation):
+    """
+    Add a (sampled) explanation to the aggregate of its subscription.
+    Once EXPLAIN_MAX_SUBSCRIPTIONS subscriptions are being tracked, the explanations of other subscriptions are dropped.
+    """
+    with _STATS_LOCK:
+        stats = _STATS.get(explanation.subscription_id)
+        if stats is None:
+            if len(_STATS) >= EXPLAIN_MAX_SUBSCRIPTIONS:
+                return
+            stats = _STATS[explanation.subscription_id] = SubscriptionStats(explanation.subscription_id)
+        stats.add(explanation)
+
+def get_explain_stats(subscription_id:str = None) -> dict[str, any]|list[dict[str, any]]|None:
+    """
+    Get the sampled aggregate for a subscription (or None if it has not been sampled), or the aggregates of all the sampled subscriptions.
+    """
+    with _STATS_LOCK:
+        if subscription_id is not None:
+            stats = _STATS.get(subscription_id)
+            return stats.to_dict() if stats is not None else None
+        return [ stats.to_dict() for stats in _STATS.values() ]
+
+def reset_explain_stats():
+    with _STATS_LOCK:
+        _STATS.clear()
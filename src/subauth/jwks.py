@@ -0,0 +1,178 @@
+import os
+import threading
+import time
+from typing import TYPE_CHECKING
+from . import metrics
+from . import timing
+
+if TYPE_CHECKING:
+    from .verifiers import TokenVerifier
+
+JWKS_TTL_SECONDS = float(os.environ.get('ENTRA_JWKS_TTL_SECONDS', "86400"))                     # How long the keys are used for before they must be refetched
+JWKS_REFRESH_AHEAD_SECONDS = float(os.environ.get('ENTRA_JWKS_REFRESH_AHEAD_SECONDS', "3600"))   # Refresh the keys in the background this long before they expire
+JWKS_MIN_REFETCH_SECONDS = float(os.environ.get('ENTRA_JWKS_MIN_REFETCH_SECONDS', "60"))         # The minimum time between refetches for an unknown kid, or after a failed fetch
+JWKS_CONNECT_TIMEOUT_SECONDS = float(os.environ.get('ENTRA_JWKS_CONNECT_TIMEOUT_SECONDS', "2"))
+JWKS_READ_TIMEOUT_SECONDS = float(os.environ.get('ENTRA_JWKS_READ_TIMEOUT_SECONDS', "5"))
+
+_KEY_MANAGERS = {}
+_KEY_MANAGERS_LOCK = threading.Lock()
+_SESSION = None
+
+
+def _get_session():
+    """
+    Get the (shared) HTTP session, so the connection to the authority is kept alive between fetches.
+    """
+    global _SESSION
+    if _SESSION is None:
+        import requests
+        _SESSION = requests.Session()
+    return _SESSION
+
+
+class JwksKeyManager:
+    """
+    Caches the signing keys (JWKS) of an authority, keyed on their kid.
+
+    The keys are used for ttl seconds, and are refreshed in the background refresh_ahead seconds before then (so requests don't wait on the fetch).
+    A token signed with an unknown kid (eg. after a key rollover) triggers a refetch, at most once every min_refetch_interval seconds.
+    Concurrent fetches are collapsed into a single request (single-flight), and if a refresh fails the current keys are kept.
+    After a failed fetch, the keys are not refetched for min_refetch_interval seconds (the current keys are used, or the requests fail straight away),
+    so an outage of the authority doesn't make every request wait on a fetch.
+    """
+    jwks_url:str
+    ttl:float
+    refresh_ahead:float
+    min_refetch_interval:float
+    _keys:dict[str, dict]|None
+    _prepared:dict[tuple[str, str], tuple[dict, any]]
+    _fetched_at:float
+    _attempted_at:float
+    _failed_at:float
+    _attempts:int
+    _refreshing:bool
+
+    def __init__(self, jwks_url:str, ttl:float = None, refresh_ahead:float = None, min_refetch_interval:float = None, session = None):
+        self.jwks_url = jwks_url
+        self.ttl = ttl if ttl is not None else JWKS_TTL_SECONDS
+        self.refresh_ahead = refresh_ahead if refresh_ahead is not None else JWKS_REFRESH_AHEAD_SECONDS
+        self.min_refetch_interval = min_refetch_interval if min_refetch_interval is not None else JWKS_MIN_REFETCH_SECONDS
+        self._session = session
+        self._keys = None
+        self._prepared = {}
+        self._fetched_at = 0.0
+        self._attempted_at = float("-inf")
+        self._failed_at = float("-inf")
+        self._attempts = 0
+        self._refreshing = False
+        self._fetch_lock = threading.Lock()
+        self._state_lock = threading.Lock()
+
+    def get_key(self, kid:str) -> dict|None:
+        """
+        Get the key with the given kid (or None if the authority has no such key).
+        Raises a RuntimeError if the keys could not be loaded at all.
+        """
+        keys = self._keys
+        age = time.monotonic() - self._fetched_at
+        backing_off = time.monotonic() - self._failed_at < self.min_refetch_interval
+        if keys is None and backing_off:
+            raise RuntimeError("Unable to load the Keys for validating the auth token")
+        if keys is None or (age >= self.ttl and not backing_off):
+            keys = self._fetch("expired" if keys is not None else "initial")
+        elif age >= self.ttl - self.refresh_ahead and not backing_off:
+            self._refresh_in_background()
+
+        key = keys.get(kid, None)
+        if key is None and time.monotonic() - self._attempted_at >= self.min_refetch_interval:
+            key = self._fetch("unknown_kid").get(kid, None)
+        return key
+
+    def get_prepared_key(self, kid:str, verifier:"TokenVerifier") -> any:
+        """
+        Get the key with the given kid, prepared for (eg. parsed into a key object by) the given verifier.
+        Each key is only prepared once per verifier (until the keys are refetched).
+        """
+        jwk = self.get_key(kid)
+        if jwk is None:
+            return None
+        entry = self._prepared.get((verifier.name, kid), None)
+        if entry is None or entry[0] is not jwk:
+            entry = (jwk, verifier.prepare_key(jwk))
+            self._prepared[(verifier.name, kid)] = entry
+        return entry[1]
+
+    def refresh(self) -> dict[str, dict]:
+        """
+        Fetch the keys now.
+        """
+        return self._fetch("manual")
+
+    def _refresh_in_background(self):
+        with self._state_lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def refresh():
+            try:
+                self._fetch("background")
+            except Exception:
+                pass    ## The current keys are kept, and the next request will try again
+            finally:
+                self._refreshing = False
+
+        threading.Thread(target=refresh, name="subauth-jwks-refresh", daemon=True).start()
+
+    def _fetch(self, reason:str) -> dict[str, dict]:
+        attempts = self._attempts
+        with self._fetch_lock:
+            ## Someone else tried to fetch the keys while we were waiting, so use the outcome of theirs (rather than fetching again)
+            if self._attempts != attempts:
+                if self._keys is None:
+                    raise RuntimeError("Unable to load the Keys for validating the auth token")
+                return self._keys
+
+            self._attempted_at = time.monotonic()
+            if timing.TIMING_ENABLED:
+                start = time.monotonic_ns()
+            try:
+                session = self._session if self._session is not None else _get_session()
+                resp = session.get(self.jwks_url, timeout=(JWKS_CONNECT_TIMEOUT_SECONDS, JWKS_READ_TIMEOUT_SECONDS))
+                resp.raise_for_status()
+                keys = { key["kid"]: key for key in resp.json().get("keys", []) if "kid" in key }
+            except Exception as e:
+                if timing.TIMING_ENABLED:
+                    timing.record(timing.JWKS, start)
+                if metrics.METRICS_ENABLED:
+                    metrics.JWKS_FETCHES.inc(reason, "error")
+                self._failed_at = time.monotonic()
+                self._attempts += 1
+                if self._keys is not None:
+                    return self._keys   ## Keep using the keys we have
+                raise RuntimeError("Unable to load the Keys for validating the auth token") from e
+
+            if timing.TIMING_ENABLED:
+                timing.record(timing.JWKS, start)
+            if metrics.METRICS_ENABLED:
+                metrics.JWKS_FETCHES.inc(reason, "ok")
+            self._keys = keys
+            self._prepared = {}
+            self._fetched_at = time.monotonic()
+            self._failed_at = float("-inf")
+            self._attempts += 1
+            return keys
+
+
+def get_key_manager(authority:str) -> JwksKeyManager:
+    """
+    Get the (shared) key manager for the given Entra authority.
+    """
+    jwks_url = authority + "/discovery/v2.0/keys"
+    manager = _KEY_MANAGERS.get(jwks_url, None)
+    if manager is None:
+        with _KEY_MANAGERS_LOCK:
+            manager = _KEY_MANAGERS.get(jwks_url, None)
+            if manager is None:
+                manager = _KEY_MANAGERS[jwks_url] = JwksKeyManager(jwks_url)
+    return manager
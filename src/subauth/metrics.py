@@ -0,0 +1,248 @@
+import os
+import threading
+import time
+
+METRICS_ENABLED = os.environ.get('SUBAUTH_METRICS_ENABLED', "true").lower() == "true"
+
+DEFAULT_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+REQUEST_CHARGE_BUCKETS = (1.0, 2.0, 3.0, 5.0, 10.0, 25.0, 50.0, 100.0, 250.0, 1000.0)
+
+
+def _format_value(value:float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+def _format_bound(bound:float) -> str:
+    if bound == float("inf"):
+        return "+Inf"
+    return repr(float(bound))
+
+def _format_labels(labelnames:tuple[str, ...], labelvalues:tuple[str, ...], extra:str = None) -> str:
+    parts = [ f'{name}="{_escape(str(value))}"' for name, value in zip(labelnames, labelvalues) ]
+    if extra:
+        parts.append(extra)
+    if not parts:
+        return ""
+    return "{" + ",".join(parts) + "}"
+
+def _escape(value:str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Counter:
+    """
+    A monotonically increasing counter, with an optional set of labels.
+    """
+    name:str
+    help:str
+    labelnames:tuple[str, ...]
+    _values:dict[tuple[str, ...], float]
+
+    def __init__(self, name:str, help:str, labelnames:tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labelvalues:str, amount:float = 1):
+        """
+        Increment the counter for the given label values.
+        """
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def value(self, *labelvalues:str) -> float:
+        return self._values.get(labelvalues, 0)
+
+    def reset(self):
+        with self._lock:
+            self._values = {}
+
+    def collect(self) -> dict[tuple[str, ...], float]:
+        with self._lock:
+            return dict(self._values)
+
+    def openmetrics(self) -> list[str]:
+        lines = [ f"# TYPE {self.name} counter", f"# HELP {self.name} {self.help}" ]
+        for labelvalues, value in sorted(self.collect().items()):
+            lines.append(f"{self.name}_total{_format_labels(self.labelnames, labelvalues)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    """
+    A histogram of observed values, with fixed buckets and an optional set of labels.
+    """
+    name:str
+    help:str
+    labelnames:tuple[str, ...]
+    buckets:tuple[float, ...]
+    _values:dict[tuple[str, ...], list]
+
+    def __init__(self, name:str, help:str, labelnames:tuple[str, ...] = (), buckets:tuple[float, ...] = DEFAULT_LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value:float, *labelvalues:str):
+        """
+        Record an observation for the given label values.
+        """
+        idx = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                idx = i
+                break
+        with self._lock:
+            state = self._values.get(labelvalues, None)
+            if state is None:
+                ## [ per-bucket counts (the last is +Inf), count, sum ]
+                state = self._values[labelvalues] = [ [0] * (len(self.buckets) + 1), 0, 0.0 ]
+            state[0][idx] += 1
+            state[1] += 1
+            state[2] += value
+
+    def reset(self):
+        with self._lock:
+            self._values = {}
+
+    def collect(self) -> dict[tuple[str, ...], dict[str, any]]:
+        res = {}
+        with self._lock:
+            for labelvalues, (counts, count, total) in self._values.items():
+                cumulative = 0
+                buckets = {}
+                for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += bucket_count
+                    buckets[bound] = cumulative
+                res[labelvalues] = { "buckets": buckets, "count": count, "sum": total }
+        return res
+
+    def openmetrics(self) -> list[str]:
+        lines = [ f"# TYPE {self.name} histogram", f"# HELP {self.name} {self.help}" ]
+        for labelvalues, state in sorted(self.collect().items()):
+            for bound, cumulative in state["buckets"].items():
+                le = 'le="' + _format_bound(bound) + '"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labelvalues, le)} {cumulative}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labelvalues)} {state['count']}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labelvalues)} {_format_value(state['sum'])}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    A collection of metrics that can be pulled (as a dict) or exported in the OpenMetrics text format.
+    """
+    _metrics:dict[str, Counter|Histogram]
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name:str, help:str, labelnames:tuple[str, ...] = ()) -> Counter:
+        return self._register(name, lambda: Counter(name, help, labelnames))
+
+    def histogram(self, name:str, help:str, labelnames:tuple[str, ...] = (), buckets:tuple[float, ...] = DEFAULT_LATENCY_BUCKETS) -> Histogram:
+        return self._register(name, lambda: Histogram(name, help, labelnames, buckets))
+
+    def _register(self, name:str, factory):
+        with self._lock:
+            metric = self._metrics.get(name, None)
+            if metric is None:
+                metric = self._metrics[name] = factory()
+            return metric
+
+    def get(self, name:str) -> Counter|Histogram|None:
+        return self._metrics.get(name, None)
+
+    def reset(self):
+        """
+        Reset all the metric values (the metrics stay registered).
+        """
+        for metric in list(self._metrics.values()):
+            metric.reset()
+
+    def collect(self) -> dict[str, dict[str, any]]:
+        """
+        Get a snapshot of all the metrics, keyed on metric name.
+        Each metric has a 'type', its 'labels' and its 'values' (keyed on the tuple of label values).
+        """
+        res = {}
+        for name, metric in sorted(self._metrics.items()):
+            res[name] = {
+                "type": "counter" if isinstance(metric, Counter) else "histogram",
+                "labels": metric.labelnames,
+                "values": metric.collect(),
+            }
+        return res
+
+    def generate_openmetrics(self) -> str:
+        """
+        Export all the metrics in the OpenMetrics text format.
+        """
+        lines = []
+        for _, metric in sorted(self._metrics.items()):
+            lines.extend(metric.openmetrics())
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+OPENMETRICS_CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+CACHE_HITS = REGISTRY.counter("subauth_cache_hits", "Number of cache lookups that found an entry", ("cache",))
+CACHE_MISSES = REGISTRY.counter("subauth_cache_misses", "Number of cache lookups that did not find an entry", ("cache",))
+CACHE_EVICTIONS = REGISTRY.counter("subauth_cache_evictions", "Number of entries removed from a cache", ("cache", "reason"))
+
+COSMOS_REQUESTS = REGISTRY.counter("subauth_cosmos_requests", "Number of requests made to CosmosDB", ("operation", "status"))
+COSMOS_REQUEST_UNITS = REGISTRY.counter("subauth_cosmos_request_units", "Total request units (RU) charged by CosmosDB", ("operation",))
+COSMOS_REQUEST_CHARGE = REGISTRY.histogram("subauth_cosmos_request_charge", "Request units (RU) charged per CosmosDB request", ("operation",), REQUEST_CHARGE_BUCKETS)
+COSMOS_REQUEST_DURATION = REGISTRY.histogram("subauth_cosmos_request_duration_seconds", "Latency of CosmosDB requests", ("operation",))
+
+JWT_VERIFICATIONS = REGISTRY.counter("subauth_jwt_verifications", "Number of JWT verifications, by result", ("result",))
+JWT_VERIFICATION_DURATION = REGISTRY.histogram("subauth_jwt_verification_duration_seconds", "Latency of JWT verifications")
+JWKS_FETCHES = REGISTRY.counter("subauth_jwks_fetches", "Number of fetches of the token signing keys (JWKS), by reason and result", ("reason", "result"))
+
+RULE_DECISIONS = REGISTRY.counter("subauth_rule_decisions", "Number of rule evaluations, by rule type and decision", ("rule_type", "decision"))
+SUBSCRIPTION_EVALUATION_DURATION = REGISTRY.histogram("subauth_subscription_evaluation_duration_seconds", "Latency of evaluating the rules of a subscription")
+
+SHIELD_REJECTIONS = REGISTRY.counter("subauth_shield_rejections", "Number of subscription ids rejected before the lookup, by reason", ("reason",))
+DECISION_LOG_DROPPED = REGISTRY.counter("subauth_decision_log_dropped", "Number of decision events dropped because the decision log queue was full")
+
+
+def metrics_enabled() -> bool:
+    return METRICS_ENABLED
+
+def set_metrics_enabled(enabled:bool):
+    """
+    Enable or disable the collection of metrics (enabled by default, or set SUBAUTH_METRICS_ENABLED=false).
+    """
+    global METRICS_ENABLED
+    METRICS_ENABLED = enabled
+
+def record_jwt_verification(result:str, start:float):
+    """
+    Record the result of a JWT verification that started at the given time.perf_counter() value.
+    """
+    if METRICS_ENABLED:
+        JWT_VERIFICATION_DURATION.observe(time.perf_counter() - start)
+        JWT_VERIFICATIONS.inc(result)
+
+def get_metrics() -> dict[str, dict[str, any]]:
+    """
+    Get a snapshot of the current metric values.
+    """
+    return REGISTRY.collect()
+
+def generate_openmetrics() -> str:
+    """
+    Get the current metric values in the OpenMetrics text format (eg. to return from a /metrics endpoint).
+    """
+    return REGISTRY.generate_openmetrics()
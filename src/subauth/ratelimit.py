@@ -0,0 +1,179 @@
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+
+RATE_LIMIT_STRIPES = int(os.environ.get('SUBAUTH_RATE_LIMIT_STRIPES', "64"))                  # The number of lock stripes of the token bucket table (rounded up to a power of 2)
+RATE_LIMIT_MAX_BUCKETS = int(os.environ.get('SUBAUTH_RATE_LIMIT_MAX_BUCKETS', "100000"))      # The maximum number of token buckets to keep (in this process)
+RATE_LIMIT_IDLE_SECONDS = float(os.environ.get('SUBAUTH_RATE_LIMIT_IDLE_SECONDS', "600"))     # How long a bucket can go unused before it can be evicted
+
+
+class RateLimiter(ABC):
+    """
+    A table of token buckets: each key has a bucket that holds up to burst tokens, and is refilled at rate tokens per second.
+    """
+    @abstractmethod
+    def try_acquire(self, key:str, rate:float, burst:float, cost:float = 1.0) -> bool:
+        """
+        Take cost tokens from the key's bucket, returns False (and takes nothing) if there are not enough tokens.
+        """
+        pass
+
+
+class _Stripe:
+    __slots__ = ( "lock", "buckets", "swept_at" )
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = {}       ## key -> [ tokens, last updated (monotonic seconds) ]
+        self.swept_at = 0.0
+
+
+class LocalRateLimiter(RateLimiter):
+    """
+    An in-process token bucket table. The table is split into lock stripes (by the hash of the key), so concurrent checks
+    of different keys rarely contend, and each stripe holds at most max_buckets / stripes buckets.
+
+    When a stripe is full, the buckets that have not been used for idle_seconds are evicted (a bucket that has been idle
+    long enough to refill is the same as a new one). If none are idle, the oldest bucket is evicted.
+    """
+    max_buckets:int
+    idle_seconds:float
+
+    def __init__(self, stripes:int = None, max_buckets:int = None, idle_seconds:float = None):
+        stripes = stripes if stripes is not None else RATE_LIMIT_STRIPES
+        size = 1
+        while size < stripes:
+            size *= 2
+        self._stripes = [ _Stripe() for _ in range(size) ]
+        self._mask = size - 1
+        self.max_buckets = max_buckets if max_buckets is not None else RATE_LIMIT_MAX_BUCKETS
+        self.idle_seconds = idle_seconds if idle_seconds is not None else RATE_LIMIT_IDLE_SECONDS
+        self._max_per_stripe = max(1, self.max_buckets // size)
+
+    def try_acquire(self, key:str, rate:float, burst:float, cost:float = 1.0) -> bool:
+        stripe = self._stripes[hash(key) & self._mask]
+        now = time.monotonic()
+        with stripe.lock:
+            bucket = stripe.buckets.get(key)
+            if bucket is None:
+                if len(stripe.buckets) >= self._max_per_stripe:
+                    self._evict(stripe, now)
+                bucket = stripe.buckets[key] = [ burst, now ]
+            else:
+                tokens = bucket[0] + (now - bucket[1]) * rate
+                bucket[0] = tokens if tokens < burst else burst
+                bucket[1] = now
+            if bucket[0] >= cost:
+                bucket[0] -= cost
+                return True
+            return False
+
+    def _evict(self, stripe:_Stripe, now:float):
+        ## Only sweep for idle buckets once a second (per stripe), so a flood of new keys does not rescan the stripe every time
+        if now - stripe.swept_at >= 1.0:
+            stripe.swept_at = now
+            idle = [ key for key, bucket in stripe.buckets.items() if now - bucket[1] >= self.idle_seconds ]
+            for key in idle:
+                del stripe.buckets[key]
+            if idle:
+                return
+        del stripe.buckets[next(iter(stripe.buckets))]
+
+    def sweep(self) -> int:
+        """
+        Evict the idle buckets from the table, returns the number of buckets evicted.
+        """
+        now = time.monotonic()
+        count = 0
+        for stripe in self._stripes:
+            with stripe.lock:
+                idle = [ key for key, bucket in stripe.buckets.items() if now - bucket[1] >= self.idle_seconds ]
+                for key in idle:
+                    del stripe.buckets[key]
+                count += len(idle)
+        return count
+
+    def __len__(self) -> int:
+        return sum(len(stripe.buckets) for stripe in self._stripes)
+
+
+## The token bucket, as a Redis script (so that the refill and the take are atomic, and every process sees the same buckets)
+_REDIS_TOKEN_BUCKET = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1])
+local ts = tonumber(state[2])
+if tokens == nil or ts == nil then
+    tokens = burst
+    ts = now
+end
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+return allowed
+"""
+
+class RedisRateLimiter(RateLimiter):
+    """
+    A token bucket table shared by all the processes (and instances) of the app, in Redis.
+    Pass in a (redis-py compatible) client, eg. redis.Redis.from_url(...), the buckets expire from Redis once they have refilled.
+
+    Every check is a round trip to Redis, so this is much slower than the LocalRateLimiter. If Redis fails, the check fails open
+    (ie. the request is allowed) unless fail_open is False.
+    """
+    prefix:str
+    fail_open:bool
+
+    def __init__(self, client, prefix:str = "subauth:rate:", fail_open:bool = True):
+        self._script = client.register_script(_REDIS_TOKEN_BUCKET)
+        self.prefix = prefix
+        self.fail_open = fail_open
+
+    def try_acquire(self, key:str, rate:float, burst:float, cost:float = 1.0) -> bool:
+        try:
+            return bool(self._script(keys=[ self.prefix + key ], args=[ rate, burst, cost ]))
+        except Exception:
+            return self.fail_open
+
+
+_LOCAL_RATE_LIMITER:LocalRateLimiter = None
+_SHARED_RATE_LIMITER:RateLimiter = None
+_RATE_LIMITER_LOCK = threading.Lock()
+
+
+def get_rate_limiter(shared:bool = False) -> RateLimiter:
+    """
+    Get the rate limiter for the rate rules: the shared one (if shared is True, and one has been set), otherwise the in-process one.
+    """
+    global _LOCAL_RATE_LIMITER
+    if shared and _SHARED_RATE_LIMITER is not None:
+        return _SHARED_RATE_LIMITER
+    if _LOCAL_RATE_LIMITER is None:
+        with _RATE_LIMITER_LOCK:
+            if _LOCAL_RATE_LIMITER is None:
+                _LOCAL_RATE_LIMITER = LocalRateLimiter()
+    return _LOCAL_RATE_LIMITER
+
+def set_rate_limiter(limiter:LocalRateLimiter|None):
+    """
+    Replace the in-process rate limiter (eg. with a different size), or None to go back to the default.
+    """
+    global _LOCAL_RATE_LIMITER
+    _LOCAL_RATE_LIMITER = limiter
+
+def set_shared_rate_limiter(limiter:RateLimiter|None):
+    """
+    Set the rate limiter that is shared between processes (eg. a RedisRateLimiter), used by the rate rules that are "shared".
+    """
+    global _SHARED_RATE_LIMITER
+    _SHARED_RATE_LIMITER = limiter
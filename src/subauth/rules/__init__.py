@@ -8,5 +8,6 @@ from .path_check import PathCheck
 from .date_check import DateCheck
 from .method_check import MethodCheck
 from .client_ip_check import ClientIPCheck
+from .rate_check import RateCheck
 
 from .rule_factory import create_rule
\ No newline at end of file
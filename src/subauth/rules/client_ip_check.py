@@ -7,6 +7,7 @@ class ClientIPCheck(Rule):
     Check if the the client IP address is in the allowed list (of CIDRs).
     This rule can be used to allow or deny requests based on their client ID address.    
     """
+    caller_rule = True
     allowed_cidrs: list[IPv4Network]
 
     def __init__(self, cidrs: list[str], allow: bool = True):
@@ -17,12 +18,15 @@ class ClientIPCheck(Rule):
         """
         Check if the client IP address is in the allowed list (of CIDRs).
         """
+        return self.matched_pattern(req) is not None
+
+    def matched_pattern(self, req: Request) -> str|None:
         if req.client_ip is None:
-            return False
+            return None
         
         client_ip = ip_address(req.client_ip)
         for cidr in self.allowed_cidrs:
             if client_ip in cidr:
-                return True
+                return str(cidr)
 
-        return False
\ No newline at end of file
+        return None
\ No newline at end of file
@@ -9,6 +9,7 @@ class CookieCheck(Rule):
     The cookie value can be a wildcard for entire cookie values, e.g. *, abc*, *abc
     The cookie value can be a regex, by wrapping the cookie value in "regex()", e.g. regex(abc.*)
     """
+    caller_rule = True
     cookie_name:str
     cookie_values:list[str]
     cookie_regexes:list[Pattern]
@@ -26,32 +27,35 @@ class CookieCheck(Rule):
         super().__init__("CookieCheck", allow)
     
     def matches(self, req:Request) -> bool:
+        return self.matched_pattern(req) is not None
+
+    def matched_pattern(self, req:Request) -> str|None:
         req_cookie_val = req.cookie(self.cookie_name)
         if not req_cookie_val:
-            return False
+            return None
         
         
         for cookie_value in self.cookie_values:
             if req_cookie_val == cookie_value:
-                return True
+                return cookie_value
             
             if '*' in cookie_value:
                 if cookie_value.startswith('*'):
                     if req_cookie_val.endswith(cookie_value[1:]):
-                        return True
+                        return cookie_value
                 elif cookie_value.endswith('*'):
                     if req_cookie_val.startswith(cookie_value[:-1]):
-                        return True
+                        return cookie_value
                 else:
                     arr = cookie_value.split('*')   ## We assume only one wildcard in this case
                     if len(arr) != 2:
-                        return False  # Unsupported wildcard expression
-                    return req_cookie_val.startswith(arr[0]) and req_cookie_val.endswith(arr[1])
+                        return None  # Unsupported wildcard expression
+                    return cookie_value if req_cookie_val.startswith(arr[0]) and req_cookie_val.endswith(arr[1]) else None
 
         
         for cookie_regex in self.cookie_regexes:
             if cookie_regex.match(req_cookie_val):
-                return True
+                return "regex(" + cookie_regex.pattern + ")"
             
-        return False
+        return None
 
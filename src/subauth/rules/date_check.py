@@ -43,4 +43,7 @@ class DateCheck(Rule):
         elif self.operator == ">=":
             return now >= self.date
         else:
-            raise ValueError(f"Invalid operator: {self.operator}")
\ No newline at end of file
+            raise ValueError(f"Invalid operator: {self.operator}")
+
+    def matched_pattern(self, req:Request) -> str|None:
+        return f"{self.operator} {self.date}" if self.matches(req) else None
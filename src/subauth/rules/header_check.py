@@ -10,6 +10,7 @@ class HeaderCheck(Rule):
     The query value can be a wildcard for entire query values, e.g. *, abc*, *abc
     The query value can be a regex, by wrapping the query value in "regex()", e.g. regex(abc.*)
     """
+    caller_rule = True
 
     header_name:str
     header_values:list[str]
@@ -28,31 +29,34 @@ class HeaderCheck(Rule):
 
         
     def matches(self, req:Request) -> bool:
+        return self.matched_pattern(req) is not None
+
+    def matched_pattern(self, req:Request) -> str|None:
         req_header_val = req.header(self.header_name)
         if not req_header_val:
-            return False
+            return None
         for header_value in self.header_values:
             if req_header_val == header_value:
-                return True
+                return header_value
             
             if header_value == '*': # Any value match
-                return True
+                return header_value
             
             if '*' in header_value:
                 if header_value.startswith('*'):
                     if req_header_val.endswith(header_value[1:]):
-                        return True
+                        return header_value
                 elif header_value.endswith('*'):
                     if req_header_val.startswith(header_value[:-1]):
-                        return True
+                        return header_value
                 else:
                     arr = header_value.split('*')   ## We assume only one wildcard in this case
                     if len(arr) != 2:
-                        return False  # Unsupported wildcard expression
-                    return req_header_val.startswith(arr[0]) and req_header_val.endswith(arr[1])
+                        return None  # Unsupported wildcard expression
+                    return header_value if req_header_val.startswith(arr[0]) and req_header_val.endswith(arr[1]) else None
                     
         for header_regex in self.header_regexes:
             if header_regex.match(req_header_val):
-                return True
-        return False
+                return "regex(" + header_regex.pattern + ")"
+        return None
     
\ No newline at end of file
@@ -38,21 +38,24 @@ class HostCheck(Rule):
         """
         Execute the rule.
         """
+        return self.matched_pattern(req) is not None
+
+    def matched_pattern(self, req:Request) -> str|None:
         if not req.host:
-            return False
+            return None
         
         lower_req_host = req.host.lower()
         for host in self.hosts:
             if lower_req_host == host.lower():
-                return True
+                return host
         
             if '*' in host:
                 if host.startswith('*'):
                     if lower_req_host.endswith(host[1:]):
-                        return True
+                        return host
                 elif host.endswith('*'):
                     if lower_req_host.startswith(host[:-1]):
-                        return True
+                        return host
                 else:
                     arr = host.split('.')
                     req_arr = lower_req_host.split('.')
@@ -63,10 +66,10 @@ class HostCheck(Rule):
                         ismatch = False
                         break
                     if ismatch:
-                        return True
+                        return host
         
         for host_regex in self.host_regexes:
             if host_regex.match(lower_req_host):
-                return True
+                return "regex(" + host_regex.pattern + ")"
         
-        return False
\ No newline at end of file
+        return None
\ No newline at end of file
@@ -15,11 +15,15 @@ class MethodCheck(Rule):
         super().__init__("MethodCheck", allow)
 
     def matches(self, req: Request) -> bool:
+        return self.matched_pattern(req) is not None
+
+    def matched_pattern(self, req: Request) -> str|None:
         req_method = req.method
         if not req_method:
-            return False
+            return None
         
         req_method = req_method.upper()
         for method in self.methods:
             if req_method == method:
-                return True
\ No newline at end of file
+                return method
+        return None
@@ -27,21 +27,24 @@ class PathCheck(Rule):
         """
         Execute the rule.
         """
+        return self.matched_pattern(req) is not None
+
+    def matched_pattern(self, req:Request) -> str|None:
         if not req.urlpath:
-            return False    
+            return None    
         
         lower_req_path = req.path().lower()
         for path in self.paths:
             if lower_req_path == path.lower():
-                return True
+                return path
             
             if '*' in path:
                 if path.startswith('*'):
                     if lower_req_path.endswith(path[1:]):
-                        return True
+                        return path
                 elif path.endswith('*'):
                     if lower_req_path.startswith(path[:-1]):
-                        return True
+                        return path
                 else:
                     arr = path.split('/')
                     req_arr = lower_req_path.split('/')
@@ -52,10 +55,10 @@ class PathCheck(Rule):
                         ismatch = False
                         break
                     if ismatch:
-                        return True
+                        return path
         
         for path_regex in self.path_regexes:
             if path_regex.match(lower_req_path):
-                return True
+                return "regex(" + path_regex.pattern + ")"
         
-        return False
\ No newline at end of file
+        return None
\ No newline at end of file
@@ -10,6 +10,7 @@ class QueryCheck(Rule):
     The query value can be a wildcard for entire query values, e.g. *, abc*, *abc
     The query value can be a regex, by wrapping the query value in "regex()", e.g. regex(abc.*)
     """
+    caller_rule = True
 
     query_param:str
     query_values:list[str]
@@ -28,31 +29,34 @@ class QueryCheck(Rule):
 
         
     def matches(self, req:Request) -> bool:
+        return self.matched_pattern(req) is not None
+
+    def matched_pattern(self, req:Request) -> str|None:
         req_query_val = req.query_param(self.query_param)
         if not req_query_val:
-            return False
+            return None
         for query_value in self.query_values:
             if req_query_val == query_value:
-                return True
+                return query_value
             
             if query_value == '*': # Any value match
-                return True
+                return query_value
 
             if '*' in query_value:
                 if query_value.startswith('*'):
                     if req_query_val.endswith(query_value[1:]):
-                        return True
+                        return query_value
                 elif query_value.endswith('*'):
                     if req_query_val.startswith(query_value[:-1]):
-                        return True
+                        return query_value
                 else:
                     arr = query_value.split('*')   ## We assume only one wildcard in this case
                     if len(arr) != 2:
-                        return False  # Unsupported wildcard expression
-                    return req_query_val.startswith(arr[0]) and req_query_val.endswith(arr[1])
+                        return None  # Unsupported wildcard expression
+                    return query_value if req_query_val.startswith(arr[0]) and req_query_val.endswith(arr[1]) else None
 
         for query_regex in self.query_regexes:
             if query_regex.match(req_query_val):
-                return True
-        return False
+                return "regex(" + query_regex.pattern + ")"
+        return None
     
@@ -0,0 +1,65 @@
+from .rule import Rule
+from ..data.request import Request
+from .. import ratelimit
+
+RATE_KEYS = ( "subscription", "client-ip", "subscription+client-ip" )
+
+class RateCheck(Rule):
+    """
+    Limit the rate of requests, with a token bucket: up to limit requests per period (in seconds), with bursts of up to burst requests.
+    The request matches while it is within the limit (and takes a token), so as an ALLOW rule, requests over the limit are denied.
+
+    The requests are counted per key, which is one of:
+    - "subscription": all the requests of the subscription (the default)
+    - "client-ip": the requests from each client IP address (across all subscriptions with the same limit)
+    - "subscription+client-ip": the requests from each client IP address, for the subscription
+    When the request has no client IP address, the client-ip keys fall back to counting per subscription.
+
+    The buckets are kept in this process, unless shared is True and a shared rate limiter has been set (see ratelimit.set_shared_rate_limiter).
+    """
+    caller_rule = True
+    stateful = True
+    limit:float
+    period:float
+    rate:float              ## Tokens per second
+    burst:float
+    key:str
+    shared:bool
+    subscription_id:str|None
+
+    def __init__(self, limit:float, period:float = 1.0, burst:float = None, key:str = "subscription", shared:bool = False, allow:bool = True):
+        if limit is None or limit <= 0:
+            raise ValueError("Rate limit must be greater than 0")
+        if period is None or period <= 0:
+            raise ValueError("Rate period must be greater than 0")
+        if key not in RATE_KEYS:
+            raise ValueError(f"Invalid rate key: {key}, should be one of {', '.join(RATE_KEYS)}")
+        self.limit = limit
+        self.period = period
+        self.rate = limit / period
+        self.burst = burst if burst is not None else limit
+        self.key = key
+        self.shared = shared
+        self.subscription_id = None
+        self._bucket_prefix = f"{limit:g}/{period:g}/{self.burst:g}:"
+        super().__init__("RateCheck", allow)
+
+    def bind_subscription(self, subscription_id:str):
+        self.subscription_id = subscription_id
+
+    def bucket_key(self, req:Request) -> str:
+        """
+        The key of the token bucket for the request (includes the limit, period and burst, so different rate rules do not share a bucket).
+        """
+        sub_key = "sub:" + (self.subscription_id or "")
+        if self.key == "subscription" or not req.client_ip:
+            return self._bucket_prefix + sub_key
+        if self.key == "client-ip":
+            return self._bucket_prefix + "ip:" + req.client_ip
+        return self._bucket_prefix + sub_key + "|ip:" + req.client_ip
+
+    def matches(self, req:Request) -> bool:
+        return ratelimit.get_rate_limiter(self.shared).try_acquire(self.bucket_key(req), self.rate, self.burst)
+
+    def matched_pattern(self, req:Request) -> str|None:
+        return f"{self.limit:g}/{self.period:g}s" if self.matches(req) else None
@@ -4,6 +4,8 @@ from ..data.request import Request
 class Rule(ABC):
     name:str
     allow:bool  ## Otherwise deny
+    caller_rule:bool = False    ## The rule is about the caller (eg. its headers or IP address), rather than the resource being requested
+    stateful:bool = False       ## Evaluating the rule changes its state (eg. uses up a rate limit)
     
 
     def __init__(self, name: str, allow:bool = True):
@@ -14,6 +16,19 @@ class Rule(ABC):
     def matches(self, req:Request) -> bool:
         pass
 
+    def bind_subscription(self, subscription_id:str):
+        """
+        Called with the id of the subscription the rule belongs to (for rules that keep state per subscription).
+        """
+        pass
+
+    def matched_pattern(self, req:Request) -> str|None:
+        """
+        The pattern (exact value, wildcard or regex) of the rule that the request matched, or None if the request does not match.
+        Used to explain a decision, rules that do not have patterns return "*" when they match.
+        """
+        return "*" if self.matches(req) else None
+
 class AllowAll(Rule):
     """
     Allow all requests.
@@ -52,6 +52,15 @@ def create_rule(rule_type:str, rule_name:str, allow:bool, claims:dict[str,any])
             else:
                 raise ValueError(f"Invalid operator: {op}")
         return DateCheck(dt, op, allow)
+    elif rule_type == "rate":
+        limit = claims.get("limit", claims.get("requests", None))
+        if not limit:
+            raise ValueError("Limit is required")
+        period = claims.get("period", claims.get("seconds", 1))
+        burst = claims.get("burst", None)
+        key = claims.get("key", claims.get("per", "subscription"))
+        shared = claims.get("shared", False)
+        return RateCheck(limit, period, burst, key, shared, allow)
     elif rule_type == "allow-all":
         return AllowAll()
     elif rule_type == "deny-all":
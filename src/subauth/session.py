@@ -0,0 +1,171 @@
+import base64
+import hashlib
+import hmac
+import json
+import os
+import time
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .data import Subscription, Request
+
+SESSION_COOKIE_NAME = os.environ.get('SESSION_COOKIE_NAME', "subauth_session")
+SESSION_MAX_AGE_SECONDS = int(os.environ.get('SESSION_MAX_AGE_SECONDS', "28800"))   # 8 hours
+
+MIN_KEY_LENGTH = 32
+
+
+class Session:
+    """
+    The (verified) contents of a session cookie: a subscription id or an Entra username, and when the session expires.
+    """
+    sub_id:str|None
+    entra_username:str|None
+    expires:int
+    key_version:str
+
+    def __init__(self, sub_id:str|None, entra_username:str|None, expires:int, key_version:str):
+        self.sub_id = sub_id
+        self.entra_username = entra_username
+        self.expires = expires
+        self.key_version = key_version
+
+    def entra_claims(self) -> dict[str, any]|None:
+        """
+        The Entra identity of the session (in the form of the ID token claims it was issued for), or None if it is not for an Entra user.
+        """
+        if self.entra_username is None:
+            return None
+        return { "preferred_username": self.entra_username, "exp": self.expires }
+
+
+def _parse_keys(value:str) -> list[tuple[str, bytes]]:
+    """
+    Parse the signing keys from "version:secret,version:secret,..." - the first key signs new sessions, and all of them are accepted.
+    """
+    keys = []
+    for entry in value.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        version, sep, secret = entry.partition(":")
+        if not sep or not version or "." in version:
+            raise ValueError("Each session signing key must be in the form version:secret")
+        if len(secret) < MIN_KEY_LENGTH:
+            raise ValueError(f"The session signing key {version} must be at least {MIN_KEY_LENGTH} characters")
+        keys.append((version, secret.encode("utf-8")))
+    return keys
+
+_SIGNING_KEYS = _parse_keys(os.environ.get('SESSION_SIGNING_KEYS', ""))
+_KEYS_BY_VERSION = dict(_SIGNING_KEYS)
+
+
+def set_signing_keys(keys:str|list[tuple[str, bytes]]):
+    """
+    Set the session signing keys (eg. to rotate them), either as "version:secret,..." or a list of (version, secret) - the first key signs new sessions.
+    An empty list disables the session cookie.
+    """
+    global _SIGNING_KEYS, _KEYS_BY_VERSION
+    _SIGNING_KEYS = _parse_keys(keys) if isinstance(keys, str) else list(keys)
+    _KEYS_BY_VERSION = dict(_SIGNING_KEYS)
+
+def sessions_enabled() -> bool:
+    return len(_SIGNING_KEYS) > 0
+
+def _b64encode(data:bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+def _b64decode(data:str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+def _sign(secret:bytes, version:str, payload:str) -> str:
+    return _b64encode(hmac.new(secret, (version + "." + payload).encode("ascii"), hashlib.sha256).digest())
+
+def encode_session(sub_id:str = None, entra_username:str = None, expires:int = None) -> str:
+    """
+    Create a signed session value (version.payload.signature) for a subscription id or an Entra username.
+    """
+    if not sessions_enabled():
+        raise RuntimeError("No session signing keys are configured (SESSION_SIGNING_KEYS)")
+    expires = int(expires if expires is not None else time.time() + SESSION_MAX_AGE_SECONDS)
+    claims = { "e": expires }
+    if sub_id is not None:
+        claims["s"] = sub_id
+    if entra_username is not None:
+        claims["u"] = entra_username
+    version, secret = _SIGNING_KEYS[0]
+    payload = _b64encode(json.dumps(claims, separators=(",", ":")).encode("utf-8"))
+    return version + "." + payload + "." + _sign(secret, version, payload)
+
+def decode_session(value:str|None) -> Session|None:
+    """
+    Verify a session value, returning None if it is invalid (or signed with an unknown key) or has expired.
+    """
+    if not value or not _SIGNING_KEYS:
+        return None
+    parts = value.split(".")
+    if len(parts) != 3:
+        return None
+    version, payload, signature = parts
+    secret = _KEYS_BY_VERSION.get(version, None)
+    if secret is None or not hmac.compare_digest(_sign(secret, version, payload), signature):
+        return None
+    try:
+        claims = json.loads(_b64decode(payload))
+        expires = int(claims["e"])
+    except Exception:
+        return None
+    if expires <= time.time():
+        return None
+    return Session(claims.get("s", None), claims.get("u", None), expires, version)
+
+def get_session_subscription(request:"Request") -> "tuple[Subscription|None, Session|None]":
+    """
+    Get the subscription for the session cookie on the request (if there is a valid one), from the subscription cache, along with the session.
+    The subscription is shared by every request (it is cached), so the identity of the session is returned with it rather than set on it.
+    """
+    if not _SIGNING_KEYS:
+        return None, None
+    session = decode_session(request.cookie(SESSION_COOKIE_NAME))
+    if session is None:
+        return None, None
+
+    from .sub_factory import get_subscription
+    if session.entra_username is not None:
+        return get_subscription(session.entra_username, True), session
+    if session.sub_id is not None:
+        return get_subscription(session.sub_id, False), session
+    return None, None
+
+def session_cookie_for(request:"Request", sub:"Subscription", entra_claims:dict[str, any] = None) -> str|None:
+    """
+    Get the Set-Cookie value for a (new or renewed) session cookie for an allowed request, or None if the current cookie is fine.
+
+    Entra users get a session for their username, which expires no later than their ID token (or session) - the claims of the caller
+    are given as entra_claims (otherwise the subscription's entra_user_claims are used). Subscriptions that are allowed to be
+    stored in the browser get a session for the subscription id. A session is renewed once it is past half its life, or if it was signed with an old key.
+    """
+    if not _SIGNING_KEYS:
+        return None
+
+    now = int(time.time())
+    sub_id = None
+    entra_username = None
+    expires = now + SESSION_MAX_AGE_SECONDS
+    claims = entra_claims if entra_claims is not None else sub.entra_user_claims
+    if sub.is_entra_user and claims:
+        entra_username = claims.get("preferred_username", claims.get("upn", None))
+        exp = claims.get("exp", None)
+        if isinstance(exp, (int, float)):
+            expires = min(expires, int(exp))
+    elif sub.store_sub_in_browser():
+        sub_id = sub.id
+    if (sub_id is None and entra_username is None) or expires <= now:
+        return None
+
+    current = decode_session(request.cookie(SESSION_COOKIE_NAME))
+    if current is not None and current.key_version == _SIGNING_KEYS[0][0] and expires - current.expires < SESSION_MAX_AGE_SECONDS // 2:
+        return None
+
+    value = encode_session(sub_id, entra_username, expires)
+    return f"{SESSION_COOKIE_NAME}={value}; Path=/; Max-Age={expires - now}; HttpOnly; SameSite=None; Secure"
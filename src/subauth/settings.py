@@ -0,0 +1,172 @@
+import os
+import re
+from typing import Mapping
+from .data.subscription import SUBSCRIPTION_FIELDS
+
+_SAME_SITE_VALUES = ( "Lax", "Strict", "None" )
+_SUBSCRIPTION_ID_CHECKSUMS = ( "luhn", "luhn36" )
+
+
+def _bool(environ:Mapping[str, str], name:str, default:bool) -> bool:
+    value = environ.get(name, None)
+    if value is None or value == "":
+        return default
+    return value.strip().lower() == "true"
+
+def _int(environ:Mapping[str, str], name:str, default:int) -> int:
+    value = environ.get(name, None)
+    if value is None or value == "":
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f"{name} must be an integer, but is: {value}")
+
+def _str(environ:Mapping[str, str], name:str, default:str = None) -> str|None:
+    value = environ.get(name, None)
+    return value if value is not None else default
+
+def _list(environ:Mapping[str, str], name:str, default:str = "") -> list[str]:
+    return [ item.strip() for item in environ.get(name, default).split(",") if item.strip() ]
+
+
+class Settings:
+    """
+    A snapshot of the configuration (from the environment variables), parsed and validated once.
+
+    The request path uses the snapshot (and the values derived from it, like the issuer and the scope list) rather than reading
+    the environment on every call. Use reload_settings() to pick up changes to the environment, or set_settings() to configure the library in code.
+
+    Only the values below are in the snapshot, and SUBSCRIPTION_CACHE_SIZE is only used when sub_factory is imported (to size the cache).
+    The tuning knobs of the other modules are module constants, read from the environment once when their module is imported, so
+    reload_settings() and set_settings() do not change them: the session cookie (session.SESSION_*), the JWKS cache (jwks.JWKS_*),
+    the token cache (tokens.TOKEN_CACHE_*), the JWT verifier (verifiers.JWT_*), the Entra redemption limits (entra.*), the CosmosDB
+    client (dataaccess.cosmosdb, eg. REQUEST_TIMEOUT_MS), the rate limiter (ratelimit.RATE_LIMIT_*) and the metrics, timing, explain
+    and decision log switches. Set those environment variables before subauth is imported, or use the module's setter
+    (eg. session.set_signing_keys, timing.set_timing_enabled or shield.set_failure_throttle).
+    """
+    ## Entra
+    entra_authority:str|None
+    entra_client_id:str|None
+    entra_client_secret:str|None
+    entra_app_name:str|None
+    entra_scopes:list[str]
+    entra_scopes_configured:bool
+    entra_redirect_uri:str|None
+    entra_state_strip_api_app_path:bool
+    entra_state_strip_api_serve_path:bool
+    entra_state_redirect_path_prefix:str|None
+    entra_alias_query_fallback:bool
+    default_redirect_url:str
+    id_token_max_age:int
+    id_token_same_site:str
+    id_token_allow_insecure:bool
+
+    ## Subscription store
+    cosmos_endpoint:str|None
+    cosmos_subscription_db:str
+    cosmos_subscription_container:str
+    subscription_cache_size:int
+    subscription_projection:bool
+    subscription_extra_fields:list[str]
+    subscription_id_min_length:int
+    subscription_id_max_length:int
+    subscription_id_charset:str|None
+    subscription_id_checksum:str|None
+
+    ## Derived values
+    entra_enabled:bool
+    entra_issuer:str|None
+    id_token_cookie_secure_attributes:str
+    id_token_cookie_suffix:str
+    subscription_fields:list[str]
+    subscription_read_fields:list[str]|None
+    subscription_id_pattern:re.Pattern|None
+
+    def __init__(self, environ:Mapping[str, str] = None):
+        environ = environ if environ is not None else os.environ
+
+        self.entra_authority = _str(environ, "ENTRA_AUTHORITY")
+        self.entra_client_id = _str(environ, "ENTRA_CLIENT_ID")
+        self.entra_client_secret = _str(environ, "ENTRA_CLIENT_SECRET")
+        self.entra_app_name = _str(environ, "ENTRA_APP_NAME")
+        self.entra_scopes_configured = environ.get("ENTRA_SCOPES", None) is not None
+        self.entra_scopes = environ.get("ENTRA_SCOPES", "User.Read").split(",")
+        self.entra_redirect_uri = _str(environ, "ENTRA_REDIRECT_URI")
+        if self.entra_redirect_uri is not None and len(self.entra_redirect_uri) == 0:
+            self.entra_redirect_uri = None
+        self.entra_state_strip_api_app_path = _bool(environ, "ENTRA_STATE_STRIP_API_APP_PATH", True)
+        self.entra_state_strip_api_serve_path = _bool(environ, "ENTRA_STATE_STRIP_API_SERVE_PATH", True)
+        self.entra_state_redirect_path_prefix = _str(environ, "ENTRA_STATE_REDIRECT_PATH_PREFIX")
+        self.entra_alias_query_fallback = _bool(environ, "ENTRA_ALIAS_QUERY_FALLBACK", True)
+        self.default_redirect_url = _str(environ, "DEFAULT_REDIRECT_URL", "/")
+        self.id_token_max_age = _int(environ, "ENTRA_ID_TOKEN_MAX_AGE_SECONDS", 28800)    # 8 hours
+        self.id_token_same_site = _str(environ, "ENTRA_ID_TOKEN_SAME_SITE", "None")
+        if self.id_token_same_site not in _SAME_SITE_VALUES:
+            self.id_token_same_site = "None"
+        self.id_token_allow_insecure = _bool(environ, "ENTRA_ID_TOKEN_ALLOW_INSECURE", False)
+
+        self.cosmos_endpoint = _str(environ, "COSMOS_ENDPOINT")
+        self.cosmos_subscription_db = _str(environ, "COSMOS_SUBSCRIPTION_DB", "subscriptions")
+        self.cosmos_subscription_container = _str(environ, "COSMOS_SUBSCRIPTION_CONTAINER", "subscriptions")
+        self.subscription_cache_size = _int(environ, "SUBSCRIPTION_CACHE_SIZE", 500)
+        self.subscription_projection = _bool(environ, "SUBSCRIPTION_PROJECTION", False)
+        self.subscription_extra_fields = _list(environ, "SUBSCRIPTION_EXTRA_FIELDS")
+        self.subscription_id_min_length = _int(environ, "SUBSCRIPTION_ID_MIN_LENGTH", 1)
+        self.subscription_id_max_length = _int(environ, "SUBSCRIPTION_ID_MAX_LENGTH", 256)
+        self.subscription_id_charset = _str(environ, "SUBSCRIPTION_ID_CHARSET")
+        self.subscription_id_checksum = _str(environ, "SUBSCRIPTION_ID_CHECKSUM")
+        if self.subscription_id_checksum is not None and self.subscription_id_checksum.lower() not in _SUBSCRIPTION_ID_CHECKSUMS:
+            raise ValueError(f"SUBSCRIPTION_ID_CHECKSUM must be one of {', '.join(_SUBSCRIPTION_ID_CHECKSUMS)}, but is: {self.subscription_id_checksum}")
+        if self.subscription_id_checksum is not None:
+            self.subscription_id_checksum = self.subscription_id_checksum.lower()
+
+        ## Precompute the values the request path needs
+        self.entra_enabled = self.entra_authority is not None and self.entra_client_id is not None
+        self.entra_issuer = self.entra_authority + "/v2.0" if self.entra_authority is not None else None
+        self.id_token_cookie_secure_attributes = f"Secure; SameSite={self.id_token_same_site};"
+        self.id_token_cookie_suffix = f" Path=/; Max-Age={self.id_token_max_age};"
+        ## alias_for is included so an alias document can never be mistaken for a subscription
+        self.subscription_fields = list(SUBSCRIPTION_FIELDS) + self.subscription_extra_fields + [ "alias_for" ]
+        ## Projecting a point (or batch) read turns it into a query, so by default they read the whole document (and the other fields are dropped after)
+        self.subscription_read_fields = self.subscription_fields if self.subscription_projection else None
+        try:
+            self.subscription_id_pattern = re.compile(f"[{self.subscription_id_charset}]*") if self.subscription_id_charset else None
+        except re.error:
+            raise ValueError(f"SUBSCRIPTION_ID_CHARSET must be the contents of a regex character class (eg. a-zA-Z0-9-), but is: {self.subscription_id_charset}")
+
+    @classmethod
+    def from_env(cls, environ:Mapping[str, str] = None) -> "Settings":
+        return cls(environ)
+
+    def require_entra(self, *names:str):
+        """
+        Raise a RuntimeError if any of the given (ENTRA_*) settings are not set.
+        """
+        for name in names:
+            if getattr(self, name.lower(), None) is None:
+                raise RuntimeError(f"{name} is not set in the environment variables")
+
+
+_SETTINGS = None
+
+def get_settings() -> Settings:
+    """
+    Get the current settings (loaded from the environment on first use).
+    """
+    global _SETTINGS
+    if _SETTINGS is None:
+        _SETTINGS = Settings.from_env()
+    return _SETTINGS
+
+def reload_settings() -> Settings:
+    """
+    Reload the settings from the environment.
+    """
+    global _SETTINGS
+    _SETTINGS = Settings.from_env()
+    return _SETTINGS
+
+def set_settings(settings:Settings):
+    global _SETTINGS
+    _SETTINGS = settings
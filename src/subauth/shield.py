@@ -0,0 +1,202 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from . import metrics
+from .data import Request
+from .settings import Settings, get_settings
+
+SHIELD_MAX_FAILURES = int(os.environ.get('SUBAUTH_SHIELD_MAX_FAILURES', "50"))                # The number of failed subscription lookups a client IP can make per window before it is throttled (0 = disabled)
+SHIELD_WINDOW_SECONDS = float(os.environ.get('SUBAUTH_SHIELD_WINDOW_SECONDS', "60"))          # The length of the (sliding) window
+SHIELD_MAX_CLIENTS = int(os.environ.get('SUBAUTH_SHIELD_MAX_CLIENTS', "10000"))               # The maximum number of client IPs to track the failures of
+SHIELD_TRUSTED_PROXIES = int(os.environ.get('SUBAUTH_SHIELD_TRUSTED_PROXIES', "0"))           # The number of (trusted) proxies in front of the app that append to x-forwarded-for (0 = use the peer address)
+
+THROTTLED_REASON = "Too many failed subscription lookups, try again later"
+
+_LUHN_ALPHABETS = {
+    "luhn": "0123456789",
+    "luhn36": "0123456789abcdefghijklmnopqrstuvwxyz",
+}
+
+
+## Subscription id format
+
+def _luhn_sum(sub_id:str, alphabet:str, double_first:bool) -> int:
+    n = len(alphabet)
+    total = 0
+    double = double_first
+    for ch in reversed(sub_id.lower()):
+        code = alphabet.find(ch)
+        if code == -1:
+            continue    ## Separators (and other characters outside the alphabet) are not part of the checksum
+        addend = code * 2 if double else code
+        total += addend // n + addend % n
+        double = not double
+    return total
+
+def luhn_valid(sub_id:str, checksum:str = "luhn36") -> bool:
+    """
+    Check the (Luhn mod N) check character at the end of the subscription id.
+    """
+    alphabet = _LUHN_ALPHABETS[checksum]
+    return _luhn_sum(sub_id, alphabet, False) % len(alphabet) == 0
+
+def add_checksum(sub_id:str, checksum:str = "luhn36") -> str:
+    """
+    Add a (Luhn mod N) check character to the end of a new subscription id, for use with SUBSCRIPTION_ID_CHECKSUM.
+    """
+    alphabet = _LUHN_ALPHABETS[checksum]
+    n = len(alphabet)
+    return sub_id + alphabet[(n - _luhn_sum(sub_id, alphabet, True) % n) % n]
+
+def valid_subscription_id(sub_id:str, settings:Settings = None) -> bool:
+    """
+    Check that the subscription id could be valid (its length, characters and checksum), before looking it up in the store.
+    """
+    settings = settings if settings is not None else get_settings()
+    if len(sub_id) < settings.subscription_id_min_length or len(sub_id) > settings.subscription_id_max_length:
+        return False
+    if settings.subscription_id_pattern is not None and settings.subscription_id_pattern.fullmatch(sub_id) is None:
+        return False
+    if settings.subscription_id_checksum is not None and not luhn_valid(sub_id, settings.subscription_id_checksum):
+        return False
+    return True
+
+
+## Failed lookups per client IP
+
+class FailureThrottle:
+    """
+    Counts the failed subscription lookups per client IP, and throttles the IPs that fail more than max_failures times in a window.
+
+    Each IP has a sliding window, approximated by the counts of the current and the previous (fixed) windows, so it takes a
+    constant amount of memory. At most max_clients IPs are tracked, the least recently failing ones are dropped first.
+    Checking an IP does not take a lock, only recording a failure does.
+    """
+    max_failures:int
+    window_seconds:float
+    max_clients:int
+
+    def __init__(self, max_failures:int = None, window_seconds:float = None, max_clients:int = None):
+        self.max_failures = max_failures if max_failures is not None else SHIELD_MAX_FAILURES
+        self.window_seconds = window_seconds if window_seconds is not None else SHIELD_WINDOW_SECONDS
+        self.max_clients = max_clients if max_clients is not None else SHIELD_MAX_CLIENTS
+        self._clients:OrderedDict[str, list] = OrderedDict()     ## ip -> [ window start, count in the window, count in the previous window ]
+        self._lock = threading.Lock()
+
+    def _estimate(self, window:list, now:float) -> float:
+        elapsed = now - window[0]
+        if elapsed >= 2 * self.window_seconds:
+            return 0
+        if elapsed >= self.window_seconds:
+            ## The current window has ended (but has not been rolled over yet), so it is now the previous one
+            return window[1] * (1 - (elapsed - self.window_seconds) / self.window_seconds)
+        return window[1] + window[2] * (1 - elapsed / self.window_seconds)
+
+    def is_throttled(self, client_ip:str|None) -> bool:
+        if client_ip is None or self.max_failures <= 0:
+            return False
+        window = self._clients.get(client_ip)
+        if window is None:
+            return False
+        return self._estimate(window, time.monotonic()) >= self.max_failures
+
+    def record_failure(self, client_ip:str|None):
+        if client_ip is None or self.max_failures <= 0:
+            return
+        now = time.monotonic()
+        with self._lock:
+            window = self._clients.get(client_ip)
+            if window is None:
+                if len(self._clients) >= self.max_clients:
+                    self._clients.popitem(last=False)
+                window = self._clients[client_ip] = [ now, 0, 0 ]
+            else:
+                self._clients.move_to_end(client_ip)
+                elapsed = now - window[0]
+                if elapsed >= 2 * self.window_seconds:
+                    window[0], window[1], window[2] = now, 0, 0
+                elif elapsed >= self.window_seconds:
+                    window[0], window[1], window[2] = window[0] + self.window_seconds, 0, window[1]
+            window[1] += 1
+
+    def reset(self, client_ip:str = None):
+        """
+        Forget the failures of the client IP (or of all of them).
+        """
+        with self._lock:
+            if client_ip is None:
+                self._clients.clear()
+            else:
+                self._clients.pop(client_ip, None)
+
+    def __len__(self) -> int:
+        return len(self._clients)
+
+
+_FAILURE_THROTTLE = FailureThrottle()
+
+
+## The client the failures are counted against
+
+def _strip_port(address:str) -> str:
+    if address.startswith("["):
+        return address[1:address.find("]")]     ## [IPv6]:port
+    if address.count(":") == 1:
+        return address.split(":")[0]            ## IPv4:port
+    return address
+
+def client_key(request:Request, trusted_proxies:int = None) -> str|None:
+    """
+    Get the client IP the failed lookups are counted against.
+
+    The x-client-ip and x-forwarded-for headers can be set by anyone (so they can't be used to throttle someone else, or to dodge the throttle),
+    so this is the peer address of the connection, or with trusted_proxies (defaults to SUBAUTH_SHIELD_TRUSTED_PROXIES) the entry of
+    x-forwarded-for appended by the outermost of the trusted proxies. None (ie. not throttled) if neither is known.
+    """
+    trusted_proxies = trusted_proxies if trusted_proxies is not None else SHIELD_TRUSTED_PROXIES
+    if trusted_proxies <= 0:
+        return request.peer_ip
+    forwarded_ips = [ ip.strip() for ip in (request.header("x-forwarded-for") or "").split(",") if ip.strip() ]
+    if len(forwarded_ips) < trusted_proxies:
+        return request.peer_ip     ## Not from (all of) the proxies
+    return _strip_port(forwarded_ips[-trusted_proxies])
+
+
+def get_failure_throttle() -> FailureThrottle:
+    return _FAILURE_THROTTLE
+
+def set_failure_throttle(throttle:FailureThrottle):
+    """
+    Replace the failure throttle (eg. with different limits, or FailureThrottle(max_failures=0) to disable it).
+    """
+    global _FAILURE_THROTTLE
+    _FAILURE_THROTTLE = throttle
+
+def is_throttled(client_ip:str|None) -> bool:
+    """
+    Check if the client IP has had too many failed subscription lookups (and so should be denied before any lookup).
+    """
+    if _FAILURE_THROTTLE.is_throttled(client_ip):
+        if metrics.METRICS_ENABLED:
+            metrics.SHIELD_REJECTIONS.inc("throttled")
+        return True
+    return False
+
+def precheck_subscription_id(sub_id:str, client_ip:str|None) -> bool:
+    """
+    Check that the subscription id could be valid before it is looked up, an invalid id counts as a failed lookup for the client IP.
+    """
+    if valid_subscription_id(sub_id):
+        return True
+    _FAILURE_THROTTLE.record_failure(client_ip)
+    if metrics.METRICS_ENABLED:
+        metrics.SHIELD_REJECTIONS.inc("invalid_format")
+    return False
+
+def record_lookup_failure(client_ip:str|None):
+    """
+    Record that a (well formed) subscription id from the client was not found.
+    """
+    _FAILURE_THROTTLE.record_failure(client_ip)
@@ -1,55 +1,274 @@
-from cachetools import TTLCache
-from .data import Subscription
-from .dataaccess import CosmosDBConnection
+import time
+from typing import TYPE_CHECKING
+from .access_index import AccessIndex
+from .caching import MeteredTTLCache
+from .data import Request, Subscription
+from .dataaccess import AliasIndex, ENTRA_ALIAS, is_alias_doc
+from .settings import get_settings
+from . import timing
 
-_SUBSCRIPTION_CACHE = TTLCache(maxsize=500, ttl=3600)  # 1 hour TTL
-_ENTRA_UN_TO_ID_CACHE = TTLCache(maxsize=500, ttl=86400)  # 24 hours TTL
+if TYPE_CHECKING:
+    from .dataaccess import CosmosDBConnection
+
+_SUBSCRIPTION_CACHE_SIZE = get_settings().subscription_cache_size
+_SUBSCRIPTION_CACHE = MeteredTTLCache("subscription", maxsize=_SUBSCRIPTION_CACHE_SIZE, ttl=3600)  # 1 hour TTL, keyed on the (lower case) subscription id
+_ENTRA_UN_TO_ID_CACHE = MeteredTTLCache("entra_username", maxsize=_SUBSCRIPTION_CACHE_SIZE, ttl=86400)  # 24 hours TTL, Entra username -> subscription id (as stored)
 _COSMOS_DB_CONNECTION = None
+_ALIAS_INDEX = None
+_ACCESS_INDEX:AccessIndex = None
 
-def get_subscription(sub_id: str, entra_user:bool) -> Subscription:
-    """
-    Get a subscription from the cache or create a new one if it doesn't exist.
-    """
-    global _SUBSCRIPTION_CACHE
-    global _ENTRA_UN_TO_ID_CACHE
+def _get_connection() -> "CosmosDBConnection":
     global _COSMOS_DB_CONNECTION
-    lower_sub_id = sub_id.lower()
-    if lower_sub_id in _SUBSCRIPTION_CACHE:
-        return _SUBSCRIPTION_CACHE[lower_sub_id]
-    
-    if entra_user and lower_sub_id in _ENTRA_UN_TO_ID_CACHE:
-        user_sub_id = _ENTRA_UN_TO_ID_CACHE[lower_sub_id]
-        if user_sub_id in _SUBSCRIPTION_CACHE:
-            return _SUBSCRIPTION_CACHE[user_sub_id]
-        
-    # Simulate fetching subscription data from a database or API
     if not _COSMOS_DB_CONNECTION:
-        import os
-        subscription_container_name = os.environ.get('COSMOS_SUBSCRIPTION_CONTAINER', "subscriptions")
-        subscription_db_name = os.environ.get('COSMOS_SUBSCRIPTION_DB', "subscriptions")
-        subscription_endpoint = os.environ.get('COSMOS_ENDPOINT', None)
-        _COSMOS_DB_CONNECTION = CosmosDBConnection(subscription_container_name, subscription_db_name, subscription_endpoint)
-    
+        from .dataaccess import CosmosDBConnection     ## Loaded on first use, to keep the azure SDKs out of the import time
+        settings = get_settings()
+        _COSMOS_DB_CONNECTION = CosmosDBConnection(settings.cosmos_subscription_container, settings.cosmos_subscription_db, settings.cosmos_endpoint)
+    return _COSMOS_DB_CONNECTION
 
-    sub_data = None
-    if entra_user:
-        sub_res = _COSMOS_DB_CONNECTION.get_items_by_query(f"SELECT * FROM c WHERE c.entra_username = '{lower_sub_id}' AND c.is_entra_user = true")
-        if sub_res and len(sub_res) > 0:
-            sub_data = sub_res[0]
-    else:
-        sub_data = _COSMOS_DB_CONNECTION.get_item(lower_sub_id)
-    
-    if not sub_data:
+def _get_alias_index() -> AliasIndex:
+    global _ALIAS_INDEX
+    connection = _get_connection()
+    if _ALIAS_INDEX is None or _ALIAS_INDEX._connection is not connection:
+        _ALIAS_INDEX = AliasIndex(connection)
+    return _ALIAS_INDEX
+
+def _subscription_fields() -> list[str]:
+    """
+    Get the fields of a subscription document that are used (custom fields can be added with SUBSCRIPTION_EXTRA_FIELDS).
+    Queries (eg. scans) always project these fields, as it costs nothing extra.
+    """
+    return get_settings().subscription_fields
+
+def _read_fields() -> list[str]|None:
+    """
+    Get the fields to project on a point (or batch) read, or None to read the whole document.
+    Projecting turns a point read into a query, so this is None unless SUBSCRIPTION_PROJECTION=true.
+    """
+    return get_settings().subscription_read_fields
+
+def _build_subscription(sub_data:dict) -> Subscription:
+    """
+    Build a Subscription from its document, keeping only the subscription fields (so any admin metadata on a whole document is dropped).
+    """
+    return Subscription({ field: sub_data[field] for field in _subscription_fields() if field in sub_data })
+
+def _compile_subscription(sub_data:dict) -> Subscription|None:
+    """
+    Build a Subscription from its document and cache it (under its id).
+    """
+    if not sub_data or is_alias_doc(sub_data):
         return None
-    
-    sub = Subscription(sub_data)
+
+    sub = _build_subscription(sub_data)
     if not sub:
         return None
-    
+
     if sub.is_expired():
         return None
-    
+
+    _SUBSCRIPTION_CACHE[sub.id.lower()] = sub
+    return sub
+
+def get_subscription(sub_id: str, entra_user:bool) -> Subscription:
+    """
+    Get a subscription from the cache or create a new one if it doesn't exist.
+
+    When entra_user is True, the sub_id is the Entra username, which is resolved to the subscription id via the alias index.
+    """
+    lower_sub_id = sub_id.lower()
     if entra_user:
-        _ENTRA_UN_TO_ID_CACHE[lower_sub_id] = sub.id
-    _SUBSCRIPTION_CACHE[lower_sub_id] = sub
-    return sub
\ No newline at end of file
+        return _get_entra_subscription(lower_sub_id)
+    return lookup_subscription(lower_sub_id)[0]
+
+def lookup_subscription(sub_id:str) -> tuple[Subscription|None, bool]:
+    """
+    Get a subscription by id (from the cache, or the store), along with whether it exists at all, so a subscription that has
+    expired (which is not returned) can be told apart from an id that is not known.
+    """
+    lower_sub_id = sub_id.lower()
+    sub = _SUBSCRIPTION_CACHE.get(lower_sub_id)
+    if sub is not None:
+        return sub, True
+
+    if timing.TIMING_ENABLED:
+        start = time.monotonic_ns()
+    sub_data = _get_connection().get_item(lower_sub_id, fields=_read_fields())
+    sub = _compile_subscription(sub_data)
+    if timing.TIMING_ENABLED:
+        timing.record(timing.STORE, start)
+    return sub, sub is not None or (sub_data is not None and not is_alias_doc(sub_data))
+
+def get_subscriptions(sub_ids:list[str]) -> dict[str, Subscription]:
+    """
+    Get many subscriptions at once (eg. to warm the cache), keyed on their (lower case) id.
+
+    The subscriptions that are not already cached are fetched from the store in a few batched round trips, and cached.
+    Subscriptions that do not exist (or have expired, or are invalid) are not included in the result.
+    """
+    res = {}
+    missing = []
+    for sub_id in sub_ids:
+        lower_sub_id = sub_id.lower()
+        if lower_sub_id in res:
+            continue
+        sub = _SUBSCRIPTION_CACHE.get(lower_sub_id)
+        if sub is not None:
+            res[lower_sub_id] = sub
+        else:
+            missing.append(lower_sub_id)
+
+    if missing:
+        for sub_data in _get_connection().get_items_by_ids(list(dict.fromkeys(missing)), fields=_read_fields()):
+            try:
+                sub = _compile_subscription(sub_data)
+            except ValueError:
+                continue    ## Skip invalid subscriptions, they'll fail when they are used
+            if sub is not None:
+                res[sub.id.lower()] = sub
+    return res
+
+def preload_subscriptions(limit:int = None, page_size:int = None) -> int:
+    """
+    Stream the subscriptions from the store (a page at a time) into the cache, up to limit (defaults to the cache size).
+    Returns the number of subscriptions loaded.
+    """
+    limit = limit if limit is not None else _SUBSCRIPTION_CACHE.maxsize
+    count = 0
+    for sub_data in _get_connection().iter_all_items(max_item_count=page_size, fields=_subscription_fields()):
+        if count >= limit:
+            break
+        try:
+            if _compile_subscription(sub_data) is not None:
+                count += 1
+        except ValueError:
+            continue    ## Skip invalid subscriptions, they'll fail when they are used
+    return count
+
+def _get_entra_subscription(username:str) -> Subscription:
+    username = username.strip()
+    user_sub_id = _ENTRA_UN_TO_ID_CACHE.get(username)
+    if user_sub_id is not None:
+        sub = _SUBSCRIPTION_CACHE.get(user_sub_id.lower())
+        if sub is not None:
+            return sub
+
+    if timing.TIMING_ENABLED:
+        start = time.monotonic_ns()
+
+    ## Resolve the username to a subscription id (point read of the alias document)
+    alias_index = _get_alias_index()
+    if user_sub_id is None:
+        user_sub_id = alias_index.resolve(ENTRA_ALIAS, username)
+
+    sub_data = None
+    if user_sub_id is not None:
+        sub = _SUBSCRIPTION_CACHE.get(user_sub_id.lower())
+        if sub is not None:
+            _ENTRA_UN_TO_ID_CACHE[username] = user_sub_id
+            return sub
+
+        ## Cosmos ids are case sensitive, so read the id as it is stored in the alias (only the cache keys are lower case)
+        sub_data = _get_connection().get_item(user_sub_id, fields=_read_fields())
+        ## Make sure the alias is not stale (eg. the subscription has since been given to another user)
+        if sub_data is not None and (not sub_data.get("is_entra_user", False) or (sub_data.get("entra_username", None) or "").strip().lower() != username):
+            sub_data = None
+
+    if sub_data is None and get_settings().entra_alias_query_fallback:
+        ## No (valid) alias yet, so fall back to querying for the subscription, and then add the alias for next time
+        sub_data = alias_index.find_entra_subscription(username, _subscription_fields())
+        if sub_data is not None:
+            alias_index.put(ENTRA_ALIAS, username, sub_data["id"])
+
+    sub = _compile_subscription(sub_data)
+    if timing.TIMING_ENABLED:
+        timing.record(timing.STORE, start)
+    if sub is None:
+        return None
+
+    _ENTRA_UN_TO_ID_CACHE[username] = sub.id
+    return sub
+
+
+def save_subscription(sub_data:dict) -> Subscription:
+    """
+    Create or update a subscription document, keeping its aliases up to date.
+    The subscription is validated before it is saved.
+    """
+    sub = Subscription(sub_data)
+    connection = _get_connection()
+    previous = connection.get_item(sub_data["id"])
+    connection.upsert_item(sub_data)
+    _get_alias_index().sync_subscription(sub_data, previous)
+    invalidate_subscription(sub.id)
+    if _ACCESS_INDEX is not None:
+        _ACCESS_INDEX.add(sub)
+    return sub
+
+def delete_subscription(sub_id:str):
+    """
+    Delete a subscription document and its aliases.
+    """
+    connection = _get_connection()
+    previous = connection.get_item(sub_id)
+    if previous is None or is_alias_doc(previous):
+        return
+    _get_alias_index().remove_subscription(previous)
+    connection.delete_item(previous["id"])
+    invalidate_subscription(sub_id)
+    if _ACCESS_INDEX is not None:
+        _ACCESS_INDEX.remove(sub_id)
+
+def rebuild_subscription_aliases() -> int:
+    """
+    (Re)create the alias documents for all the Entra user subscriptions.
+    Returns the number of aliases written.
+    """
+    return _get_alias_index().rebuild()
+
+def invalidate_subscription(sub_id:str):
+    """
+    Remove a subscription (and any aliases pointing at it) from the cache.
+    """
+    lower_sub_id = sub_id.lower()
+    _SUBSCRIPTION_CACHE.pop(lower_sub_id, None)
+    for username, user_sub_id in list(_ENTRA_UN_TO_ID_CACHE.items()):
+        if user_sub_id.lower() == lower_sub_id:
+            _ENTRA_UN_TO_ID_CACHE.pop(username, None)
+
+
+def build_access_index(page_size:int = None) -> AccessIndex:
+    """
+    Build the reverse index of all the subscriptions in the store (by the hosts, paths and methods they allow), streaming them a page at a time.
+    The index is kept up to date by save_subscription(...) and delete_subscription(...), use refresh_access_index(...) for changes made directly in the store.
+    """
+    global _ACCESS_INDEX
+    index = AccessIndex()
+    for sub_data in _get_connection().iter_all_items(max_item_count=page_size, fields=_subscription_fields()):
+        if is_alias_doc(sub_data):
+            continue
+        try:
+            index.add(Subscription(sub_data))
+        except ValueError:
+            continue    ## Skip invalid subscriptions, they can't allow anything
+    _ACCESS_INDEX = index
+    return index
+
+def refresh_access_index(sub_id:str):
+    """
+    Reload a subscription into the access index (or remove it, if it no longer exists).
+    """
+    if _ACCESS_INDEX is None:
+        return
+    sub_data = _get_connection().get_item(sub_id, fields=_read_fields())
+    if sub_data is None or is_alias_doc(sub_data):
+        _ACCESS_INDEX.remove(sub_id)
+    else:
+        _ACCESS_INDEX.add(_build_subscription(sub_data))
+
+def find_subscriptions_with_access(host:str, path:str, method:str = "GET", caller:Request = None) -> list[Subscription]:
+    """
+    Find the subscriptions that allow requests to the host and path (with the method), eg. to answer "who can access app.foo.com/api/users".
+    The access index is built on first use (see build_access_index), and only the candidate subscriptions it finds are evaluated.
+    """
+    index = _ACCESS_INDEX if _ACCESS_INDEX is not None else build_access_index()
+    return index.find(host, path, method, caller)
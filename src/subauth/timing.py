@@ -0,0 +1,113 @@
+import contextvars
+import os
+import time
+from typing import Callable
+
+TIMING_ENABLED = os.environ.get('SUBAUTH_STAGE_TIMING', "false").lower() == "true"            # Time the stages of each auth check
+SERVER_TIMING_ENABLED = os.environ.get('SUBAUTH_SERVER_TIMING', "false").lower() == "true"    # Add a Server-Timing header (with the stage timings) to the responses
+
+## The stages of an auth check
+CONVERT = "convert"     # Converting the framework request to a Request
+LOOKUP = "lookup"       # Finding the subscription for the request (includes store, jwt and jwks)
+STORE = "store"         # Loading a subscription that is not in the cache (includes cosmos)
+COSMOS = "cosmos"       # A CosmosDB call (including its retries)
+JWT = "jwt"             # Verifying an Entra ID token (includes jwks)
+JWKS = "jwks"           # Fetching the token signing keys
+RULES = "rules"         # Evaluating the rules of the subscription
+TOTAL = "total"         # The whole auth check
+
+_TRACE = contextvars.ContextVar("subauth_stage_trace", default=None)
+_HOOKS:list[Callable[[str, int, int], None]] = []
+
+## The (approximate) offset from the monotonic clock to the epoch, for converting the stage start times (eg. for OpenTelemetry spans)
+_EPOCH_OFFSET_NS = time.time_ns() - time.monotonic_ns()
+
+
+class StageTrace:
+    """
+    The stage timings of one auth check, as (stage, start, duration) - the times are monotonic nanoseconds.
+    """
+    started_ns:int
+    stages:list[tuple[str, int, int]]
+
+    def __init__(self):
+        self.started_ns = time.monotonic_ns()
+        self.stages = []
+
+    def durations(self) -> dict[str, int]:
+        """
+        The total duration (ns) of each stage, in the order they were first recorded.
+        """
+        durations = {}
+        for stage, _, duration in self.stages:
+            durations[stage] = durations.get(stage, 0) + duration
+        return durations
+
+    def server_timing(self) -> str:
+        """
+        The stage timings as a Server-Timing header value, eg. "convert;dur=0.021, lookup;dur=1.204, rules;dur=0.015".
+        """
+        return ", ".join(f"{stage};dur={duration / 1e6:.3f}" for stage, duration in self.durations().items())
+
+
+def set_timing_enabled(enabled:bool, server_timing:bool = None):
+    """
+    Enable or disable the stage timers (and, optionally, the Server-Timing header). Both are disabled by default,
+    or set SUBAUTH_STAGE_TIMING=true (and SUBAUTH_SERVER_TIMING=true).
+    """
+    global TIMING_ENABLED, SERVER_TIMING_ENABLED
+    TIMING_ENABLED = enabled
+    if server_timing is not None:
+        SERVER_TIMING_ENABLED = server_timing
+
+def add_stage_hook(hook:Callable[[str, int, int], None]):
+    """
+    Call the hook with (stage, start_ns, duration_ns) as each stage completes (eg. to create OpenTelemetry spans, or feed a profiler).
+    The times are monotonic nanoseconds - use to_epoch_ns() to convert a start time to a wall clock time.
+    A hook must be fast, and must not raise.
+    """
+    _HOOKS.append(hook)
+
+def remove_stage_hook(hook:Callable[[str, int, int], None]):
+    if hook in _HOOKS:
+        _HOOKS.remove(hook)
+
+def to_epoch_ns(monotonic_ns:int) -> int:
+    return monotonic_ns + _EPOCH_OFFSET_NS
+
+def start_trace() -> StageTrace:
+    """
+    Start recording the stages of an auth check (in the current context).
+    """
+    trace = StageTrace()
+    _TRACE.set(trace)
+    return trace
+
+def finish_trace(trace:StageTrace) -> StageTrace:
+    """
+    Stop recording the stages, and record the total time of the auth check.
+    """
+    record(TOTAL, trace.started_ns)
+    _TRACE.set(None)
+    return trace
+
+def current_trace() -> StageTrace|None:
+    return _TRACE.get()
+
+def record(stage:str, start_ns:int):
+    """
+    Record a stage that started at the given time.monotonic_ns() value and has just completed.
+    Only call this when TIMING_ENABLED, eg:
+
+        if timing.TIMING_ENABLED:
+            start = time.monotonic_ns()
+        ...
+        if timing.TIMING_ENABLED:
+            timing.record(timing.RULES, start)
+    """
+    duration = time.monotonic_ns() - start_ns
+    trace = _TRACE.get()
+    if trace is not None:
+        trace.stages.append((stage, start_ns, duration))
+    for hook in _HOOKS:
+        hook(stage, start_ns, duration)
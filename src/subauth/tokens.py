@@ -0,0 +1,73 @@
+import hashlib
+import os
+import threading
+import time
+from typing import Callable
+from .caching import MeteredTLRUCache
+
+TOKEN_CACHE_SIZE = int(os.environ.get('ENTRA_TOKEN_CACHE_SIZE', "1000"))
+TOKEN_CACHE_MAX_TTL_SECONDS = float(os.environ.get('ENTRA_TOKEN_CACHE_MAX_TTL_SECONDS', "3600"))   # Cached claims are re-verified at least this often, even if the token is valid for longer
+
+
+def _claims_expiry(key:bytes, claims:dict[str, any], now:float) -> float:
+    """
+    Cache the claims until the token expires (capped at TOKEN_CACHE_MAX_TTL_SECONDS).
+    """
+    expiry = now + TOKEN_CACHE_MAX_TTL_SECONDS
+    exp = claims.get("exp", None)
+    if isinstance(exp, (int, float)):
+        expiry = min(expiry, float(exp))
+    return expiry
+
+## Keyed on the digest of the token (so the tokens themselves are not kept in memory), the wall clock is used to compare with the exp claim
+_TOKEN_CACHE = MeteredTLRUCache("token", maxsize=TOKEN_CACHE_SIZE, ttu=_claims_expiry, timer=time.time)
+_IN_FLIGHT = {}
+_IN_FLIGHT_LOCK = threading.Lock()
+
+
+def _token_key(token:str) -> bytes:
+    return hashlib.sha256(token.encode("utf-8")).digest()
+
+def get_cached_claims(token:str) -> dict[str, any]|None:
+    """
+    Get the claims of a token that has already been verified (and has not expired), or None.
+    """
+    if TOKEN_CACHE_SIZE <= 0:
+        return None
+    return _TOKEN_CACHE.get(_token_key(token))
+
+def verify_and_cache(token:str, verify:Callable[[str], dict[str, any]|None]) -> dict[str, any]|None:
+    """
+    Verify a token (with the given verify function, which returns its claims) and cache the claims.
+
+    Concurrent calls for the same token are collapsed, so only the first verifies it (the others wait for, and use, its result).
+    Failed verifications (a None result, or an exception) are not cached.
+    """
+    if TOKEN_CACHE_SIZE <= 0:
+        return verify(token)
+
+    key = _token_key(token)
+    with _IN_FLIGHT_LOCK:
+        flight = _IN_FLIGHT.get(key, None)
+        if flight is None:
+            flight = _IN_FLIGHT[key] = [ threading.Lock(), 0 ]
+        flight[1] += 1
+
+    try:
+        with flight[0]:
+            ## Verified while we were waiting?
+            claims = _TOKEN_CACHE.get(key)
+            if claims is not None:
+                return claims
+            claims = verify(token)
+            if claims is not None:
+                _TOKEN_CACHE[key] = claims
+            return claims
+    finally:
+        with _IN_FLIGHT_LOCK:
+            flight[1] -= 1
+            if flight[1] == 0:
+                _IN_FLIGHT.pop(key, None)
+
+def clear_token_cache():
+    _TOKEN_CACHE.clear()
@@ -0,0 +1,154 @@
+import base64
+import json
+import os
+import time
+from abc import ABC, abstractmethod
+from typing import Callable
+
+JWT_BACKEND = os.environ.get('ENTRA_JWT_BACKEND', "auto").lower()     # jose, cryptography or auto (cryptography, if it is installed)
+JWT_LEEWAY_SECONDS = float(os.environ.get('ENTRA_JWT_LEEWAY_SECONDS', "0"))
+
+_VERIFIER = None
+
+
+class TokenVerifier(ABC):
+    """
+    Verifies the signature and the claims of an (RS256) JWT.
+
+    Keys are prepared (eg. parsed into a public key object) once, with prepare_key, when the keys are loaded.
+    verify raises the python-jose exceptions (ExpiredSignatureError, JWTClaimsError or JWTError) for an invalid token, whichever backend is used.
+    """
+    name:str = "base"
+
+    @abstractmethod
+    def prepare_key(self, jwk:dict[str, any]) -> any:
+        pass
+
+    @abstractmethod
+    def verify(self, token:str, get_key:Callable[[str], any], audience:str, issuer:str) -> dict[str, any]|None:
+        """
+        Verify the token with the (prepared) key returned by get_key for its kid, and return its claims.
+        Returns None if there is no key for the kid.
+        """
+        pass
+
+
+class JoseVerifier(TokenVerifier):
+    """
+    Verifies tokens with python-jose (using pre-constructed key objects).
+    """
+    name = "jose"
+
+    def prepare_key(self, jwk:dict[str, any]) -> any:
+        from jose import jwk as jose_jwk
+        return jose_jwk.construct(jwk, "RS256")
+
+    def verify(self, token:str, get_key:Callable[[str], any], audience:str, issuer:str) -> dict[str, any]|None:
+        from jose import jwt
+        key = get_key(jwt.get_unverified_header(token).get("kid", None))
+        if key is None:
+            return None
+        return jwt.decode(token, key, algorithms=["RS256"], audience=audience, issuer=issuer, options={ "leeway": JWT_LEEWAY_SECONDS })
+
+
+def _b64decode(segment:str) -> bytes:
+    return base64.urlsafe_b64decode(segment + "=" * (-len(segment) % 4))
+
+def _b64int(segment:str) -> int:
+    return int.from_bytes(_b64decode(segment), "big")
+
+
+class CryptographyVerifier(TokenVerifier):
+    """
+    Verifies tokens with the cryptography package directly, which avoids most of python-jose's per-token overhead.
+    Performs the same checks as JoseVerifier: the RS256 signature, exp, nbf, iat, the audience and the issuer.
+    """
+    name = "cryptography"
+
+    def __init__(self):
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.primitives.asymmetric import padding
+        from cryptography.exceptions import InvalidSignature
+        self._hash = hashes.SHA256()
+        self._padding = padding.PKCS1v15()
+        self._invalid_signature = InvalidSignature
+
+    def prepare_key(self, jwk:dict[str, any]) -> any:
+        from cryptography.hazmat.primitives.asymmetric.rsa import RSAPublicNumbers
+        if jwk.get("kty", None) != "RSA":
+            raise ValueError(f"Unsupported key type: {jwk.get('kty', None)}")
+        return RSAPublicNumbers(_b64int(jwk["e"]), _b64int(jwk["n"])).public_key()
+
+    def verify(self, token:str, get_key:Callable[[str], any], audience:str, issuer:str) -> dict[str, any]|None:
+        from jose.exceptions import JWTError, ExpiredSignatureError, JWTClaimsError
+
+        try:
+            header_segment, claims_segment, signature_segment = token.split(".")
+            header = json.loads(_b64decode(header_segment))
+            signature = _b64decode(signature_segment)
+        except Exception:
+            raise JWTError("Invalid token")
+        if header.get("alg", None) != "RS256":
+            raise JWTError("The specified alg value is not allowed")
+
+        key = get_key(header.get("kid", None))
+        if key is None:
+            return None
+        try:
+            key.verify(signature, (header_segment + "." + claims_segment).encode("ascii"), self._padding, self._hash)
+        except self._invalid_signature:
+            raise JWTError("Signature verification failed.")
+
+        try:
+            claims = json.loads(_b64decode(claims_segment))
+        except Exception:
+            raise JWTError("Invalid payload")
+        if not isinstance(claims, dict):
+            raise JWTError("Invalid payload")
+
+        now = time.time()
+        for claim in ("exp", "nbf", "iat"):
+            if claim in claims and not isinstance(claims[claim], (int, float)):
+                raise JWTClaimsError(f"Invalid {claim} claim")
+        if "nbf" in claims and claims["nbf"] > now + JWT_LEEWAY_SECONDS:
+            raise JWTClaimsError("The token is not yet valid (nbf)")
+        if "exp" in claims and claims["exp"] < now - JWT_LEEWAY_SECONDS:
+            raise ExpiredSignatureError("Signature has expired.")
+
+        aud = claims.get("aud", None)
+        auds = aud if isinstance(aud, list) else [ aud ]
+        if audience is not None and audience not in auds:
+            raise JWTClaimsError("Invalid audience")
+        if issuer is not None and claims.get("iss", None) != issuer:
+            raise JWTClaimsError("Invalid issuer")
+        return claims
+
+
+def create_verifier(backend:str = "auto") -> TokenVerifier:
+    """
+    Create a verifier for the given backend (jose, cryptography, or auto to use cryptography if it is installed).
+    """
+    backend = backend.lower()
+    if backend == "jose":
+        return JoseVerifier()
+    if backend == "cryptography":
+        return CryptographyVerifier()
+    if backend == "auto":
+        try:
+            return CryptographyVerifier()
+        except ImportError:
+            return JoseVerifier()
+    raise ValueError(f"Unknown JWT verification backend: {backend}")
+
+def get_verifier() -> TokenVerifier:
+    """
+    Get the (shared) verifier for the configured backend (ENTRA_JWT_BACKEND).
+    """
+    global _VERIFIER
+    if _VERIFIER is None:
+        _VERIFIER = create_verifier(JWT_BACKEND)
+    return _VERIFIER
+
+def set_verifier(verifier:TokenVerifier):
+    global _VERIFIER
+    _VERIFIER = verifier
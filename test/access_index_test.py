@@ -0,0 +1,153 @@
+import sys
+import os
+import random
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+
+from subauth import ratelimit, sub_factory
+from subauth.access_index import AccessIndex
+from subauth.data import Request, Subscription
+from subauth.ratelimit import LocalRateLimiter
+
+
+def _sub(sub_id:str, *rules:dict) -> Subscription:
+    return Subscription({ "id": sub_id, "name": sub_id, "expiry": -1, "rules": list(rules) })
+
+def _hosts(*hosts:str, allow:bool = True) -> dict:
+    return { "name": "hosts", "type": "host", "hosts": list(hosts), "allow": allow }
+
+def _paths(*paths:str, allow:bool = True) -> dict:
+    return { "name": "paths", "type": "path", "paths": list(paths), "allow": allow }
+
+def _methods(*methods:str) -> dict:
+    return { "name": "methods", "type": "method", "methods": list(methods) }
+
+
+class StubConnection:
+    def __init__(self, docs:list[dict]):
+        self.docs = { doc["id"]: doc for doc in docs }
+
+    def iter_all_items(self, max_item_count:int = None, continuation_token:str = None, fields:list[str] = None):
+        return iter(list(self.docs.values()))
+
+    def get_item(self, id:str, fields:list[str] = None) -> dict:
+        return self.docs.get(id)
+
+
+class TestAccessIndex(unittest.TestCase):
+    def setUp(self):
+        self.index = AccessIndex([
+            _sub("exact", _hosts("app.foo.com"), _paths("/api/users")),
+            _sub("suffix", _hosts("*.foo.com"), _paths("/api/*")),
+            _sub("prefix", _hosts("app.*"), _methods("POST")),
+            _sub("regex", _hosts("regex(.*\\.foo\\.com)")),
+            _sub("middle", _hosts("app.*.foo.com")),
+            _sub("other", _hosts("bar.com"), _paths("/api/*")),
+            _sub("deny-admin", _hosts("app.foo.com"), _paths("/admin/*", allow=False)),
+            _sub("all", { "name": "all", "type": "allow-all" }),
+        ])
+
+    def test_candidates(self):
+        candidates = self.index.candidates("app.foo.com", "/api/users", "GET")
+        self.assertNotIn("other", candidates)
+        self.assertNotIn("prefix", candidates)      ## POST only
+        self.assertTrue({ "exact", "suffix", "regex", "middle", "deny-admin", "all" } <= candidates)
+
+        self.assertEqual(self.index.candidates("bar.com", "/api/x", "GET"), { "other", "regex", "middle", "all" })
+
+    def test_find(self):
+        self.assertEqual([ sub.id for sub in self.index.find("app.foo.com", "/api/users") ], [ "all", "deny-admin", "exact", "regex", "suffix" ])
+        self.assertEqual([ sub.id for sub in self.index.find("app.foo.com", "/admin/x") ], [ "all", "regex" ])
+        self.assertEqual([ sub.id for sub in self.index.find("app.test.foo.com", "/other", "POST") ], [ "all", "middle", "prefix", "regex" ])
+
+    def test_incremental_updates(self):
+        self.index.add(_sub("new", _hosts("new.foo.com")))
+        self.assertIn("new", [ sub.id for sub in self.index.find("new.foo.com", "/") ])
+
+        ## Replacing a subscription removes its old entries
+        self.index.add(_sub("new", _hosts("renamed.foo.com")))
+        self.assertNotIn("new", self.index.candidates("new.foo.com", "/"))
+        self.assertIn("new", self.index.candidates("renamed.foo.com", "/"))
+
+        self.index.remove("NEW")
+        self.assertNotIn("new", self.index)
+        self.assertNotIn("new", self.index.candidates("renamed.foo.com", "/"))
+        self.assertEqual(len(self.index), 8)
+
+    def test_caller_and_rate_rules(self):
+        ratelimit.set_rate_limiter(LocalRateLimiter())
+        try:
+            index = AccessIndex([
+                _sub("keyed", _hosts("app.foo.com"), { "name": "key", "type": "header", "header": "x-key", "values": [ "secret" ] }),
+                _sub("limited", _hosts("app.foo.com"), { "name": "rate", "type": "rate", "limit": 1, "period": 3600 }),
+            ])
+            ## The caller rules are assumed to match, and the rate rules are not used up
+            for _ in range(3):
+                self.assertEqual([ sub.id for sub in index.find("app.foo.com", "/") ], [ "keyed", "limited" ])
+
+            ## Unless there is a caller to check them against
+            self.assertEqual([ sub.id for sub in index.find("app.foo.com", "/", caller=Request("GET", "x", "/", { "x-key": "wrong" })) ], [ "limited" ])
+            self.assertEqual([ sub.id for sub in index.find("app.foo.com", "/", caller=Request("GET", "x", "/", { "x-key": "secret" })) ], [ "keyed", "limited" ])
+        finally:
+            ratelimit.set_rate_limiter(None)
+
+    def test_matches_full_evaluation(self):
+        rng = random.Random(7)
+        hosts = [ "app.foo.com", "api.foo.com", "x.bar.com", "bar.com", "app.test" ]
+        paths = [ "/", "/api/users", "/api/orders/1", "/admin/x", "/static/app.js" ]
+        host_patterns = hosts + [ "*.foo.com", "*.com", "app.*", "regex(api\\..*)" ]
+        path_patterns = paths + [ "/api/*", "*.js", "/admin/*", "regex(/api/orders/\\d+)" ]
+        subs = []
+        for i in range(300):
+            rules = []
+            if rng.random() < 0.9:
+                rules.append(_hosts(*rng.sample(host_patterns, rng.randint(1, 3))))
+            if rng.random() < 0.6:
+                rules.append(_paths(*rng.sample(path_patterns, rng.randint(1, 3)), allow=rng.random() < 0.8))
+            if rng.random() < 0.3:
+                rules.append(_methods(*rng.sample([ "GET", "POST", "PUT" ], rng.randint(1, 2))))
+            subs.append(_sub(f"sub-{i}", *(rules or [ { "name": "all", "type": "allow-all" } ])))
+        index = AccessIndex(subs)
+
+        for host in hosts:
+            for path in paths:
+                for method in ( "GET", "POST" ):
+                    expected = sorted(sub.id for sub in subs if sub.is_allowed(Request(method, host, path, {}))[0])
+                    self.assertEqual(sorted(sub.id for sub in index.find(host, path, method)), expected, (host, path, method))
+
+
+class TestSubFactoryAccessIndex(unittest.TestCase):
+    def setUp(self):
+        self.connection = StubConnection([
+            { "id": "sub-1", "name": "Sub 1", "expiry": -1, "rules": [ _hosts("app.foo.com") ] },
+            { "id": "sub-2", "name": "Sub 2", "expiry": -1, "rules": [ _hosts("bar.com") ] },
+            { "id": "alias:entra:user@foo.com", "alias_for": "sub-1" },
+        ])
+        sub_factory._COSMOS_DB_CONNECTION = self.connection
+
+    def tearDown(self):
+        sub_factory._COSMOS_DB_CONNECTION = None
+        sub_factory._ACCESS_INDEX = None
+
+    def test_build_and_refresh(self):
+        self.assertEqual([ sub.id for sub in sub_factory.find_subscriptions_with_access("app.foo.com", "/") ], [ "sub-1" ])
+        self.assertEqual(len(sub_factory._ACCESS_INDEX), 2)
+
+        self.connection.docs["sub-2"]["rules"] = [ _hosts("*.foo.com") ]
+        sub_factory.refresh_access_index("sub-2")
+        self.assertEqual([ sub.id for sub in sub_factory.find_subscriptions_with_access("app.foo.com", "/") ], [ "sub-1", "sub-2" ])
+
+        del self.connection.docs["sub-1"]
+        sub_factory.refresh_access_index("sub-1")
+        self.assertEqual([ sub.id for sub in sub_factory.find_subscriptions_with_access("app.foo.com", "/") ], [ "sub-2" ])
+
+    def test_refresh_mixed_case_id(self):
+        sub_factory.build_access_index()
+        self.connection.docs["Sub-3"] = { "id": "Sub-3", "name": "Sub 3", "expiry": -1, "rules": [ _hosts("app.foo.com") ] }
+        sub_factory.refresh_access_index("Sub-3")
+        self.assertEqual([ sub.id for sub in sub_factory.find_subscriptions_with_access("app.foo.com", "/") ], [ "Sub-3", "sub-1" ])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,188 @@
+import sys
+import os
+import base64
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+
+import azure.functions as func
+from starlette.requests import Request as StarletteRequest
+
+from subauth import core, session, settings, sub_factory
+from subauth.data import Request
+from subauth.dataaccess import StoreUnavailableError
+from subauth import function_utils, fastapi_utils
+
+
+def _request(path:str = "/api/test", headers:dict[str, str] = None, host:str = "app.test") -> Request:
+    return Request("GET", host, path, headers if headers is not None else {})
+
+def _function_request(url:str, headers:dict[str, str]) -> func.HttpRequest:
+    return func.HttpRequest("GET", url, headers=headers, body=b"", route_params={})
+
+def _fastapi_request(path:str, headers:dict[str, str], client:tuple[str, int] = ("10.0.0.9", 1234)) -> StarletteRequest:
+    return StarletteRequest({
+        "type": "http",
+        "method": "GET",
+        "scheme": "https",
+        "server": ("app.test", 443),
+        "path": path,
+        "query_string": b"",
+        "headers": [ (k.lower().encode(), v.encode()) for k, v in headers.items() ],
+        "client": client,
+    })
+
+
+class TestCorePipeline(unittest.TestCase):
+    def setUp(self):
+        settings.set_settings(settings.Settings({}))
+        session.set_signing_keys([])
+        sub_factory._SUBSCRIPTION_CACHE.clear()
+        sub_factory._compile_subscription({ "id": "sub-1", "name": "Sub 1", "expiry": -1, "browserstore": False, "rules": [ { "name": "hosts", "type": "host", "hosts": [ "app.test" ] } ] })
+        sub_factory._compile_subscription({ "id": "sub-2", "name": "Sub 2", "expiry": -1, "browserstore": True, "rules": [ { "name": "all", "type": "allow-all" } ] })
+
+    def tearDown(self):
+        settings.set_settings(None)
+        sub_factory._SUBSCRIPTION_CACHE.clear()
+
+    def test_credential_sources(self):
+        self.assertEqual(core.get_subscription_id(_request(headers={ "subscription": "Bearer sub-1" })), "sub-1")
+        self.assertEqual(core.get_subscription_id(_request("/api/test?subscription=sub-1")), "sub-1")
+        self.assertEqual(core.get_subscription_id(_request(headers={ "Cookie": "x-subscription=sub-1" })), "sub-1")
+        self.assertIsNone(core.get_subscription_id(_request()))
+
+        ## The token is trimmed of any cookie attributes that were sent with it
+        self.assertEqual(core.get_id_token(_request(headers={ "authorization": "Bearer abc.def.ghi; Path=/" })), "abc.def.ghi")
+
+    def test_client_ip(self):
+        self.assertEqual(core.resolve_client_ip({ "x-forwarded-for": "1.2.3.4, 5.6.7.8" }), "1.2.3.4")
+        self.assertEqual(core.resolve_client_ip({ "x-client-ip": "ignore" }, "9.9.9.9"), "9.9.9.9")
+        self.assertIsNone(core.resolve_client_ip({}))
+
+    def test_allowed(self):
+        decision = core.authorize(_request(headers={ "subscription": "sub-1" }))
+        self.assertTrue(decision.allowed)
+        self.assertEqual(decision.subscription.id, "sub-1")
+        self.assertIsNone(decision.headers)
+
+        ## A subscription stored in the browser is sent back as a cookie
+        decision = core.authorize(_request(headers={ "subscription": "sub-2" }))
+        self.assertIn("subscription=sub-2", dict(decision.headers)["Set-Cookie"])
+
+    def test_not_allowed(self):
+        decision = core.authorize(_request(headers={ "subscription": "sub-1" }, host="other.test"))
+        self.assertFalse(decision.allowed)
+        self.assertEqual(decision.subscription.id, "sub-1")
+        self.assertIsNotNone(decision.reason)
+        templates = core.get_response_templates()
+        self.assertEqual(dict(templates.denied_headers(decision.reason)), { "x-reason": decision.reason })
+        self.assertEqual(dict(templates.denied_headers(decision.reason, include_reason=False)), {})
+
+        decision = core.authorize(_request())
+        self.assertFalse(decision.allowed)
+        self.assertIsNone(decision.subscription)
+
+    def test_store_unavailable(self):
+        class UnavailableConnection:
+            def get_item(self, id:str, partitionKey:str = None, fields:list[str] = None):
+                raise StoreUnavailableError("The circuit breaker is open")
+        sub_factory._COSMOS_DB_CONNECTION = UnavailableConnection()
+        try:
+            decision = core.authorize(_request(headers={ "subscription": "sub-3" }))
+            self.assertFalse(decision.allowed)
+            self.assertEqual(decision.reason, core.STORE_UNAVAILABLE_REASON)
+
+            ## Cached subscriptions are still allowed
+            self.assertTrue(core.authorize(_request(headers={ "subscription": "sub-1" })).allowed)
+        finally:
+            sub_factory._COSMOS_DB_CONNECTION = None
+
+    def test_response_templates(self):
+        templates = core.ResponseTemplates(allow_methods="GET", max_age=60, allow_credentials=False)
+        headers = templates.cors_preflight_headers("https://web.test")
+        self.assertEqual(headers["Access-Control-Allow-Origin"], "https://web.test")
+        self.assertEqual(headers["Access-Control-Allow-Methods"], "GET")
+        self.assertEqual(headers["Access-Control-Max-Age"], "60")
+        self.assertNotIn("Access-Control-Allow-Credentials", headers)
+        self.assertEqual(templates.cors_preflight_headers(None)["Access-Control-Allow-Origin"], "*")
+
+        ## The headers are built once, and can't be changed
+        self.assertIs(templates.cors_preflight_headers("https://web.test"), headers)
+        self.assertIs(templates.denied_headers("No"), templates.denied_headers("No"))
+        with self.assertRaises(TypeError):
+            headers["Access-Control-Allow-Origin"] = "*"
+
+    def test_rules_request(self):
+        request = _request(headers={ "subscription": "sub-1" })
+        decision = core.authorize(request, _request(headers={ "subscription": "sub-1" }, host="other.test"))
+        self.assertFalse(decision.allowed)
+
+    def test_auth_state(self):
+        settings.set_settings(settings.Settings({ "ENTRA_STATE_REDIRECT_PATH_PREFIX": "/app" }))
+        state = core.auth_state("/api/app/home", {})
+        self.assertEqual(base64.urlsafe_b64decode(state).decode(), "/app/home")
+
+    def test_adapters_agree(self):
+        headers = { "Host": "app.test", "subscription": "sub-1", "x-forwarded-for": "1.2.3.4" }
+        from_function = function_utils.function_req_to_request(_function_request("https://app.test/api/test", headers))
+        from_fastapi = fastapi_utils.fastapi_req_to_request(_fastapi_request("/api/test", headers))
+        for request in (from_function, from_fastapi):
+            self.assertEqual(request.host, "app.test")
+            self.assertEqual(request.path(), "/api/test")
+            self.assertEqual(request.client_ip, "1.2.3.4")
+
+        allowed, sub, response = function_utils.validate_function_request(_function_request("https://app.test/api/test", headers))
+        self.assertTrue(allowed)
+        self.assertIsNone(response)
+        allowed, sub, response = fastapi_utils.validate_function_request(_fastapi_request("/api/test", headers))
+        self.assertTrue(allowed)
+        self.assertIsNone(response)
+
+        ## Only FastAPI knows the peer address
+        self.assertEqual(fastapi_utils.fastapi_req_to_request(_fastapi_request("/api/test", { "Host": "app.test" })).client_ip, "10.0.0.9")
+
+    def test_adapters_return_headers(self):
+        headers = { "Host": "app.test", "subscription": "sub-2" }
+        allowed, _, response = function_utils.validate_function_request(_function_request("https://app.test/api/test", headers))
+        self.assertEqual(response.status_code, 0)
+        self.assertIn("subscription=sub-2", response.headers["Set-Cookie"])
+
+        allowed, _, cookie_headers = function_utils.validate_function_request(_function_request("https://app.test/api/test", headers), return_headers=True)
+        self.assertTrue(allowed)
+        self.assertEqual(cookie_headers[0][0], "Set-Cookie")
+        allowed, _, cookie_headers = fastapi_utils.validate_function_request(_fastapi_request("/api/test", headers), return_headers=True)
+        self.assertTrue(allowed)
+        self.assertIn("subscription=sub-2", cookie_headers[0][1])
+
+        templates = core.ResponseTemplates(preflight_body="", allow_methods="GET")
+        preflight = func.HttpRequest("OPTIONS", "https://app.test/api/test", headers={ "Origin": "https://web.test" }, body=b"")
+        allowed, _, response = function_utils.validate_function_request(preflight, templates=templates)
+        self.assertEqual(response.headers["Access-Control-Allow-Methods"], "GET")
+        self.assertEqual(response.headers["Access-Control-Allow-Origin"], "https://web.test")
+
+    def test_adapters_deny_with_the_reason(self):
+        headers = { "Host": "other.test", "subscription": "sub-1" }
+        allowed, _, response = function_utils.validate_function_request(_function_request("https://other.test/api/test", headers))
+        self.assertFalse(allowed)
+        self.assertEqual(response.status_code, 401)
+        self.assertIn("x-reason", response.headers)
+        allowed, _, response = fastapi_utils.validate_function_request(_fastapi_request("/api/test", headers))
+        self.assertFalse(allowed)
+        self.assertEqual(response.status_code, 401)
+        self.assertIn("x-reason", response.headers)
+
+    def test_validate_request(self):
+        to_request = lambda override_path = None, disguised_hosts = True: _request(override_path or "/api/test", { "subscription": "sub-1" }, "other.test")
+        allowed, sub, response, headers = core.validate_request(to_request(), to_request, lambda redirect_url: "unused", default_fail_status=403)
+        self.assertFalse(allowed)
+        self.assertEqual(sub.id, "sub-1")
+        self.assertEqual(response[0], 403)
+        self.assertIn("x-reason", response[2])
+        self.assertIsNone(headers)
+
+        allowed, _, response, _ = core.validate_request(None, to_request, lambda redirect_url: "unused")
+        self.assertEqual(response[0], 400)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,202 @@
+import sys
+import os
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+
+from azure.cosmos.errors import CosmosClientTimeoutError, CosmosHttpResponseError
+from subauth.dataaccess import CosmosDBConnection, cosmosdb
+from subauth.dataaccess.cosmosdb import select_clause
+from subauth.dataaccess.fake_cosmos import FakeContainerProxy
+from subauth.dataaccess.resilience import CircuitBreaker, RetryBudget, StoreUnavailableError
+
+class BatchReadContainer:
+    """
+    A container client stand-in that only supports batched reads.
+    """
+    def __init__(self, docs:list[dict]):
+        self.docs = { doc["id"]: doc for doc in docs }
+        self.calls = []
+
+    def read_items(self, items:list[tuple[str, str]], **kwargs):
+        self.calls.append(len(items))
+        return [ self.docs[item_id] for item_id, _ in items if item_id in self.docs ]
+
+
+class FlakyContainer:
+    """
+    A container client stand-in that fails the first few reads with the given status code.
+    """
+    def __init__(self, failures:int, status_code:int = 429, retry_after_ms:str = "10"):
+        self.failures = failures
+        self.status_code = status_code
+        self.retry_after_ms = retry_after_ms
+        self.calls = 0
+
+    def read_item(self, item:str, partition_key:str, **kwargs):
+        self.calls += 1
+        if self.calls <= self.failures:
+            e = CosmosHttpResponseError(status_code=self.status_code, message="Failed")
+            e.headers = { "x-ms-retry-after-ms": self.retry_after_ms }
+            raise e
+        return { "id": item }
+
+
+class PagedQueryContainer:
+    """
+    A container client stand-in whose queries return pages of results, with the page index as the continuation token.
+    The first page fetch fails if fail_once is set.
+    """
+    class Pager:
+        def __init__(self, docs:list[dict], page_size:int, token:str):
+            self.docs = docs
+            self.page_size = page_size
+            self.index = int(token) if token else 0
+            self.continuation_token = token
+
+        def __iter__(self):
+            return self
+
+        def __next__(self):
+            if self.index * self.page_size >= len(self.docs):
+                raise StopIteration
+            page = self.docs[self.index * self.page_size:(self.index + 1) * self.page_size]
+            self.index += 1
+            self.continuation_token = str(self.index) if self.index * self.page_size < len(self.docs) else None
+            return iter(page)
+
+    def __init__(self, docs:list[dict], fail_once:bool = False):
+        self.docs = docs
+        self.fail_once = fail_once
+        self.queries = []
+
+    def query_items(self, query:str, max_item_count:int, **kwargs):
+        self.queries.append(query)
+        container = self
+        class Paged:
+            def by_page(self, token:str = None):
+                if container.fail_once:
+                    container.fail_once = False
+                    raise CosmosHttpResponseError(status_code=503, message="Failed")
+                return PagedQueryContainer.Pager(container.docs, max_item_count, token)
+        return Paged()
+
+
+def _connection(container, failure_threshold:int = 5) -> CosmosDBConnection:
+    connection = CosmosDBConnection.__new__(CosmosDBConnection)
+    connection._container = "test"
+    connection._container_client = container
+    connection._breaker = CircuitBreaker(failure_threshold, 60)
+    connection._retry_budget = RetryBudget()
+    return connection
+
+
+class TestCosmosDBConnection(unittest.TestCase):
+    def setUp(self):
+        self.container = BatchReadContainer([ { "id": str(i) } for i in range(0, 2500) ])
+        self.connection = _connection(self.container)
+
+    def test_get_items_by_ids_chunks(self):
+        ids = [ str(i) for i in range(0, 3000) ]
+        items = self.connection.get_items_by_ids(ids, chunk_size=1000, max_parallelism=2)
+        self.assertEqual(len(items), 2500)
+        self.assertEqual(sorted(self.container.calls), [ 1000, 1000, 1000 ])
+
+    def test_get_items_by_ids_empty(self):
+        self.assertEqual(self.connection.get_items_by_ids([]), [])
+        self.assertEqual(self.container.calls, [])
+
+    def test_retry_throttled_read(self):
+        container = FlakyContainer(2)
+        self.assertEqual(_connection(container).get_item("abc"), { "id": "abc" })
+        self.assertEqual(container.calls, 3)
+
+    def test_retry_after_beyond_deadline(self):
+        container = FlakyContainer(1, retry_after_ms="60000")
+        with self.assertRaises(CosmosHttpResponseError):
+            _connection(container).get_item("abc")
+        self.assertEqual(container.calls, 1)
+
+    def test_circuit_breaker_fails_fast(self):
+        container = FlakyContainer(100, status_code=503)
+        connection = _connection(container, failure_threshold=2)
+        for _ in range(0, 2):
+            with self.assertRaises(CosmosHttpResponseError):
+                connection.get_item("abc")
+        calls = container.calls
+        with self.assertRaises(StoreUnavailableError):
+            connection.get_item("abc")
+        self.assertEqual(container.calls, calls)
+
+    def test_not_found_is_healthy(self):
+        container = FlakyContainer(100, status_code=404)
+        connection = _connection(container, failure_threshold=1)
+        self.assertRaises(CosmosHttpResponseError, connection.get_item, "abc")
+        self.assertEqual(connection._breaker.state, "closed")
+        self.assertEqual(container.calls, 1)
+
+
+class TestRetryBudget(unittest.TestCase):
+    def test_budget_exhausted(self):
+        budget = RetryBudget(ratio=0.5, min_tokens=1)
+        self.assertTrue(budget.try_spend())
+        self.assertFalse(budget.try_spend())
+        budget.record_call()
+        budget.record_call()
+        self.assertTrue(budget.try_spend())
+
+
+class TestCosmosDBPagedQueries(unittest.TestCase):
+    def setUp(self):
+        self.container = PagedQueryContainer([ { "id": str(i) } for i in range(0, 25) ])
+        self.connection = _connection(self.container)
+
+    def test_iter_all_items(self):
+        self.assertEqual(len(list(self.connection.iter_all_items(max_item_count=10))), 25)
+        self.assertNotIn("ORDER BY", self.container.queries[0])
+
+    def test_pages_and_resume(self):
+        pages = self.connection.iter_item_pages("SELECT * FROM c", max_item_count=10)
+        items, token = next(pages)
+        self.assertEqual(len(items), 10)
+        self.assertEqual(token, "1")
+        resumed = list(self.connection.iter_item_pages("SELECT * FROM c", max_item_count=10, continuation_token=token))
+        self.assertEqual([ len(items) for items, _ in resumed ], [ 10, 5 ])
+        self.assertIsNone(resumed[-1][1])
+
+    def test_failed_page_is_retried(self):
+        container = PagedQueryContainer([ { "id": str(i) } for i in range(0, 5) ], fail_once=True)
+        self.assertEqual(len(list(_connection(container).iter_all_items())), 5)
+        self.assertEqual(len(container.queries), 2)
+
+
+    def test_query_is_retried_per_page(self):
+        container = PagedQueryContainer([ { "id": str(i) } for i in range(0, 250) ], fail_once=True)
+        self.assertEqual(len(_connection(container).get_items_by_query("SELECT * FROM c")), 250)
+        ## The failed first page, then the query is restarted (from the continuation token) for each of the 3 pages
+        self.assertEqual(len(container.queries), 4)
+
+    def test_query_page_deadline(self):
+        slept = []
+        container = FakeContainerProxy([ { "id": str(i) } for i in range(0, 250) ], latency="fixed:500", sleep=slept.append)
+        timeout_ms = cosmosdb.REQUEST_TIMEOUT_MS
+        cosmosdb.REQUEST_TIMEOUT_MS = 100
+        try:
+            with self.assertRaises(CosmosClientTimeoutError):
+                _connection(container).get_items_by_query("SELECT * FROM c")
+            self.assertEqual(len(slept), 1)
+            self.assertLessEqual(slept[0], 0.1)
+
+            ## Each page is given its own deadline
+            cosmosdb.REQUEST_TIMEOUT_MS = 1000
+            self.assertEqual(len(_connection(container).get_items_by_query("SELECT * FROM c")), 250)
+            self.assertEqual(slept[1:], [ 0.5, 0.5, 0.5 ])
+        finally:
+            cosmosdb.REQUEST_TIMEOUT_MS = timeout_ms
+
+
+class TestSelectClause(unittest.TestCase):
+    def test_select_clause(self):
+        self.assertEqual(select_clause(None), "SELECT * FROM c")
+        self.assertEqual(select_clause([ "id", "name" ]), "SELECT c.id, c.name FROM c")
+        self.assertRaises(ValueError, select_clause, [ "id FROM c; --" ])
@@ -0,0 +1,75 @@
+import sys
+import os
+import threading
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+
+import azure.functions as func
+
+from subauth import decision_log, metrics, settings, sub_factory, timing
+from subauth import function_utils
+
+
+def _function_request(url:str, headers:dict[str, str]) -> func.HttpRequest:
+    return func.HttpRequest("GET", url, headers={ "host": url.split("/")[2], **headers }, body=b"", route_params={})
+
+
+class TestDecisionLog(unittest.TestCase):
+    def setUp(self):
+        settings.set_settings(settings.Settings({}))
+        sub_factory._SUBSCRIPTION_CACHE.clear()
+        sub_factory._compile_subscription({ "id": "sub-1", "name": "Sub 1", "expiry": -1, "browserstore": False, "rules": [ { "name": "hosts", "type": "host", "hosts": [ "app.test" ] } ] })
+        metrics.REGISTRY.reset()
+        self.events = []
+        self.logger = decision_log.DecisionLogger(self.events.append)
+        decision_log.set_decision_logger(self.logger)
+        decision_log.set_decision_log_enabled(True, 1.0, 1.0)
+
+    def tearDown(self):
+        decision_log.set_decision_log_enabled(False, 0.01, 1.0)
+        decision_log.set_decision_logger(None)
+        timing.set_timing_enabled(False, False)
+        settings.set_settings(None)
+        sub_factory._SUBSCRIPTION_CACHE.clear()
+
+    def test_decision_events(self):
+        timing.set_timing_enabled(True)
+        function_utils.validate_function_request(_function_request("https://app.test/api/test", { "subscription": "sub-1" }))
+        function_utils.validate_function_request(_function_request("https://other.test/api/test?x=1", { "subscription": "sub-1" }))
+        self.assertTrue(self.logger.flush(5))
+
+        allowed, denied = self.events
+        self.assertEqual((allowed["subscription_id"], allowed["outcome"], allowed["deny_rule"]), ("sub-1", "allow", None))
+        self.assertEqual(list(allowed["stages"].keys()), [ "convert", "lookup", "rules", "total" ])
+        self.assertEqual((denied["outcome"], denied["deny_rule"], denied["host"], denied["path"]), ("deny", "HostCheck", "other.test", "/api/test"))
+        self.assertNotIn("sub-1", str([ value for key, value in denied.items() if key != "subscription_id" ]))
+
+    def test_sampling(self):
+        decision_log.set_decision_log_enabled(True, 0.0, 1.0)
+        function_utils.validate_function_request(_function_request("https://app.test/api/test", { "subscription": "sub-1" }))
+        function_utils.validate_function_request(_function_request("https://app.test/api/test", {}))
+        self.assertTrue(self.logger.flush(5))
+        self.assertEqual([ (event["outcome"], event["subscription_id"], event["sample_rate"]) for event in self.events ], [ ("deny", None, 1.0) ])
+
+    def test_full_queue_drops(self):
+        release = threading.Event()
+        logger = decision_log.DecisionLogger(lambda event: release.wait(5), queue_size=2)
+        results = [ logger.emit({ "n": n }) for n in range(10) ]
+        release.set()
+        self.assertTrue(logger.flush(5))
+
+        ## The writer takes one event off the queue (and blocks), so at most 3 are accepted
+        self.assertLessEqual(results.count(True), 3)
+        self.assertEqual(logger.dropped, results.count(False))
+        self.assertEqual(metrics.DECISION_LOG_DROPPED.value(), logger.dropped)
+
+    def test_deny_rule(self):
+        self.assertEqual(decision_log.deny_rule("Request does not match ALLOW rule PathCheck"), "PathCheck")
+        self.assertEqual(decision_log.deny_rule("Request matches DENY rule MethodCheck"), "MethodCheck")
+        self.assertIsNone(decision_log.deny_rule("Subscription has expired"))
+        self.assertIsNone(decision_log.deny_rule(None))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+import sys
+import os
+import asyncio
+import threading
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+
+from subauth import entra
+
+
+class StubApp:
+    created = 0
+
+    def __init__(self, **kwargs):
+        StubApp.created += 1
+        self.kwargs = kwargs
+
+
+class TestMsalAppCache(unittest.TestCase):
+    def setUp(self):
+        entra.clear_msal_apps()
+        StubApp.created = 0
+        self.patch = mock.patch("msal.ConfidentialClientApplication", StubApp)
+        self.patch.start()
+
+    def tearDown(self):
+        self.patch.stop()
+        entra.clear_msal_apps()
+
+    def test_app_is_created_once(self):
+        app = entra.get_msal_app("https://login/tenant", "client", "secret", "app")
+        self.assertIs(entra.get_msal_app("https://login/tenant", "client", "secret", "app"), app)
+        self.assertEqual(StubApp.created, 1)
+        self.assertEqual(app.kwargs["authority"], "https://login/tenant")
+
+    def test_apps_are_keyed_on_the_registration(self):
+        app = entra.get_msal_app("https://login/tenant", "client", "secret", "app")
+        self.assertIsNot(entra.get_msal_app("https://login/tenant", "client", "rotated-secret", "app"), app)
+        self.assertIsNot(entra.get_msal_app("https://login/other", "client", "secret", "app"), app)
+        self.assertEqual(StubApp.created, 3)
+
+    def test_concurrent_first_use(self):
+        apps = []
+        threads = [ threading.Thread(target=lambda: apps.append(entra.get_msal_app("https://login/tenant", "client", "secret", "app"))) for _ in range(0, 8) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(StubApp.created, 1)
+        self.assertTrue(all(app is apps[0] for app in apps))
+
+    def test_tokens_are_not_kept(self):
+        app = entra.get_msal_app("https://login/tenant", "client", "secret", "app")
+        cache = app.kwargs["token_cache"]
+        cache.add({ "client_id": "client", "scope": [ "User.Read" ], "token_endpoint": "https://login/tenant/token", "response": { "access_token": "x" } })
+        self.assertEqual(list(cache.search(cache.CredentialType.ACCESS_TOKEN)), [])
+
+
+class SlowApp:
+    """
+    An MSAL app stand-in whose code redemption takes delay seconds.
+    """
+    def __init__(self, delay:float):
+        self.delay = delay
+
+    def acquire_token_by_authorization_code(self, code:str, scopes:list[str], redirect_uri:str):
+        time.sleep(self.delay)
+        return { "id_token": "token-for-" + code }
+
+
+class TestAsyncRedemption(unittest.TestCase):
+    def test_redemption(self):
+        result = asyncio.run(entra.redeem_auth_code_async("abc", [ "User.Read" ], "https://app/cb", app=SlowApp(0.01)))
+        self.assertEqual(result["id_token"], "token-for-abc")
+        self.assertEqual(entra._REDEMPTION_PENDING, 0)
+
+    def test_event_loop_is_not_blocked(self):
+        async def run():
+            ticks = []
+            async def tick():
+                for _ in range(0, 5):
+                    ticks.append(time.monotonic())
+                    await asyncio.sleep(0.01)
+            await asyncio.gather(entra.redeem_auth_code_async("abc", [], "https://app/cb", app=SlowApp(0.1)), tick())
+            return ticks
+        ticks = asyncio.run(run())
+        self.assertEqual(len(ticks), 5)
+        self.assertLess(ticks[-1] - ticks[0], 0.09)
+
+    def test_deadline(self):
+        with self.assertRaises(asyncio.TimeoutError):
+            asyncio.run(entra.redeem_auth_code_async("abc", [], "https://app/cb", timeout=0.01, app=SlowApp(0.1)))
+
+    def test_overload(self):
+        max_pending = entra.REDEMPTION_MAX_PENDING
+        entra.REDEMPTION_MAX_PENDING = 2
+        try:
+            async def run():
+                return await asyncio.gather(*[ entra.redeem_auth_code_async(str(i), [], "https://app/cb", app=SlowApp(0.05)) for i in range(0, 3) ], return_exceptions=True)
+            results = asyncio.run(run())
+            self.assertEqual(sum(1 for result in results if isinstance(result, entra.RedemptionOverloadedError)), 1)
+            self.assertEqual(sum(1 for result in results if isinstance(result, dict)), 2)
+        finally:
+            entra.REDEMPTION_MAX_PENDING = max_pending
+
+    def test_timed_out_redemptions_are_released(self):
+        from concurrent.futures import ThreadPoolExecutor
+        executor, max_pending = entra._REDEMPTION_EXECUTOR, entra.REDEMPTION_MAX_PENDING
+        entra._REDEMPTION_EXECUTOR = ThreadPoolExecutor(max_workers=1)
+        entra.REDEMPTION_MAX_PENDING = 3
+        try:
+            async def run():
+                return await asyncio.gather(*[ entra.redeem_auth_code_async(str(i), [], "https://app/cb", timeout=0.02, app=SlowApp(0.05)) for i in range(0, 3) ], return_exceptions=True)
+            ## The queued redemptions are cancelled, and the one in flight is released when it is done
+            for _ in range(0, 3):
+                results = asyncio.run(run())
+                self.assertTrue(all(isinstance(result, asyncio.TimeoutError) for result in results), results)
+                entra._REDEMPTION_EXECUTOR.submit(lambda: None).result()
+                self.assertEqual(entra._REDEMPTION_PENDING, 0)
+        finally:
+            entra._REDEMPTION_EXECUTOR.shutdown()
+            entra._REDEMPTION_EXECUTOR, entra.REDEMPTION_MAX_PENDING = executor, max_pending
+
+
+if __name__ == '__main__':
+    unittest.main()
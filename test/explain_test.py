@@ -0,0 +1,100 @@
+import sys
+import os
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+
+from subauth import explain, ratelimit
+from subauth.ratelimit import LocalRateLimiter
+from subauth.data import Request, Subscription
+
+
+def _subscription() -> Subscription:
+    return Subscription({
+        "id": "sub-1",
+        "name": "Sub 1",
+        "expiry": -1,
+        "rules": [
+            { "name": "hosts", "type": "host", "hosts": [ "foo.org", "*.example.com", "regex(api[\\d]\\.test)" ] },
+            { "name": "admin", "type": "path", "paths": [ "/admin/*" ], "allow": False },
+            { "name": "methods", "type": "method", "methods": [ "GET", "POST" ] },
+        ]
+    })
+
+
+class TestExplain(unittest.TestCase):
+    def setUp(self):
+        self.sub = _subscription()
+        explain.reset_explain_stats()
+
+    def tearDown(self):
+        explain.set_explain_sample_rate(0)
+        explain.reset_explain_stats()
+
+    def test_explain_allowed(self):
+        explanation = self.sub.explain(Request("GET", "app.example.com", "/api/test", {}))
+        self.assertTrue(explanation.allowed)
+        self.assertEqual(explanation.reason, "OK")
+        self.assertEqual([ (rule.type, rule.pattern, rule.outcome) for rule in explanation.rules ], [
+            ("HostCheck", "*.example.com", "allow"),
+            ("PathCheck", None, "allow"),
+            ("MethodCheck", "GET", "allow"),
+        ])
+        self.assertTrue(all(rule.duration_ns >= 0 for rule in explanation.rules))
+        self.assertGreaterEqual(explanation.duration_ns, sum(rule.duration_ns for rule in explanation.rules))
+        self.assertIsNotNone(explanation.slowest())
+
+    def test_explain_denied(self):
+        request = Request("DELETE", "api1.test", "/admin/users", {})
+        explanation = self.sub.explain(request)
+        self.assertEqual((explanation.allowed, explanation.reason), self.sub.is_allowed(request))
+        self.assertEqual([ (rule.pattern, rule.outcome) for rule in explanation.rules ], [ ("regex(api[\\d]\\.test)", "allow"), ("/admin/*", "deny") ])
+
+        ## The rest of the rules can be evaluated too
+        explanation = self.sub.explain(request, evaluate_all=True)
+        self.assertEqual(explanation.reason, "Request matches DENY rule PathCheck")
+        self.assertEqual([ rule.outcome for rule in explanation.rules ], [ "allow", "deny", "deny" ])
+        self.assertEqual(explanation.to_dict()["rules"][2]["type"], "MethodCheck")
+
+    def test_sampled_aggregate(self):
+        self.assertTrue(self.sub.is_allowed(Request("GET", "foo.org", "/", {}))[0])
+        self.assertIsNone(explain.get_explain_stats("sub-1"))   ## Not sampled by default
+
+        explain.set_explain_sample_rate(1.0)
+        self.assertTrue(self.sub.is_allowed(Request("GET", "foo.org", "/", {}))[0])
+        self.assertTrue(self.sub.is_allowed(Request("POST", "foo.org", "/", {}))[0])
+        self.assertEqual(self.sub.is_allowed(Request("GET", "bar.org", "/", {})), (False, "Request does not match ALLOW rule HostCheck"))
+
+        stats = explain.get_explain_stats("sub-1")
+        self.assertEqual((stats["samples"], stats["allowed"]), (3, 2))
+        hosts, admin, methods = stats["rules"]
+        self.assertEqual((hosts["evaluations"], hosts["matches"], hosts["denies"]), (3, 2, 1))
+        self.assertEqual(hosts["patterns"], { "foo.org": 2 })
+        self.assertEqual(admin["evaluations"], 2)
+        self.assertEqual(methods["patterns"], { "GET": 1, "POST": 1 })
+        self.assertGreaterEqual(hosts["max_ns"], hosts["mean_ns"])
+        self.assertEqual(len(explain.get_explain_stats()), 1)
+
+    def test_explain_does_not_use_rate_limits(self):
+        ratelimit.set_rate_limiter(LocalRateLimiter())
+        try:
+            sub = Subscription({ "id": "sub-2", "name": "Sub 2", "expiry": -1, "rules": [
+                { "name": "hosts", "type": "host", "hosts": [ "bar.org" ] },
+                { "name": "rate", "type": "rate", "limit": 1, "period": 3600 },
+            ] })
+            request = Request("GET", "foo.org", "/", {})
+            for _ in range(3):
+                explanation = sub.explain(request, evaluate_all=True)
+                self.assertEqual([ rule.outcome for rule in explanation.rules ], [ "deny", "skipped" ])
+
+            ## The (sampled) decisions still take their tokens
+            explain.set_explain_sample_rate(1.0)
+            request = Request("GET", "bar.org", "/", {})
+            self.assertEqual([ sub.is_allowed(request)[0] for _ in range(2) ], [ True, False ])
+            self.assertEqual(explain.get_explain_stats("sub-2")["rules"][1]["evaluations"], 2)
+        finally:
+            ratelimit.set_rate_limiter(None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+import sys
+import os
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+
+from azure.cosmos.exceptions import CosmosHttpResponseError, CosmosClientTimeoutError
+from subauth.dataaccess import CosmosDBConnection
+from subauth.dataaccess.fake_cosmos import FakeContainerProxy, LatencyModel, register_fake_container, clear_fake_containers
+import random
+
+DOCS = [
+    { "id": "sub1", "name": "One", "is_entra_user": True, "entra_username": "one@test.com", "rules": [] },
+    { "id": "sub2", "name": "Two", "is_entra_user": False, "rules": [] },
+    { "id": "sub3", "name": "Three", "is_entra_user": True, "entra_username": "three@test.com", "rules": [] },
+]
+
+
+class TestFakeContainerProxy(unittest.TestCase):
+    def setUp(self):
+        self.fake = FakeContainerProxy(DOCS, seed=1)
+        register_fake_container("subscriptions", self.fake)
+        self.connection = CosmosDBConnection("subscriptions", "subscriptions")
+
+    def tearDown(self):
+        clear_fake_containers()
+
+    def test_connection_is_served_by_the_fake(self):
+        self.assertIs(self.connection._container_client, self.fake)
+        self.assertEqual(self.connection.get_item("sub2")["name"], "Two")
+        self.assertIsNone(self.connection.get_item("missing"))
+
+    def test_projected_read(self):
+        self.assertEqual(self.connection.get_item("sub1", fields=["id", "name"]), { "id": "sub1", "name": "One" })
+
+    def test_queries(self):
+        res = self.connection.get_items_by_query(
+            "SELECT c.id FROM c WHERE c.is_entra_user = true AND c.entra_username = @username",
+            parameters=[ { "name": "@username", "value": "three@test.com" } ],
+        )
+        self.assertEqual(res, [ { "id": "sub3" } ])
+        self.assertEqual(len(self.connection.get_item_list(["sub1", "sub2", "nope"])), 2)
+        with self.assertRaises(ValueError):
+            self.connection.get_items_by_query("SELECT VALUE COUNT(1) FROM c")
+
+    def test_paging(self):
+        pages = list(self.connection.iter_item_pages("SELECT * FROM c", max_item_count=2))
+        self.assertEqual([ len(items) for items, _ in pages ], [ 2, 1 ])
+        self.assertIsNone(pages[-1][1])
+        resumed = list(self.connection.iter_item_pages("SELECT * FROM c", max_item_count=2, continuation_token=pages[0][1]))
+        self.assertEqual([ item["id"] for item in resumed[0][0] ], [ "sub3" ])
+
+    def test_writes(self):
+        self.connection.upsert_item({ "id": "sub4", "name": "Four" })
+        self.assertEqual(self.connection.get_item("sub4")["name"], "Four")
+        self.connection.delete_item("sub4")
+        self.assertIsNone(self.connection.get_item("sub4"))
+        self.assertEqual(self.fake.calls["upsert_item"], 1)
+
+    def test_throttling(self):
+        slept = []
+        self.fake.throttle_rate = 1.0
+        self.fake._sleep = slept.append
+        with self.assertRaises(CosmosHttpResponseError) as e:
+            self.fake.read_item("sub1", "sub1")
+        self.assertEqual(e.exception.status_code, 429)
+        self.assertEqual(e.exception.headers["x-ms-retry-after-ms"], "100")
+
+        ## The connection retries the throttled reads (after the retry-after delay) before giving up
+        self.fake.retry_after_ms = 5
+        self.fake.reset_stats()
+        with self.assertRaises(CosmosHttpResponseError):
+            self.connection.get_item("sub1")
+        self.assertEqual(self.fake.calls["read_item"], 3)
+
+    def test_timeout(self):
+        slept = []
+        fake = FakeContainerProxy(DOCS, latency="fixed:50", sleep=slept.append)
+        with self.assertRaises(CosmosClientTimeoutError):
+            fake.read_item("sub1", "sub1", timeout=0.01)
+        self.assertEqual(slept, [ 0.01 ])
+        self.assertEqual(fake.read_item("sub1", "sub1", timeout=1)["id"], "sub1")
+        self.assertEqual(slept, [ 0.01, 0.05 ])
+
+    def test_latency_models(self):
+        rng = random.Random(1)
+        self.assertEqual(LatencyModel("fixed:5").sample_ms(rng), 5)
+        self.assertTrue(2 <= LatencyModel("uniform:2:10").sample_ms(rng) <= 10)
+        self.assertTrue(LatencyModel("lognormal:4:0.6").sample_ms(rng) > 0)
+        self.assertEqual(LatencyModel().sample_ms(rng), 0)
+        with self.assertRaises(ValueError):
+            LatencyModel("pareto:1")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,27 @@
+import sys
+import os
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../benchmarks')))
+
+from import_time import measure_import
+
+class TestImportTime(unittest.TestCase):
+    def test_package_import_is_light(self):
+        res = measure_import("import subauth")
+        self.assertEqual(res["loaded"], [])
+        self.assertLess(res["ms"], 500)
+
+    def test_rule_engine_import_is_light(self):
+        res = measure_import("from subauth import Subscription, Request, create_rule")
+        self.assertEqual(res["loaded"], [])
+
+    def test_store_is_loaded_on_first_use(self):
+        res = measure_import("from subauth import get_subscription")
+        self.assertNotIn("azure.cosmos", res["loaded"])
+        self.assertNotIn("azure.identity", res["loaded"])
+
+    def test_adapter_does_not_load_other_adapter(self):
+        res = measure_import("from subauth import function_utils")
+        self.assertNotIn("fastapi", res["loaded"])
+        self.assertNotIn("azure.cosmos", res["loaded"])
@@ -0,0 +1,151 @@
+import sys
+import os
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+
+from subauth.jwks import JwksKeyManager
+
+
+class FakeResponse:
+    def __init__(self, keys:list[dict]):
+        self.keys = keys
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return { "keys": self.keys }
+
+
+class FakeSession:
+    """
+    A requests.Session stand-in that serves the current set of keys (or fails if they are None).
+    """
+    def __init__(self, kids:list[str], delay:float = 0):
+        self.kids = kids
+        self.delay = delay
+        self.calls = 0
+        self.timeouts = []
+
+    def get(self, url:str, timeout = None):
+        self.calls += 1
+        self.timeouts.append(timeout)
+        if self.delay:
+            time.sleep(self.delay)
+        if self.kids is None:
+            raise ConnectionError("Failed")
+        return FakeResponse([ { "kid": kid, "kty": "RSA" } for kid in self.kids ])
+
+
+class TestJwksKeyManager(unittest.TestCase):
+    def test_keys_are_fetched_once_with_a_timeout(self):
+        session = FakeSession(["a", "b"])
+        manager = JwksKeyManager("https://login/keys", session=session)
+        self.assertEqual(manager.get_key("a")["kid"], "a")
+        self.assertEqual(manager.get_key("b")["kid"], "b")
+        self.assertEqual(session.calls, 1)
+        self.assertIsNotNone(session.timeouts[0])
+
+    def test_unknown_kid_refetch_is_rate_limited(self):
+        session = FakeSession(["a"])
+        manager = JwksKeyManager("https://login/keys", min_refetch_interval=60, session=session)
+        manager.get_key("a")
+
+        ## Key rollover
+        session.kids = ["a", "b"]
+        manager._attempted_at -= 61
+        self.assertEqual(manager.get_key("b")["kid"], "b")
+        self.assertEqual(session.calls, 2)
+
+        ## An unknown kid only triggers one refetch per interval
+        self.assertIsNone(manager.get_key("zzz"))
+        self.assertIsNone(manager.get_key("zzz"))
+        self.assertEqual(session.calls, 2)
+
+    def test_expired_keys_are_refetched_and_kept_on_failure(self):
+        session = FakeSession(["a"])
+        manager = JwksKeyManager("https://login/keys", ttl=10, refresh_ahead=0, session=session)
+        manager.get_key("a")
+        manager._fetched_at -= 11
+        session.kids = None
+        self.assertEqual(manager.get_key("a")["kid"], "a")
+        self.assertEqual(session.calls, 2)
+
+    def test_initial_failure_raises(self):
+        manager = JwksKeyManager("https://login/keys", session=FakeSession(None))
+        with self.assertRaises(RuntimeError):
+            manager.get_key("a")
+
+    def test_background_refresh(self):
+        session = FakeSession(["a"])
+        manager = JwksKeyManager("https://login/keys", ttl=100, refresh_ahead=10, session=session)
+        manager.get_key("a")
+        manager._fetched_at -= 95
+        session.kids = ["a", "b"]
+        self.assertEqual(manager.get_key("a")["kid"], "a")  ## Served from the current keys
+        for _ in range(0, 100):
+            if session.calls == 2 and not manager._refreshing:
+                break
+            time.sleep(0.01)
+        self.assertEqual(session.calls, 2)
+        self.assertIn("b", manager._keys)
+
+    def test_concurrent_fetches_are_collapsed(self):
+        session = FakeSession(["a"], delay=0.05)
+        manager = JwksKeyManager("https://login/keys", session=session)
+        threads = [ threading.Thread(target=manager.get_key, args=("a",)) for _ in range(0, 8) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(session.calls, 1)
+
+    def _get_keys_concurrently(self, manager:JwksKeyManager, count:int) -> list:
+        results = [ None ] * count
+        def get_key(i:int):
+            try:
+                results[i] = manager.get_key("a")
+            except RuntimeError as e:
+                results[i] = e
+        threads = [ threading.Thread(target=get_key, args=(i,)) for i in range(0, count) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_failed_refetch_backs_off(self):
+        session = FakeSession(["a"], delay=0.02)
+        manager = JwksKeyManager("https://login/keys", ttl=10, refresh_ahead=0, min_refetch_interval=60, session=session)
+        manager.get_key("a")
+        manager._fetched_at -= 11
+        session.kids = None
+
+        ## The waiting requests use the outcome of the failed fetch, and the stale keys are served until the interval has passed
+        results = self._get_keys_concurrently(manager, 10)
+        self.assertTrue(all(result["kid"] == "a" for result in results))
+        self.assertEqual(session.calls, 2)
+        self.assertEqual(manager.get_key("a")["kid"], "a")
+        self.assertEqual(session.calls, 2)
+
+        session.kids = ["a", "b"]
+        manager._failed_at -= 61
+        self.assertEqual(manager.get_key("b")["kid"], "b")
+        self.assertEqual(session.calls, 3)
+
+    def test_failed_initial_fetch_backs_off(self):
+        session = FakeSession(None, delay=0.02)
+        manager = JwksKeyManager("https://login/keys", min_refetch_interval=60, session=session)
+        results = self._get_keys_concurrently(manager, 10)
+        self.assertTrue(all(isinstance(result, RuntimeError) for result in results))
+        self.assertEqual(session.calls, 1)
+        with self.assertRaises(RuntimeError):
+            manager.get_key("a")
+        self.assertEqual(session.calls, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
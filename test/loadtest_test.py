@@ -0,0 +1,52 @@
+import sys
+import os
+import random
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../benchmarks')))
+
+import loadtest
+from subauth import shield, sub_factory
+from subauth.dataaccess.fake_cosmos import clear_fake_containers
+
+class TestLoadTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = sub_factory._SUBSCRIPTION_CACHE
+        self.throttle = shield.get_failure_throttle()
+
+    def tearDown(self):
+        clear_fake_containers()
+        sub_factory._COSMOS_DB_CONNECTION = None
+        sub_factory._SUBSCRIPTION_CACHE = self.cache
+        shield.set_failure_throttle(self.throttle)
+
+    def test_corpus_follows_the_rule_mix(self):
+        docs = loadtest.generate_corpus(1000, { "host": 0.8, "large": 0.2 }, seed=3)
+        self.assertEqual(len(docs), 1000)
+        large = sum(1 for doc in docs if len(doc["rules"]) > 1)
+        self.assertTrue(150 < large < 250, large)
+
+    def test_stream_is_skewed(self):
+        sample = loadtest.zipf_sampler(1000, 1.1, random.Random(1))
+        ranks = [ sample() for _ in range(10000) ]
+        self.assertGreater(ranks.count(0), ranks.count(10) * 5)
+        self.assertTrue(all(0 <= rank < 1000 for rank in ranks))
+
+    def test_percentiles(self):
+        res = loadtest.percentiles([ i * 1000000 for i in range(1, 1001) ])
+        self.assertEqual(res["p50_ms"], 500)
+        self.assertEqual(res["p99_ms"], 990)
+        self.assertEqual(res["max_ms"], 1000)
+
+    def test_run(self):
+        for adapter in loadtest.ADAPTERS:
+            res = loadtest.run(subscriptions=200, requests=500, adapter=adapter, concurrency=2, cache_size=50, deny_ratio=0.1, unknown_ratio=0.05)
+            self.assertEqual(res["allowed"] + res["denied"], 500)
+            self.assertGreater(res["allowed"], 300)
+            self.assertGreater(res["denied"], 0)
+            self.assertTrue(0 < res["cache_hit_ratio"] < 1)
+            self.assertGreater(res["store_calls_per_request"], 0)
+            self.assertLessEqual(res["latency"]["p50_ms"], res["latency"]["p999_ms"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import sys
+import os
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+
+from subauth import metrics
+from subauth.caching import MeteredTTLCache
+from subauth.data import Request, Subscription
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.registry = metrics.MetricsRegistry()
+        metrics.REGISTRY.reset()
+
+    def test_counter(self):
+        counter = self.registry.counter("test_requests", "Test requests", ("status",))
+        counter.inc("200")
+        counter.inc("200", amount=2)
+        counter.inc("404")
+        self.assertEqual(counter.value("200"), 3)
+        self.assertEqual(counter.value("404"), 1)
+        self.assertEqual(counter.value("500"), 0)
+
+    def test_histogram(self):
+        histogram = self.registry.histogram("test_latency", "Test latency", buckets=(0.1, 1.0))
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5)
+        state = histogram.collect()[()]
+        self.assertEqual(state["count"], 3)
+        self.assertEqual(state["buckets"], { 0.1: 1, 1.0: 2, float("inf"): 3 })
+
+    def test_openmetrics_export(self):
+        self.registry.counter("test_requests", "Test requests", ("status",)).inc("200")
+        self.registry.histogram("test_latency", "Test latency", buckets=(0.1,)).observe(0.05)
+        text = self.registry.generate_openmetrics()
+        self.assertIn("# TYPE test_requests counter", text)
+        self.assertIn('test_requests_total{status="200"} 1', text)
+        self.assertIn('test_latency_bucket{le="0.1"} 1', text)
+        self.assertIn('test_latency_bucket{le="+Inf"} 1', text)
+        self.assertIn("test_latency_count 1", text)
+        self.assertTrue(text.endswith("# EOF\n"))
+
+    def test_cache_metrics(self):
+        cache = MeteredTTLCache("test", maxsize=1, ttl=60)
+        self.assertIsNone(cache.get("a"))
+        cache["a"] = 1
+        self.assertEqual(cache.get("a"), 1)
+        cache["b"] = 2
+        self.assertEqual(metrics.CACHE_HITS.value("test"), 1)
+        self.assertEqual(metrics.CACHE_MISSES.value("test"), 1)
+        self.assertEqual(metrics.CACHE_EVICTIONS.value("test", "capacity"), 1)
+
+    def test_rule_decisions(self):
+        sub = Subscription({ "id": "abc", "name": "Test", "expiry": -1, "rules": [
+            { "name": "hosts", "type": "host", "hosts": [ "foo.com" ] },
+            { "name": "paths", "type": "path", "paths": [ "/api/*" ] },
+        ]})
+        self.assertTrue(sub.is_allowed(Request("GET", "foo.com", "/api/test"))[0])
+        self.assertFalse(sub.is_allowed(Request("GET", "foo.com", "/other"))[0])
+        self.assertEqual(metrics.RULE_DECISIONS.value("HostCheck", "allow"), 2)
+        self.assertEqual(metrics.RULE_DECISIONS.value("PathCheck", "allow"), 1)
+        self.assertEqual(metrics.RULE_DECISIONS.value("PathCheck", "deny"), 1)
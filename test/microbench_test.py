@@ -0,0 +1,33 @@
+import sys
+import os
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../benchmarks')))
+
+import microbench
+
+class TestMicrobench(unittest.TestCase):
+    def test_results_are_machine_readable(self):
+        res = microbench.run("rules.host.1.*", min_time=0.001, repeats=2)
+        self.assertEqual(sorted(res["results"].keys()), [ "rules.host.1.match_last", "rules.host.1.miss" ])
+        self.assertIn("python", res["meta"])
+        for result in res["results"].values():
+            self.assertGreater(result["median_ns"], 0)
+            self.assertIn("peak_bytes", result)
+            self.assertIn("retained_bytes_per_call", result)
+
+    def test_every_rule_type_is_covered(self):
+        names = microbench._BENCHMARKS.keys()
+        for rule_type in ( "host", "path", "header", "query", "cookie", "client_ip", "method", "date" ):
+            self.assertTrue(any(name.startswith(f"rules.{rule_type}.") for name in names), rule_type)
+
+    def test_compare(self):
+        baseline = { "results": { "a": { "median_ns": 100.0 }, "b": { "median_ns": 100.0 } } }
+        current = { "results": { "a": { "median_ns": 105.0 }, "b": { "median_ns": 150.0 }, "c": { "median_ns": 1.0 } } }
+        changes = { change["name"]: change for change in microbench.compare(baseline, current, threshold=0.10) }
+        self.assertEqual(sorted(changes.keys()), [ "a", "b" ])
+        self.assertFalse(changes["a"]["regressed"])
+        self.assertTrue(changes["b"]["regressed"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+import sys
+import os
+import time
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+
+from subauth import ratelimit
+from subauth.rules import RateCheck, create_rule
+from subauth.ratelimit import LocalRateLimiter, RateLimiter
+from subauth.data import Request, Subscription
+
+
+class RecordingLimiter(RateLimiter):
+    def __init__(self):
+        self.calls = []
+
+    def try_acquire(self, key:str, rate:float, burst:float, cost:float = 1.0) -> bool:
+        self.calls.append((key, rate, burst))
+        return False
+
+
+class TestRateRule(unittest.TestCase):
+    def setUp(self):
+        ratelimit.set_rate_limiter(LocalRateLimiter(stripes=4, max_buckets=100))
+        self.request = Request("GET", "app.test", "/", {}, client_ip="10.0.0.1")
+
+    def tearDown(self):
+        ratelimit.set_rate_limiter(None)
+        ratelimit.set_shared_rate_limiter(None)
+
+    def test_burst_then_deny(self):
+        rule = create_rule("rate", "rate", True, { "limit": 3, "period": 60 })
+        rule.bind_subscription("sub-1")
+        self.assertEqual([ rule.matches(self.request) for _ in range(4) ], [ True, True, True, False ])
+
+    def test_refill(self):
+        rule = RateCheck(1000, burst=1)
+        rule.bind_subscription("sub-1")
+        self.assertTrue(rule.matches(self.request))
+        self.assertFalse(rule.matches(self.request))
+        time.sleep(0.01)
+        self.assertTrue(rule.matches(self.request))
+
+    def test_keys(self):
+        other_ip = Request("GET", "app.test", "/", {}, client_ip="10.0.0.2")
+        no_ip = Request("GET", "app.test", "/", {})
+        per_sub, per_ip, per_sub_ip = RateCheck(1, key="subscription"), RateCheck(1, key="client-ip"), RateCheck(1, key="subscription+client-ip")
+        for rule in (per_sub, per_ip, per_sub_ip):
+            rule.bind_subscription("sub-1")
+
+        self.assertEqual(per_sub.bucket_key(self.request), per_sub.bucket_key(other_ip))
+        self.assertNotEqual(per_ip.bucket_key(self.request), per_ip.bucket_key(other_ip))
+        self.assertEqual(per_sub_ip.bucket_key(self.request), "1/1/1:sub:sub-1|ip:10.0.0.1")
+        self.assertEqual(per_ip.bucket_key(no_ip), per_sub.bucket_key(no_ip))
+        self.assertNotEqual(RateCheck(2).bucket_key(self.request), RateCheck(1).bucket_key(self.request))
+
+        self.assertTrue(per_ip.matches(self.request))
+        self.assertFalse(per_ip.matches(self.request))
+        self.assertTrue(per_ip.matches(other_ip))
+
+    def test_subscription(self):
+        sub = Subscription({ "id": "sub-1", "name": "Sub 1", "expiry": -1, "rules": [
+            { "name": "all", "type": "allow-all" },
+            { "name": "rate", "type": "rate", "limit": 2, "period": 60 },
+        ] })
+        self.assertEqual(sub.rules[1].subscription_id, "sub-1")
+        self.assertEqual([ sub.is_allowed(self.request) for _ in range(3) ], [ (True, "OK"), (True, "OK"), (False, "Request does not match ALLOW rule RateCheck") ])
+
+        ## A reloaded subscription carries on with the same bucket
+        sub = Subscription({ "id": "sub-1", "name": "Sub 1", "expiry": -1, "rules": [ { "name": "rate", "type": "rate", "limit": 2, "period": 60 } ] })
+        self.assertFalse(sub.is_allowed(self.request)[0])
+
+    def test_shared_limiter(self):
+        shared = RecordingLimiter()
+        ratelimit.set_shared_rate_limiter(shared)
+        rule = create_rule("rate", "rate", True, { "limit": 10, "period": 2, "burst": 5, "shared": True })
+        rule.bind_subscription("sub-1")
+        self.assertFalse(rule.matches(self.request))
+        self.assertEqual(shared.calls, [ ("10/2/5:sub:sub-1", 5.0, 5) ])
+
+        ## Rules that are not shared stay in process
+        self.assertTrue(create_rule("rate", "rate", True, { "limit": 10 }).matches(self.request))
+
+    def test_bursts_do_not_share_a_bucket(self):
+        smooth, bursty = RateCheck(10, 60, burst=1), RateCheck(10, 60)
+        smooth.bind_subscription("sub-1")
+        bursty.bind_subscription("sub-1")
+        self.assertNotEqual(smooth.bucket_key(self.request), bursty.bucket_key(self.request))
+        self.assertEqual([ smooth.matches(self.request) for _ in range(2) ], [ True, False ])
+        self.assertTrue(all(bursty.matches(self.request) for _ in range(10)))
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            create_rule("rate", "rate", True, {})
+        with self.assertRaises(ValueError):
+            RateCheck(10, key="user")
+        with self.assertRaises(ValueError):
+            RateCheck(10, period=0)
+
+    def test_bounded_table(self):
+        limiter = LocalRateLimiter(stripes=2, max_buckets=10, idle_seconds=0)
+        for i in range(100):
+            limiter.try_acquire(f"key-{i}", 1, 1)
+        self.assertLessEqual(len(limiter), 10)
+        self.assertGreater(len(limiter), 0)
+
+    def test_idle_eviction(self):
+        limiter = LocalRateLimiter(stripes=1, max_buckets=100, idle_seconds=60)
+        limiter.try_acquire("a", 1, 1)
+        self.assertEqual(limiter.sweep(), 0)
+        limiter.idle_seconds = 0
+        self.assertEqual(limiter.sweep(), 1)
+        self.assertEqual(len(limiter), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+import sys
+import os
+import time
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+
+from subauth import session, sub_factory
+from subauth.data import Request
+
+KEY_1 = "v1:" + "a" * 32
+KEY_2 = "v2:" + "b" * 32
+
+
+def _request(cookie:str = None) -> Request:
+    headers = { "Cookie": f"{session.SESSION_COOKIE_NAME}={cookie}" } if cookie else {}
+    return Request("GET", "app.test", "/", headers)
+
+def _cookie_value(set_cookie:str) -> str:
+    return set_cookie.split(";")[0].split("=", 1)[1]
+
+
+class TestSessionCookie(unittest.TestCase):
+    def setUp(self):
+        session.set_signing_keys(KEY_1)
+        sub_factory._SUBSCRIPTION_CACHE.clear()
+        sub_factory._ENTRA_UN_TO_ID_CACHE.clear()
+        self.sub = sub_factory._compile_subscription({ "id": "sub-1", "name": "Sub 1", "expiry": -1, "browserstore": True, "rules": [ { "name": "all", "type": "allow-all" } ] })
+
+    def tearDown(self):
+        session.set_signing_keys([])
+
+    def test_round_trip(self):
+        value = session.encode_session(sub_id="sub-1")
+        decoded = session.decode_session(value)
+        self.assertEqual(decoded.sub_id, "sub-1")
+        self.assertIsNone(decoded.entra_username)
+        self.assertEqual(decoded.key_version, "v1")
+        self.assertLess(len(value), 120)
+
+    def test_tampered_and_expired_sessions_are_rejected(self):
+        value = session.encode_session(sub_id="sub-1")
+        version, payload, signature = value.split(".")
+        forged = session._b64encode(b'{"e":9999999999,"s":"sub-2"}')
+        self.assertIsNone(session.decode_session(f"{version}.{forged}.{signature}"))
+        self.assertIsNone(session.decode_session(f"v9.{payload}.{signature}"))
+        self.assertIsNone(session.decode_session("garbage"))
+        self.assertIsNone(session.decode_session(session.encode_session(sub_id="sub-1", expires=time.time() - 1)))
+
+    def test_key_rotation(self):
+        old_value = session.encode_session(sub_id="sub-1")
+        session.set_signing_keys(KEY_2 + "," + KEY_1)
+        self.assertEqual(session.decode_session(old_value).sub_id, "sub-1")
+        self.assertEqual(session.decode_session(session.encode_session(sub_id="sub-1")).key_version, "v2")
+
+        ## A session signed with the old key is re-signed
+        set_cookie = session.session_cookie_for(_request(old_value), self.sub)
+        self.assertEqual(session.decode_session(_cookie_value(set_cookie)).key_version, "v2")
+
+        session.set_signing_keys(KEY_2)
+        self.assertIsNone(session.decode_session(old_value))
+
+    def test_invalid_keys(self):
+        with self.assertRaises(ValueError):
+            session.set_signing_keys("v1:short")
+        with self.assertRaises(ValueError):
+            session.set_signing_keys("no-version")
+
+    def test_session_resolves_to_the_cached_subscription(self):
+        value = session.encode_session(sub_id="sub-1")
+        sub, user_session = session.get_session_subscription(_request(value))
+        self.assertIs(sub, self.sub)
+        self.assertEqual(user_session.sub_id, "sub-1")
+        self.assertEqual(session.get_session_subscription(_request()), (None, None))
+
+    def test_cookie_is_issued_and_renewed(self):
+        set_cookie = session.session_cookie_for(_request(), self.sub)
+        self.assertIn("HttpOnly", set_cookie)
+        value = _cookie_value(set_cookie)
+        self.assertEqual(session.decode_session(value).sub_id, "sub-1")
+
+        ## A fresh session is not reissued, but one past half its life is
+        self.assertIsNone(session.session_cookie_for(_request(value), self.sub))
+        old = session.encode_session(sub_id="sub-1", expires=time.time() + session.SESSION_MAX_AGE_SECONDS // 4)
+        self.assertIsNotNone(session.session_cookie_for(_request(old), self.sub))
+
+    def test_entra_session_expires_with_the_token(self):
+        entra_sub = sub_factory._compile_subscription({ "id": "sub-2", "name": "Sub 2", "expiry": -1, "is_entra_user": True, "entra_username": "user@test.com", "rules": [ { "name": "all", "type": "allow-all" } ] })
+        entra_sub.entra_user_claims = { "preferred_username": "user@test.com", "exp": int(time.time()) + 600 }
+        value = _cookie_value(session.session_cookie_for(_request(), entra_sub))
+        decoded = session.decode_session(value)
+        self.assertEqual(decoded.entra_username, "user@test.com")
+        self.assertIsNone(decoded.sub_id)
+        self.assertLessEqual(decoded.expires, entra_sub.entra_user_claims["exp"])
+
+    def test_entra_session_does_not_change_the_cached_subscription(self):
+        entra_sub = sub_factory._compile_subscription({ "id": "sub-2", "name": "Sub 2", "expiry": -1, "is_entra_user": True, "entra_username": "user@test.com", "rules": [ { "name": "all", "type": "allow-all" } ] })
+        sub_factory._ENTRA_UN_TO_ID_CACHE["user@test.com"] = "sub-2"
+        claims = { "preferred_username": "user@test.com", "oid": "1234", "name": "User", "exp": int(time.time()) + 7200 }
+        entra_sub.is_entra_user = True
+        entra_sub.entra_user_claims = claims
+
+        value = session.encode_session(entra_username="user@test.com", expires=time.time() + 600)
+        sub, user_session = session.get_session_subscription(_request(value))
+        self.assertIs(sub, entra_sub)
+        self.assertIs(sub.entra_user_claims, claims)
+
+        ## The renewed session still expires with the session it came from
+        self.assertEqual(user_session.entra_claims(), { "preferred_username": "user@test.com", "exp": user_session.expires })
+        self.assertIsNone(session.session_cookie_for(_request(value), sub, user_session.entra_claims()))
+
+    def test_disabled(self):
+        session.set_signing_keys([])
+        self.assertFalse(session.sessions_enabled())
+        self.assertIsNone(session.session_cookie_for(_request(), self.sub))
+        self.assertIsNone(session.decode_session("v1.e30.abc"))
+
+
+if __name__ == '__main__':
+    unittest.main()
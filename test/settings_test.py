@@ -0,0 +1,81 @@
+import sys
+import os
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+
+from subauth import settings
+from subauth.settings import Settings
+
+
+class TestSettings(unittest.TestCase):
+    def tearDown(self):
+        settings.set_settings(None)
+
+    def test_defaults(self):
+        s = Settings({})
+        self.assertFalse(s.entra_enabled)
+        self.assertIsNone(s.entra_issuer)
+        self.assertEqual(s.entra_scopes, [ "User.Read" ])
+        self.assertFalse(s.entra_scopes_configured)
+        self.assertIsNone(s.entra_redirect_uri)
+        self.assertTrue(s.entra_state_strip_api_app_path)
+        self.assertEqual(s.default_redirect_url, "/")
+        self.assertEqual(s.id_token_max_age, 28800)
+        self.assertEqual(s.id_token_cookie_secure_attributes, "Secure; SameSite=None;")
+        self.assertEqual(s.subscription_cache_size, 500)
+        self.assertIn("alias_for", s.subscription_fields)
+
+    def test_entra_values_are_derived_once(self):
+        s = Settings({
+            "ENTRA_AUTHORITY": "https://login.test/tenant",
+            "ENTRA_CLIENT_ID": "client",
+            "ENTRA_SCOPES": "User.Read,openid",
+            "ENTRA_REDIRECT_URI": "",
+            "ENTRA_ID_TOKEN_MAX_AGE_SECONDS": "60",
+            "ENTRA_ID_TOKEN_SAME_SITE": "Strict",
+            "ENTRA_STATE_STRIP_API_APP_PATH": "FALSE",
+        })
+        self.assertTrue(s.entra_enabled)
+        self.assertEqual(s.entra_issuer, "https://login.test/tenant/v2.0")
+        self.assertEqual(s.entra_scopes, [ "User.Read", "openid" ])
+        self.assertIsNone(s.entra_redirect_uri)
+        self.assertFalse(s.entra_state_strip_api_app_path)
+        self.assertEqual(s.id_token_cookie_secure_attributes, "Secure; SameSite=Strict;")
+        self.assertEqual(s.id_token_cookie_suffix, " Path=/; Max-Age=60;")
+
+    def test_invalid_same_site_falls_back_to_none(self):
+        self.assertEqual(Settings({ "ENTRA_ID_TOKEN_SAME_SITE": "Sometimes" }).id_token_same_site, "None")
+
+    def test_invalid_integer_is_rejected(self):
+        with self.assertRaises(ValueError):
+            Settings({ "SUBSCRIPTION_CACHE_SIZE": "lots" })
+
+    def test_subscription_fields(self):
+        self.assertIsNone(Settings({}).subscription_read_fields)
+        self.assertEqual(Settings({ "SUBSCRIPTION_PROJECTION": "true" }).subscription_read_fields, Settings({}).subscription_fields)
+        fields = Settings({ "SUBSCRIPTION_EXTRA_FIELDS": "tier, owner" }).subscription_fields
+        self.assertIn("tier", fields)
+        self.assertIn("owner", fields)
+
+    def test_require_entra(self):
+        s = Settings({ "ENTRA_AUTHORITY": "https://login.test/tenant" })
+        s.require_entra("ENTRA_AUTHORITY")
+        with self.assertRaisesRegex(RuntimeError, "ENTRA_CLIENT_ID is not set"):
+            s.require_entra("ENTRA_AUTHORITY", "ENTRA_CLIENT_ID")
+
+    def test_get_set_and_reload(self):
+        configured = Settings({ "DEFAULT_REDIRECT_URL": "/home" })
+        settings.set_settings(configured)
+        self.assertIs(settings.get_settings(), configured)
+
+        os.environ["DEFAULT_REDIRECT_URL"] = "/reloaded"
+        try:
+            self.assertIs(settings.get_settings(), configured)
+            self.assertEqual(settings.reload_settings().default_redirect_url, "/reloaded")
+        finally:
+            del os.environ["DEFAULT_REDIRECT_URL"]
+
+
+if __name__ == '__main__':
+    unittest.main()
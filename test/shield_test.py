@@ -0,0 +1,158 @@
+import sys
+import os
+import time
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+
+from subauth import core, metrics, settings, shield, sub_factory
+from subauth.data import Request
+from subauth.shield import FailureThrottle
+
+
+class CountingConnection:
+    def __init__(self):
+        self.lookups = []
+
+    def get_item(self, id:str, fields:list[str] = None) -> dict:
+        self.lookups.append(id)
+        if id.startswith("expired-"):
+            return { "id": id, "name": "Sub", "expiry": -2, "rules": [ { "name": "all", "type": "allow-all" } ] }
+        return { "id": id, "name": "Sub", "expiry": -1, "rules": [ { "name": "all", "type": "allow-all" } ] } if id.startswith("sub-") else None
+
+
+def _request(sub_id:str, peer_ip:str = "10.0.0.1", headers:dict[str, str] = None) -> Request:
+    return core.build_request("GET", "app.test", "/", { "subscription": sub_id, **(headers or {}) }, peer_ip=peer_ip)
+
+
+class TestSubscriptionIdFormat(unittest.TestCase):
+    def test_length_and_charset(self):
+        config = settings.Settings({ "SUBSCRIPTION_ID_MIN_LENGTH": "4", "SUBSCRIPTION_ID_MAX_LENGTH": "8", "SUBSCRIPTION_ID_CHARSET": "a-z0-9-" })
+        self.assertTrue(shield.valid_subscription_id("sub-1234", config))
+        self.assertFalse(shield.valid_subscription_id("sub", config))
+        self.assertFalse(shield.valid_subscription_id("sub-12345", config))
+        self.assertFalse(shield.valid_subscription_id("sub_1234", config))
+        self.assertFalse(shield.valid_subscription_id("' OR 1=1", config))
+
+        ## Anything goes by default (up to 256 characters)
+        self.assertTrue(shield.valid_subscription_id("Any Thing @ all", settings.Settings({})))
+        self.assertFalse(shield.valid_subscription_id("x" * 257, settings.Settings({})))
+
+    def test_checksum(self):
+        config = settings.Settings({ "SUBSCRIPTION_ID_CHECKSUM": "luhn36" })
+        sub_id = shield.add_checksum("acme-7f3k9q")
+        self.assertTrue(shield.valid_subscription_id(sub_id, config))
+        self.assertTrue(shield.valid_subscription_id(sub_id.upper(), config))
+        self.assertFalse(shield.valid_subscription_id(sub_id[:-1] + ("a" if sub_id[-1] != "a" else "b"), config))
+
+        ## The classic (digits only) Luhn check
+        self.assertTrue(shield.luhn_valid("79927398713", "luhn"))
+        self.assertFalse(shield.luhn_valid("79927398710", "luhn"))
+        self.assertEqual(shield.add_checksum("7992739871", "luhn"), "79927398713")
+
+    def test_invalid_settings(self):
+        with self.assertRaises(ValueError):
+            settings.Settings({ "SUBSCRIPTION_ID_CHECKSUM": "md5" })
+        with self.assertRaises(ValueError):
+            settings.Settings({ "SUBSCRIPTION_ID_CHARSET": "a-" + "\\" })
+
+
+class TestFailureThrottle(unittest.TestCase):
+    def test_sliding_window(self):
+        throttle = FailureThrottle(max_failures=3, window_seconds=0.2)
+        for _ in range(3):
+            self.assertFalse(throttle.is_throttled("10.0.0.1"))
+            throttle.record_failure("10.0.0.1")
+        self.assertTrue(throttle.is_throttled("10.0.0.1"))
+        self.assertFalse(throttle.is_throttled("10.0.0.2"))
+        self.assertFalse(throttle.is_throttled(None))
+
+        ## The failures age out of the window
+        time.sleep(0.45)
+        self.assertFalse(throttle.is_throttled("10.0.0.1"))
+
+    def test_bounded_table(self):
+        throttle = FailureThrottle(max_failures=1, max_clients=10)
+        for i in range(100):
+            throttle.record_failure(f"10.0.0.{i}")
+        self.assertEqual(len(throttle), 10)
+        self.assertTrue(throttle.is_throttled("10.0.0.99"))
+        self.assertFalse(throttle.is_throttled("10.0.0.0"))
+
+    def test_disabled(self):
+        throttle = FailureThrottle(max_failures=0)
+        throttle.record_failure("10.0.0.1")
+        self.assertFalse(throttle.is_throttled("10.0.0.1"))
+        self.assertEqual(len(throttle), 0)
+
+
+class TestShieldPipeline(unittest.TestCase):
+    def setUp(self):
+        settings.set_settings(settings.Settings({ "SUBSCRIPTION_ID_CHARSET": "a-z0-9-" }))
+        sub_factory._SUBSCRIPTION_CACHE.clear()
+        self.connection = CountingConnection()
+        sub_factory._COSMOS_DB_CONNECTION = self.connection
+        self.throttle = shield.get_failure_throttle()
+        shield.set_failure_throttle(FailureThrottle(max_failures=3, window_seconds=60))
+        metrics.REGISTRY.reset()
+
+    def tearDown(self):
+        shield.set_failure_throttle(self.throttle)
+        sub_factory._COSMOS_DB_CONNECTION = None
+        sub_factory._SUBSCRIPTION_CACHE.clear()
+        settings.set_settings(None)
+
+    def test_invalid_ids_are_not_looked_up(self):
+        sub, _ = core.resolve_subscription(_request("' OR 1=1"))
+        self.assertIsNone(sub)
+        self.assertEqual(self.connection.lookups, [])
+        self.assertEqual(metrics.SHIELD_REJECTIONS.value("invalid_format"), 1)
+
+        sub, _ = core.resolve_subscription(_request("sub-1"))
+        self.assertEqual(sub.id, "sub-1")
+
+    def test_repeat_offenders_are_throttled(self):
+        for n in range(3):
+            sub, _ = core.resolve_subscription(_request(f"guess-{n}"))
+            self.assertIsNone(sub)
+        self.assertEqual(len(self.connection.lookups), 3)
+
+        ## Even a valid id is denied (without a lookup), while the client is throttled
+        sub, reason = core.resolve_subscription(_request("sub-1"))
+        self.assertIsNone(sub)
+        self.assertEqual(reason, shield.THROTTLED_REASON)
+        self.assertEqual(len(self.connection.lookups), 3)
+        self.assertEqual(metrics.SHIELD_REJECTIONS.value("throttled"), 1)
+
+        ## Other clients are not affected
+        sub, _ = core.resolve_subscription(_request("sub-1", "10.0.0.2"))
+        self.assertEqual(sub.id, "sub-1")
+
+    def test_expired_subscriptions_are_not_failures(self):
+        for _ in range(5):
+            sub, _ = core.resolve_subscription(_request("expired-1"))
+            self.assertIsNone(sub)
+        self.assertFalse(shield.get_failure_throttle().is_throttled("10.0.0.1"))
+        self.assertEqual(core.resolve_subscription(_request("sub-1"))[0].id, "sub-1")
+
+    def test_forged_client_ip_is_not_trusted(self):
+        ## The failures are counted against the peer, not the (caller set) client IP headers
+        for n in range(3):
+            core.resolve_subscription(_request(f"guess-{n}", "10.0.0.9", { "x-client-ip": "10.0.0.1", "x-forwarded-for": f"10.0.1.{n}" }))
+        self.assertEqual(core.resolve_subscription(_request("sub-1"))[0].id, "sub-1")
+        self.assertEqual(core.resolve_subscription(_request("sub-1", "10.0.0.9", { "x-client-ip": "10.0.0.5" }))[1], shield.THROTTLED_REASON)
+
+
+class TestClientKey(unittest.TestCase):
+    def test_client_key(self):
+        request = _request("sub-1", "10.0.0.9", { "x-client-ip": "1.1.1.1", "x-forwarded-for": "1.1.1.1, 2.2.2.2:5123, 3.3.3.3" })
+        self.assertEqual(shield.client_key(request), "10.0.0.9")
+        self.assertEqual(shield.client_key(request, trusted_proxies=1), "3.3.3.3")
+        self.assertEqual(shield.client_key(request, trusted_proxies=2), "2.2.2.2")
+        self.assertEqual(shield.client_key(request, trusted_proxies=4), "10.0.0.9")
+        self.assertEqual(shield.client_key(_request("sub-1", None, { "x-forwarded-for": "[2001:db8::1]:443" }), trusted_proxies=1), "2001:db8::1")
+        self.assertIsNone(shield.client_key(_request("sub-1", None, { "x-client-ip": "1.1.1.1" })))
+
+
+if __name__ == '__main__':
+    unittest.main()
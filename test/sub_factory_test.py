@@ -0,0 +1,185 @@
+import sys
+import os
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+
+from azure.cosmos.errors import CosmosResourceNotFoundError
+from subauth import sub_factory, settings
+from subauth.dataaccess import alias_doc_id, ENTRA_ALIAS, CosmosDBConnection
+from subauth.dataaccess.fake_cosmos import FakeContainerProxy, register_fake_container, clear_fake_containers
+
+class InMemoryConnection:
+    """
+    A minimal stand-in for CosmosDBConnection that counts the calls made to it.
+    """
+    def __init__(self, docs:list[dict]):
+        self.docs = { doc["id"]: doc for doc in docs }
+        self.reads = 0
+        self.queries = 0
+
+    def get_item(self, id:str, partitionKey:str = None, fields:list[str] = None):
+        self.reads += 1
+        self.fields = fields
+        return _project(self.docs.get(id, None), fields)
+
+    def get_items_by_query(self, query:str, source:str = None, parameters:list = None):
+        self.queries += 1
+        username = parameters[0]["value"] if parameters else None
+        return [ doc for doc in self.docs.values() if doc.get("is_entra_user", False) and (username is None or doc.get("entra_username") == username) ]
+
+    def iter_items_by_query(self, query:str, parameters:list = None):
+        return iter(self.get_items_by_query(query, parameters=parameters))
+
+    def get_items_by_ids(self, ids:list[str], partitionKeys:list[str] = None, chunk_size:int = None, max_parallelism:int = None, fields:list[str] = None):
+        self.batches = getattr(self, "batches", 0) + 1
+        return [ _project(self.docs[id], fields) for id in ids if id in self.docs ]
+
+    def upsert_item(self, item:dict, ttl:int = None, source:str = None):
+        self.docs[item["id"]] = item
+
+    def delete_item(self, id:str, partitionKey:str = None):
+        if id not in self.docs:
+            raise CosmosResourceNotFoundError()
+        del self.docs[id]
+
+
+def _project(doc:dict, fields:list[str]) -> dict:
+    if doc is None or not fields:
+        return doc
+    return { key: value for key, value in doc.items() if key in fields }
+
+
+def _sub(sub_id:str, username:str = None) -> dict:
+    doc = { "id": sub_id, "name": f"Sub {sub_id}", "expiry": -1, "rules": [ { "name": "all", "type": "allow-all" } ] }
+    if username:
+        doc["is_entra_user"] = True
+        doc["entra_username"] = username
+    return doc
+
+
+class TestSubFactoryAliases(unittest.TestCase):
+    def setUp(self):
+        sub_factory._SUBSCRIPTION_CACHE.clear()
+        sub_factory._ENTRA_UN_TO_ID_CACHE.clear()
+        self.connection = InMemoryConnection([ _sub("abc123", "user@foo.com"), { **_sub("def456"), "admin_notes": "x" * 1000, "team": "blue" } ])
+        sub_factory._COSMOS_DB_CONNECTION = self.connection
+
+    def tearDown(self):
+        sub_factory._COSMOS_DB_CONNECTION = None
+        sub_factory._ALIAS_INDEX = None
+
+    def test_query_fallback_writes_alias(self):
+        sub = sub_factory.get_subscription("User@Foo.com", True)
+        self.assertEqual(sub.id, "abc123")
+        self.assertEqual(self.connection.queries, 1)
+        self.assertEqual(self.connection.docs[alias_doc_id(ENTRA_ALIAS, "user@foo.com")]["alias_for"], "abc123")
+
+    def test_alias_point_read(self):
+        self.connection.upsert_item({ "id": alias_doc_id(ENTRA_ALIAS, "user@foo.com"), "alias_for": "abc123", "alias_type": ENTRA_ALIAS })
+        sub = sub_factory.get_subscription("user@foo.com", True)
+        self.assertEqual(sub.id, "abc123")
+        self.assertEqual(self.connection.queries, 0)
+        self.assertEqual(self.connection.reads, 2)
+
+    def test_shared_cache_entry(self):
+        by_user = sub_factory.get_subscription("user@foo.com", True)
+        reads = self.connection.reads
+        by_id = sub_factory.get_subscription("abc123", False)
+        self.assertIs(by_user, by_id)
+        self.assertIs(sub_factory.get_subscription("user@foo.com", True), by_user)
+        self.assertEqual(self.connection.reads, reads)
+
+    def test_username_is_not_a_subscription_id(self):
+        sub_factory.get_subscription("user@foo.com", True)
+        self.assertIsNone(sub_factory.get_subscription("user@foo.com", False))
+        self.assertIsNone(sub_factory.get_subscription(alias_doc_id(ENTRA_ALIAS, "user@foo.com"), False))
+
+    def test_alias_to_mixed_case_id(self):
+        self.connection.upsert_item(_sub("AbC789", "mixed@foo.com"))
+        self.connection.upsert_item({ "id": alias_doc_id(ENTRA_ALIAS, "mixed@foo.com"), "alias_for": "AbC789", "alias_type": ENTRA_ALIAS })
+        sub = sub_factory.get_subscription("mixed@foo.com", True)
+        self.assertEqual(sub.id, "AbC789")
+        self.assertEqual(self.connection.queries, 0)
+
+        ## The cached alias still finds the subscription once it has been invalidated
+        sub_factory.invalidate_subscription("abc789")
+        self.assertEqual(sub_factory._ENTRA_UN_TO_ID_CACHE.get("mixed@foo.com"), None)
+        sub_factory._ENTRA_UN_TO_ID_CACHE["mixed@foo.com"] = "AbC789"
+        self.assertEqual(sub_factory.get_subscription("mixed@foo.com", True).id, "AbC789")
+        self.assertEqual(self.connection.queries, 0)
+
+    def test_stale_alias_is_ignored(self):
+        self.connection.upsert_item({ "id": alias_doc_id(ENTRA_ALIAS, "user@foo.com"), "alias_for": "def456", "alias_type": ENTRA_ALIAS })
+        sub = sub_factory.get_subscription("user@foo.com", True)
+        self.assertEqual(sub.id, "abc123")
+
+    def test_save_subscription_moves_alias(self):
+        sub_factory.save_subscription(_sub("abc123", "other@foo.com"))
+        self.assertNotIn(alias_doc_id(ENTRA_ALIAS, "user@foo.com"), self.connection.docs)
+        self.assertEqual(self.connection.docs[alias_doc_id(ENTRA_ALIAS, "other@foo.com")]["alias_for"], "abc123")
+        self.assertIsNone(sub_factory.get_subscription("user@foo.com", True))
+
+    def test_delete_subscription_removes_alias(self):
+        sub_factory.rebuild_subscription_aliases()
+        sub_factory.delete_subscription("abc123")
+        self.assertEqual(len(self.connection.docs), 1)
+
+    def test_get_subscriptions_batched(self):
+        sub_factory.get_subscription("abc123", False)
+        reads = self.connection.reads
+        subs = sub_factory.get_subscriptions([ "ABC123", "def456", "missing", "def456" ])
+        self.assertEqual(set(subs.keys()), { "abc123", "def456" })
+        self.assertEqual(self.connection.reads, reads)
+        self.assertEqual(self.connection.batches, 1)
+        self.assertIs(sub_factory.get_subscription("def456", False), subs["def456"])
+
+    def test_get_subscriptions_skips_invalid(self):
+        self.connection.upsert_item({ "id": "bad789", "name": "Bad", "expiry": -1, "rules": [ { "name": "x", "type": "no-such-rule" } ] })
+        subs = sub_factory.get_subscriptions([ "abc123", "bad789", "def456" ])
+        self.assertEqual(set(subs.keys()), { "abc123", "def456" })
+
+    def test_unwanted_fields_are_dropped(self):
+        sub = sub_factory.get_subscription("def456", False)
+        self.assertIsNone(self.connection.fields)
+        self.assertEqual(sub.properties, {})
+
+    def test_projection(self):
+        os.environ["SUBSCRIPTION_PROJECTION"] = "true"
+        try:
+            settings.reload_settings()
+            sub = sub_factory.get_subscription("def456", False)
+            self.assertIn("rules", self.connection.fields)
+            self.assertNotIn("admin_notes", self.connection.fields)
+            self.assertEqual(sub.properties, {})
+        finally:
+            del os.environ["SUBSCRIPTION_PROJECTION"]
+            settings.reload_settings()
+
+    def test_projection_extra_fields(self):
+        os.environ["SUBSCRIPTION_EXTRA_FIELDS"] = "team"
+        try:
+            settings.reload_settings()
+            sub = sub_factory.get_subscription("def456", False)
+            self.assertEqual(sub.properties, { "team": "blue" })
+        finally:
+            del os.environ["SUBSCRIPTION_EXTRA_FIELDS"]
+            settings.reload_settings()
+
+
+class TestSubFactoryReads(unittest.TestCase):
+    def setUp(self):
+        sub_factory._SUBSCRIPTION_CACHE.clear()
+        self.fake = FakeContainerProxy([ _sub("abc123"), _sub("def456"), _sub("ghi789") ])
+        register_fake_container("subscriptions", self.fake)
+        sub_factory._COSMOS_DB_CONNECTION = CosmosDBConnection("subscriptions", "subscriptions")
+
+    def tearDown(self):
+        clear_fake_containers()
+        sub_factory._COSMOS_DB_CONNECTION = None
+        sub_factory._SUBSCRIPTION_CACHE.clear()
+
+    def test_cache_misses_use_point_reads(self):
+        self.assertEqual(sub_factory.get_subscription("abc123", False).id, "abc123")
+        self.assertEqual(set(sub_factory.get_subscriptions([ "def456", "ghi789" ]).keys()), { "def456", "ghi789" })
+        self.assertEqual(self.fake.calls, { "read_item": 1, "read_items": 1 })
@@ -0,0 +1,89 @@
+import sys
+import os
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+
+import azure.functions as func
+
+from subauth import settings, sub_factory, timing
+from subauth import function_utils
+
+
+def _function_request(url:str, headers:dict[str, str]) -> func.HttpRequest:
+    return func.HttpRequest("GET", url, headers={ "host": url.split("/")[2], **headers }, body=b"", route_params={})
+
+
+class TestStageTiming(unittest.TestCase):
+    def setUp(self):
+        settings.set_settings(settings.Settings({}))
+        sub_factory._SUBSCRIPTION_CACHE.clear()
+        sub_factory._compile_subscription({ "id": "sub-1", "name": "Sub 1", "expiry": -1, "browserstore": False, "rules": [ { "name": "hosts", "type": "host", "hosts": [ "app.test" ] } ] })
+        self.stages = []
+        timing.add_stage_hook(self.hook)
+
+    def tearDown(self):
+        timing.set_timing_enabled(False, False)
+        timing.remove_stage_hook(self.hook)
+        settings.set_settings(None)
+        sub_factory._SUBSCRIPTION_CACHE.clear()
+
+    def hook(self, stage:str, start_ns:int, duration_ns:int):
+        self.stages.append((stage, start_ns, duration_ns))
+
+    def test_disabled_by_default(self):
+        timing.set_timing_enabled(False, False)
+        allowed, _, headers = function_utils.validate_function_request(_function_request("https://app.test/api/test", { "subscription": "sub-1" }))
+        self.assertTrue(allowed)
+        self.assertIsNone(headers)
+        self.assertEqual(self.stages, [])
+        self.assertIsNone(timing.current_trace())
+
+    def test_stages_are_recorded(self):
+        timing.set_timing_enabled(True)
+        allowed, _, headers = function_utils.validate_function_request(_function_request("https://app.test/api/test", { "subscription": "sub-1" }))
+        self.assertTrue(allowed)
+        self.assertIsNone(headers)   ## No Server-Timing header unless asked for
+        self.assertEqual([ stage for stage, _, _ in self.stages ], [ timing.CONVERT, timing.LOOKUP, timing.RULES, timing.TOTAL ])
+        self.assertTrue(all(duration >= 0 for _, _, duration in self.stages))
+        self.assertIsNone(timing.current_trace())
+
+    def test_server_timing_header(self):
+        timing.set_timing_enabled(True, True)
+        allowed, _, headers = function_utils.validate_function_request(_function_request("https://app.test/api/test", { "subscription": "sub-1" }), return_headers=True)
+        self.assertTrue(allowed)
+        name, value = headers[-1]
+        self.assertEqual(name, "Server-Timing")
+        self.assertEqual([ entry.split(";")[0] for entry in value.split(", ") ], [ "convert", "lookup", "rules", "total" ])
+
+        ## Denied requests get the header too
+        allowed, _, resp = function_utils.validate_function_request(_function_request("https://other.test/api/test", { "subscription": "sub-1" }))
+        self.assertFalse(allowed)
+        self.assertIn("rules;dur=", resp.headers["Server-Timing"])
+
+    def test_store_stage(self):
+        class Connection:
+            def get_item(self, id:str, fields:list[str] = None) -> dict:
+                return { "id": id, "name": "Sub 2", "expiry": -1, "rules": [ { "name": "all", "type": "allow-all" } ] }
+
+        timing.set_timing_enabled(True)
+        sub_factory._COSMOS_DB_CONNECTION = Connection()
+        try:
+            trace = timing.start_trace()
+            self.assertIsNotNone(sub_factory.get_subscription("sub-2", False))
+            self.assertIsNotNone(sub_factory.get_subscription("sub-2", False))   ## Cached, so not timed
+            timing.finish_trace(trace)
+        finally:
+            sub_factory._COSMOS_DB_CONNECTION = None
+        self.assertEqual([ stage for stage, _, _ in trace.stages ], [ timing.STORE, timing.TOTAL ])
+
+    def test_trace_durations(self):
+        trace = timing.StageTrace()
+        trace.stages = [ ("lookup", 0, 1_000_000), ("rules", 0, 500_000), ("lookup", 0, 250_000) ]
+        self.assertEqual(trace.durations(), { "lookup": 1_250_000, "rules": 500_000 })
+        self.assertEqual(trace.server_timing(), "lookup;dur=1.250, rules;dur=0.500")
+        self.assertGreater(timing.to_epoch_ns(0), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import sys
+import os
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+
+from subauth import tokens
+
+
+class TestTokenCache(unittest.TestCase):
+    def setUp(self):
+        tokens.clear_token_cache()
+        self.calls = 0
+
+    def verify(self, token:str) -> dict:
+        self.calls += 1
+        time.sleep(0.02)
+        if token == "bad":
+            return None
+        return { "sub": token, "exp": time.time() + 600 }
+
+    def test_token_is_verified_once(self):
+        self.assertIsNone(tokens.get_cached_claims("token-a"))
+        claims = tokens.verify_and_cache("token-a", self.verify)
+        self.assertEqual(claims["sub"], "token-a")
+        self.assertEqual(tokens.get_cached_claims("token-a"), claims)
+        self.assertEqual(tokens.verify_and_cache("token-a", self.verify), claims)
+        self.assertEqual(self.calls, 1)
+
+    def test_failures_are_not_cached(self):
+        self.assertIsNone(tokens.verify_and_cache("bad", self.verify))
+        self.assertIsNone(tokens.verify_and_cache("bad", self.verify))
+        self.assertEqual(self.calls, 2)
+
+    def test_expired_tokens_are_not_cached(self):
+        tokens.verify_and_cache("old", lambda token: { "sub": token, "exp": time.time() - 1 })
+        self.assertIsNone(tokens.get_cached_claims("old"))
+
+    def test_expiry_is_capped(self):
+        claims = { "exp": time.time() + 10 * 86400 }
+        self.assertLessEqual(tokens._claims_expiry(b"", claims, 1000.0), 1000.0 + tokens.TOKEN_CACHE_MAX_TTL_SECONDS)
+        self.assertEqual(tokens._claims_expiry(b"", { "exp": 1500 }, 1000.0), 1500)
+
+    def test_concurrent_first_uses_verify_once(self):
+        results = []
+        threads = [ threading.Thread(target=lambda: results.append(tokens.verify_and_cache("token-b", self.verify))) for _ in range(0, 8) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(len(results), 8)
+        self.assertTrue(all(result["sub"] == "token-b" for result in results))
+        self.assertEqual(tokens._IN_FLIGHT, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
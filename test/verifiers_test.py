@@ -0,0 +1,73 @@
+import sys
+import os
+import time
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../benchmarks')))
+
+from jose.exceptions import JWTError, ExpiredSignatureError, JWTClaimsError
+from subauth.verifiers import JoseVerifier, CryptographyVerifier, create_verifier
+from subauth.jwks import JwksKeyManager
+from jwt_verify import make_signing_key, make_token, AUDIENCE, ISSUER
+
+PRIVATE_PEM, PUBLIC_JWK = make_signing_key("kid-1")
+OTHER_PEM, _ = make_signing_key("kid-1")
+
+
+class TestVerifiers(unittest.TestCase):
+    """
+    Both backends must accept and reject the same tokens.
+    """
+    def verify(self, verifier, token:str, audience:str = AUDIENCE, issuer:str = ISSUER):
+        key = verifier.prepare_key(PUBLIC_JWK)
+        return verifier.verify(token, lambda kid: key if kid == "kid-1" else None, audience, issuer)
+
+    def test_backends_agree(self):
+        for verifier in (JoseVerifier(), CryptographyVerifier()):
+            with self.subTest(verifier.name):
+                claims = self.verify(verifier, make_token(PRIVATE_PEM, "kid-1"))
+                self.assertEqual(claims["preferred_username"], "user@example.com")
+
+                self.assertIsNone(self.verify(verifier, make_token(PRIVATE_PEM, "kid-2")))
+                with self.assertRaises(ExpiredSignatureError):
+                    self.verify(verifier, make_token(PRIVATE_PEM, "kid-1", exp=int(time.time()) - 60))
+                with self.assertRaises(JWTClaimsError):
+                    self.verify(verifier, make_token(PRIVATE_PEM, "kid-1"), audience="someone-else")
+                with self.assertRaises(JWTClaimsError):
+                    self.verify(verifier, make_token(PRIVATE_PEM, "kid-1"), issuer="https://evil/v2.0")
+                with self.assertRaises(JWTError):
+                    self.verify(verifier, make_token(OTHER_PEM, "kid-1"))
+                with self.assertRaises(JWTError):
+                    self.verify(verifier, "not-a-token")
+
+    def test_create_verifier(self):
+        self.assertEqual(create_verifier("jose").name, "jose")
+        self.assertEqual(create_verifier("auto").name, "cryptography")
+        with self.assertRaises(ValueError):
+            create_verifier("nope")
+
+    def test_keys_are_prepared_once(self):
+        class CountingVerifier(CryptographyVerifier):
+            prepared = 0
+            def prepare_key(self, jwk):
+                CountingVerifier.prepared += 1
+                return super().prepare_key(jwk)
+
+        class Session:
+            def get(self, url, timeout=None):
+                class Response:
+                    def raise_for_status(self): pass
+                    def json(self): return { "keys": [ PUBLIC_JWK ] }
+                return Response()
+
+        manager = JwksKeyManager("https://login/keys", session=Session())
+        verifier = CountingVerifier()
+        token = make_token(PRIVATE_PEM, "kid-1")
+        for _ in range(0, 5):
+            verifier.verify(token, lambda kid: manager.get_prepared_key(kid, verifier), AUDIENCE, ISSUER)
+        self.assertEqual(CountingVerifier.prepared, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()